@@ -1,22 +1,27 @@
 import streamlit as st
-import google.generativeai as genai
-from google.generativeai.types import HarmCategory, HarmBlockThreshold
 import time
 import datetime
 import json
 import uuid
-import gspread
-try:
-    from gspread.exceptions import CellNotFound, WorksheetNotFound
-except ImportError:
-    try:
-        CellNotFound = gspread.CellNotFound
-        WorksheetNotFound = gspread.WorksheetNotFound
-    except AttributeError:
-        CellNotFound = Exception
-        WorksheetNotFound = Exception
-
-from oauth2client.service_account import ServiceAccountCredentials
+import copy
+import atexit
+import threading
+import functools
+import contextlib
+import re
+import os
+import hashlib
+import heapq
+import math
+import unicodedata
+import itertools
+import random
+import zlib
+import base64
+import sqlite3
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED, TimeoutError as FutureTimeoutError
+# google.generativeai・gspread・oauth2client は読み込みが重いので、最初に使う関数の中で import する
 
 # ==========================================
 # 1. 設定・準備
@@ -24,18 +29,81 @@ from oauth2client.service_account import ServiceAccountCredentials
 st.set_page_config(page_title="AI Director Assistant", layout="wide", initial_sidebar_state="expanded")
 
 ALLOWED_USERS = ["admin", "muramatsu", "wada"]
-error_container = st.container()
 
+# genai は文字列の指定も受け付けるので、起動時に google.generativeai を読み込まなくて済むよう名前で書く
 safety_settings = {
-    HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_NONE,
-    HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_NONE,
-    HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_NONE,
-    HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE,
+    "HARM_CATEGORY_HARASSMENT": "BLOCK_NONE",
+    "HARM_CATEGORY_HATE_SPEECH": "BLOCK_NONE",
+    "HARM_CATEGORY_SEXUALLY_EXPLICIT": "BLOCK_NONE",
+    "HARM_CATEGORY_DANGEROUS_CONTENT": "BLOCK_NONE",
 }
 
 model_high_quality = "gemini-2.5-pro"
 model_high_speed = "gemini-2.5-flash"
 
+# 自動保存の統合ウィンドウ（秒）。この間の連続保存は1回の書き込みにまとめる
+SAVE_DEBOUNCE_SEC = float(st.secrets.get("SAVE_DEBOUNCE_SEC", 3))
+# 保存先。"sqlite" はローカルの SQLite に読み書きして Sheets へは裏で複製する。"sheets" は Sheets に直接読み書きする
+STORAGE_BACKEND = st.secrets.get("STORAGE_BACKEND", "sqlite")
+LOCAL_DB_PATH = st.secrets.get("LOCAL_DB_PATH", ".local_store.sqlite3")
+# ログイン時に Sheets の一覧との突き合わせを待つ上限（秒）。超えたらローカルのデータで開き、突き合わせは裏で続ける
+REMOTE_READ_TIMEOUT_SEC = float(st.secrets.get("REMOTE_READ_TIMEOUT_SEC", 5))
+REPLICA_DELAY_SEC = float(st.secrets.get("REPLICA_DELAY_SEC", 2))  # 続けて来る変更をまとめてから Sheets に送る
+REPLICA_MAX_BACKOFF_SEC = 300
+# セッションごとに本文を保持しておくプロジェクト数（古いものから破棄し、選択時に読み直す）
+PROJECT_CACHE_SIZE = max(1, int(st.secrets.get("PROJECT_CACHE_SIZE", 5)))
+# 本文に残す履歴（会議中の出力・AI相談）の件数の上限。超えたら古い方を退避して半分にする
+HISTORY_MAX_ITEMS = max(2, int(st.secrets.get("HISTORY_MAX_ITEMS", 40)))
+HISTORY_PAGE_SIZE = 10   # 履歴を一度に表示する件数（「さらに表示」で増やす）
+CHAT_CONTEXT_TURNS = 5   # AI相談のプロンプトに入れる直近のやり取りの数
+# AI応答キャッシュ（同じモデル・プロンプトの再実行は API を呼ばずに返す）
+LLM_CACHE_DIR = st.secrets.get("LLM_CACHE_DIR", ".llm_cache")
+LLM_CACHE_TTL_SEC = float(st.secrets.get("LLM_CACHE_TTL_SEC", 7 * 24 * 3600))
+LLM_CACHE_MEMORY_ITEMS = int(st.secrets.get("LLM_CACHE_MEMORY_ITEMS", 200))
+LLM_CACHE_DISK_ITEMS = int(st.secrets.get("LLM_CACHE_DISK_ITEMS", 2000))
+# AI呼び出しを並列に投げるときの同時実行数（プロセス全体で共有）
+LLM_MAX_CONCURRENCY = max(1, int(st.secrets.get("LLM_MAX_CONCURRENCY", 4)))
+# generate_with_model の打ち切り時間（秒）
+LLM_DEADLINE_SEC = float(st.secrets.get("LLM_DEADLINE_SEC", 120))
+# 分析用モデルがこの秒数で応答しなければ対話用モデルにも同じ依頼を投げ、先に返った方を使う（0 で無効）
+HEDGE_AFTER_SEC = float(st.secrets.get("HEDGE_AFTER_SEC", 20))
+LATENCY_WINDOW_SEC = 600  # モデルごとのレイテンシを集計する期間
+LATENCY_MIN_SAMPLES = 5   # これより少ないうちは集計値を使わない
+# STEP 1・3・4 の生成は裏のジョブで実行する（プロジェクト切替や再接続をしても結果は残る）
+JOB_MAX_WORKERS = max(1, int(st.secrets.get("JOB_MAX_WORKERS", 4)))   # プロセス全体の同時実行数
+JOB_MAX_PER_USER = max(1, int(st.secrets.get("JOB_MAX_PER_USER", 2)))  # 1ユーザーの同時実行数（超えた分は順番待ち）
+JOB_POLL_SEC = 1.0                 # 実行中のジョブがあるとき、各タブが進み具合を確認する間隔
+JOB_RESULT_TTL_SEC = 24 * 3600     # 終わったジョブの結果を持っておく時間
+# STEP 1・3 の更新案を Gemini の構造化出力（JSON）で受け取る。無効なら ===SECTION1=== などの区切りで受け取る
+STRUCTURED_OUTPUT = bool(st.secrets.get("STRUCTURED_OUTPUT", False))
+# プロンプトに入れる全ログの上限（トークン概算）。超えた分は区間ごとの要約 + 直近の生ログにする
+TRANSCRIPT_TOKEN_BUDGET = int(st.secrets.get("TRANSCRIPT_TOKEN_BUDGET", 30000))
+TRANSCRIPT_CHUNK_CHARS = int(st.secrets.get("TRANSCRIPT_CHUNK_CHARS", 4000))
+TRANSCRIPT_TAIL_RATIO = 0.6  # 予算のうち直近の生ログに使う割合
+# 全ログ・履歴をローカルで全文検索し、関連する部分だけをプロンプトに入れる（AI相談、要約にした長いログの補足）
+RETRIEVAL_ENABLED = bool(st.secrets.get("RETRIEVAL_ENABLED", True))
+RETRIEVAL_TOKEN_BUDGET = int(st.secrets.get("RETRIEVAL_TOKEN_BUDGET", 2000))  # 1回のプロンプトに入れる検索結果の上限
+RETRIEVAL_TOP_K = 8
+RETRIEVAL_PASSAGE_CHARS = 400  # 全ログ・長い履歴を区切る単位
+RETRIEVAL_MAX_PROJECTS = 20    # 索引をメモリに持っておくプロジェクト数
+# プロジェクト情報（決定事項・未決・戦略・メモ）を Gemini のコンテキストキャッシュに載せる
+CONTEXT_CACHE_ENABLED = bool(st.secrets.get("CONTEXT_CACHE_ENABLED", True))
+CONTEXT_CACHE_TTL_SEC = int(st.secrets.get("CONTEXT_CACHE_TTL_SEC", 1800))
+CONTEXT_CACHE_MIN_TOKENS = int(st.secrets.get("CONTEXT_CACHE_MIN_TOKENS", 2048))  # API の最小トークン数未満は送らない
+CONTEXT_CACHE_MAX_ENTRIES = 50
+# 全セッション共通の呼び出し上限（1分あたり）。サービスアカウントと API キーを共有しているため、超える分は待たせる
+SHEETS_READS_PER_MIN = int(st.secrets.get("SHEETS_READS_PER_MIN", 60))
+SHEETS_WRITES_PER_MIN = int(st.secrets.get("SHEETS_WRITES_PER_MIN", 60))
+GEMINI_RPM = int(st.secrets.get("GEMINI_RPM", 60))         # モデルごと
+GEMINI_TPM = int(st.secrets.get("GEMINI_TPM", 1000000))    # モデルごと（プロンプトのトークン概算で数える）
+# 429・5xx などの一時的なエラーの再試行（待ち時間は指数的に伸ばし、揺らぎを入れる）
+RETRY_MAX_ATTEMPTS = max(1, int(st.secrets.get("RETRY_MAX_ATTEMPTS", 5)))
+RETRY_BASE_SEC = 1.0
+RETRY_MAX_SEC = 32.0
+# 計測結果を JSONL で書き出すファイル（空なら書き出さない）
+TELEMETRY_JSONL = st.secrets.get("TELEMETRY_JSONL", "")
+TELEMETRY_MAX_SPANS = 5000
+
 DEFAULT_TEMPLATE = """■基本情報
 クライアント名：
 新規・リニューアル：
@@ -90,15 +158,468 @@ TikTok：
 ・セクションタイトル（見出し）
 本文本文本文本文本文本文本文本文"""
 
+# --- 計測 ---
+class Telemetry:
+    """Sheets / Gemini 呼び出しの計測。1回の呼び出しを1スパン（所要時間・送受信バイト数・トークン数・エラー種別）として残す。
+    スパンにはスクリプト実行スレッドで bind したセッション ID と実行回（rerun の番号）が付く"""
+
+    def __init__(self, jsonl_path, max_spans):
+        self.jsonl_path = jsonl_path
+        self._lock = threading.Lock()
+        self._spans = deque(maxlen=max_spans)
+        self._local = threading.local()
+
+    def bind(self, session_id, run_id):
+        self._local.tags = {"session": session_id, "run": run_id}
+
+    def wrap(self, fn):
+        """呼び出し元のセッション・実行回を引き継いで、別スレッドで fn を実行するためのラッパー"""
+        tags = dict(getattr(self._local, "tags", {}))
+        @functools.wraps(fn)
+        def wrapped(*args, **kwargs):
+            self._local.tags = tags
+            return fn(*args, **kwargs)
+        return wrapped
+
+    @contextlib.contextmanager
+    def span(self, name, **attrs):
+        record = {"name": name, "session": None, "run": None, **getattr(self._local, "tags", {}), **attrs,
+                  "ts": time.time(), "error": None}
+        stack = self._local.__dict__.setdefault("stack", [])
+        stack.append(record)
+        start = time.perf_counter()
+        try:
+            yield record
+        except Exception as e:
+            record["error"] = type(e).__name__
+            raise
+        finally:
+            stack[:] = [r for r in stack if r is not record]
+            record["duration_ms"] = round((time.perf_counter() - start) * 1000, 1)
+            self._record(record)
+
+    def annotate(self, **attrs):
+        """実行中のスパンに値を追加する"""
+        stack = getattr(self._local, "stack", None)
+        if stack: stack[-1].update(attrs)
+
+    def add(self, **amounts):
+        """実行中のスパンの数値に加算する"""
+        stack = getattr(self._local, "stack", None)
+        if stack:
+            for key, amount in amounts.items():
+                stack[-1][key] = stack[-1].get(key, 0) + amount
+
+    def _record(self, record):
+        with self._lock:
+            self._spans.append(record)
+            if self.jsonl_path:
+                try:
+                    with open(self.jsonl_path, "a", encoding="utf-8") as f:
+                        f.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+                except OSError:
+                    pass
+
+    def summary(self, session_id, run_id):
+        """セッション内の呼び出しを名前ごとに集計する（p50 / p95 はミリ秒）"""
+        with self._lock:
+            spans = [s for s in self._spans if s["session"] == session_id]
+        rows = {}
+        for s in spans:
+            row = rows.setdefault(s["name"], {"呼び出し": s["name"], "今回": 0, "累計": 0, "エラー": 0, "再試行": 0,
+                                              "durations": [], "待ち秒": 0.0, "送信KB": 0.0, "受信KB": 0.0, "トークン": 0})
+            row["累計"] += 1
+            row["今回"] += s["run"] == run_id
+            row["エラー"] += bool(s["error"])
+            row["再試行"] += s.get("retries", 0)
+            row["待ち秒"] += s.get("queued_sec", 0)
+            row["durations"].append(s["duration_ms"])
+            row["送信KB"] += s.get("bytes_out", 0) / 1024
+            row["受信KB"] += s.get("bytes_in", 0) / 1024
+            row["トークン"] += s.get("prompt_tokens", 0) + s.get("response_tokens", 0)
+        result = []
+        for row in rows.values():
+            durations = sorted(row.pop("durations"))
+            row["p50 ms"] = durations[len(durations) // 2]
+            row["p95 ms"] = durations[min(len(durations) - 1, int(len(durations) * 0.95))]
+            row["待ち秒"] = round(row["待ち秒"], 1)
+            row["送信KB"] = round(row["送信KB"], 1)
+            row["受信KB"] = round(row["受信KB"], 1)
+            result.append(row)
+        return sorted(result, key=lambda r: r["呼び出し"])
+
+@st.cache_resource
+def get_telemetry():
+    return Telemetry(TELEMETRY_JSONL, TELEMETRY_MAX_SPANS)
+
+telemetry = get_telemetry()
+
+def _approx_bytes(value):
+    """読み込んだデータのおおよそのサイズ（文字列の UTF-8 バイト数の合計）"""
+    if isinstance(value, str):
+        return len(value.encode("utf-8"))
+    if isinstance(value, dict):
+        return sum(_approx_bytes(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(_approx_bytes(v) for v in value)
+    return 0
+
+def instrumented(name, measure_result=True):
+    """メソッドの呼び出しを計測する。measure_result なら戻り値のサイズを受信バイト数として記録する"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with telemetry.span(name) as record:
+                result = fn(*args, **kwargs)
+                if measure_result and "bytes_in" not in record:
+                    record["bytes_in"] = _approx_bytes(result)
+                return result
+        return wrapper
+    return decorator
+
+# --- 流量制御 ---
+PRIORITY_INTERACTIVE = 0  # 画面の操作から直接呼ばれるもの
+PRIORITY_BACKGROUND = 1   # 保存キュー・Sheets への複製
+
+class TokenBucket:
+    """毎秒 rate 個補充され、capacity 個まで貯まるトークンバケツ。
+    足りないときは待ち、待っている呼び出しには優先度の高い順 → 到着順に払い出す"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._cond = threading.Condition()
+        self._waiters = []  # (優先度, 到着順) のヒープ
+        self._seq = itertools.count()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, cost=1, priority=PRIORITY_INTERACTIVE):
+        """トークンを取り出す。待った秒数を返す"""
+        cost = min(cost, self.capacity)  # 1回で上限を超える要求は満タンになるのを待って通す
+        ticket = (priority, next(self._seq))
+        started = time.monotonic()
+        with self._cond:
+            heapq.heappush(self._waiters, ticket)
+            try:
+                while True:
+                    self._refill()
+                    first = self._waiters[0] == ticket
+                    if first and self.tokens >= cost:
+                        self.tokens -= cost
+                        return time.monotonic() - started
+                    # 先頭だけが補充を待ち、後ろは先頭が取り出したときに起こされる
+                    self._cond.wait((cost - self.tokens) / self.rate if first else None)
+            finally:
+                self._waiters.remove(ticket)
+                heapq.heapify(self._waiters)
+                self._cond.notify_all()
+
+    def drain(self):
+        """429 を受けたときに呼ぶ。貯まっていた分を捨て、以降の呼び出しを補充のペースまで落とす"""
+        with self._cond:
+            self._refill()
+            self.tokens = min(self.tokens, 0)
+
+def _is_quota_error(e):
+    msg = str(e)
+    return bool(re.search(r"\b429\b", msg)) or any(s in msg for s in (
+        "RESOURCE_EXHAUSTED", "Resource has been exhausted", "Quota exceeded", "rateLimitExceeded"))
+
+def _is_transient_error(e):
+    """時間をおけば成功しうるエラー（クォータ超過・サーバー側の一時的な障害・通信エラー）"""
+    if _is_quota_error(e) or isinstance(e, (ConnectionError, TimeoutError)):
+        return True
+    msg = str(e)
+    return bool(re.search(r"\b(500|502|503|504)\b", msg)) or any(s in msg for s in (
+        "UNAVAILABLE", "DEADLINE_EXCEEDED", "Internal error", "Connection aborted", "timed out"))
+
+class RateLimiter:
+    """Sheets（読み・書き）と Gemini（モデルごとの RPM・TPM）の呼び出しをプロセス全体で制御する。
+    上限を超える呼び出しはエラーにせず待たせ、一時的なエラーは指数バックオフ（揺らぎ付き）で再試行する。
+    裏スレッドは mark_background() しておくと、待ちの中で画面操作からの呼び出しに順番を譲る"""
+
+    def __init__(self, per_minute, attempts, base_sec, max_sec):
+        self.per_minute = per_minute  # バケツの種類 → 1分あたりの上限
+        self.attempts = attempts
+        self.base_sec = base_sec
+        self.max_sec = max_sec
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self._local = threading.local()
+
+    def bucket(self, name):
+        """name は "sheets.read" や "gemini.rpm:gemini-2.5-pro"（: 以降はモデルなどの区別）"""
+        with self._lock:
+            if name not in self._buckets:
+                limit = max(1, self.per_minute[name.split(":")[0]])
+                # 1分の上限を一度に使い切らないよう、瞬間的に通すのは4分の1まで
+                self._buckets[name] = TokenBucket(limit / 60, max(1.0, limit / 4))
+            return self._buckets[name]
+
+    def mark_background(self):
+        """このスレッドからの呼び出しを低優先度にする（裏スレッドの開始時に呼ぶ）"""
+        self._local.priority = PRIORITY_BACKGROUND
+
+    def run(self, costs, fn, retry_transient=True):
+        """costs（[(バケツ名, 量)]）を取り出してから fn() を呼ぶ。
+        クォータ超過は常に、その他の一時的なエラーは retry_transient のときだけ再試行する"""
+        priority = getattr(self._local, "priority", PRIORITY_INTERACTIVE)
+        for attempt in range(self.attempts):
+            queued = sum(self.bucket(name).acquire(cost, priority) for name, cost in costs)
+            if queued > 0.01: telemetry.add(queued_sec=queued)
+            try:
+                return fn()
+            except Exception as e:
+                quota = _is_quota_error(e)
+                if attempt + 1 >= self.attempts or not (quota or (retry_transient and _is_transient_error(e))):
+                    raise
+                if quota:
+                    for name, _ in costs:
+                        self.bucket(name).drain()
+                telemetry.add(retries=1)
+                time.sleep(random.uniform(0, min(self.max_sec, self.base_sec * 2 ** attempt)))
+
+@st.cache_resource
+def get_rate_limiter():
+    return RateLimiter({
+        "sheets.read": SHEETS_READS_PER_MIN, "sheets.write": SHEETS_WRITES_PER_MIN,
+        "gemini.rpm": GEMINI_RPM, "gemini.tpm": GEMINI_TPM,
+    }, RETRY_MAX_ATTEMPTS, RETRY_BASE_SEC, RETRY_MAX_SEC)
+
+rate_limiter = get_rate_limiter()
+
 # ==========================================
 # 2. データベース管理クラス
 # ==========================================
+PROJECT_HEADERS = ["project_id", "confirmed", "pending", "memo", "transcript", "json_data", "updated_at", "strategy"]
+CONFIG_HEADERS = ["user_id", "api_key", "last_project_id"]
+# 差分保存用: プロジェクトの項目 → 書き込む列（履歴系は json_data 列にまとめて入る）
+FIELD_COLUMNS = {
+    "confirmed": "B", "pending": "C", "director_memo": "D", "full_transcript": "E",
+    "meeting_history": "F", "chat_history": "F", "chat_context": "F", "transcript_digest": "F",
+    "history_archived": "F", "transcript_base_seq": "F", "transcript_seq": "F", "instruction_book": "F",
+    "strategy": "H",
+}
+
+# transcript / json_data 列の保存形式
+CODEC_TAG = "#zc1:"       # 圧縮形式の目印（v1: zlib + base64）。旧形式の行はそのまま平文
+CELL_CHAR_LIMIT = 45000   # Sheets の1セル上限 50,000 文字に余裕を持たせた分割単位
+CODEC_MIN_CHARS = 2000    # これより短い値は圧縮しない
+PACKED_COLUMNS = ("E", "F")
+# 1セルに収まらない圧縮データの続きを置くシート（1行 = A列のキー + 続きのチャンク）
+OVERFLOW_SHEET = "_overflow"
+OVERFLOW_HEADERS = ["key", "data"]
+# 本文から退避した古い履歴を置くシート（1行 = キー "<user>/<project>/<項目>" + 連番 + 1件分の JSON）
+ARCHIVE_SHEET = "_archive"
+ARCHIVE_HEADERS = ["key", "seq", "entry"]
+# 会議ログの追記分を置くシート（1行 = キー "<user>/<project>" + 連番 + 追記日時 + 追記したテキスト）。
+# 全ログは transcript 列（ベース）に、連番が transcript_base_seq より大きい追記分を順に足したもの。
+# 最後に追記した連番は json_data の transcript_seq に持ち、追記分があるか・ローカルに揃っているかの判定に使う
+TRANSCRIPT_SHEET = "_transcript"
+TRANSCRIPT_HEADERS = ["key", "seq", "at", "text"]
+
+# gspread のメソッドのうち書き込みクォータを使うもの（それ以外は読み込みとして数える）
+SHEETS_WRITE_METHODS = {
+    "update", "batch_update", "update_cell", "update_cells", "append_row", "append_rows",
+    "resize", "add_cols", "add_rows", "add_worksheet", "batch_clear", "clear",
+}
+# 失敗しても実は反映されていた場合に、再送すると行やシートが重複するもの（クォータ超過のときだけ再送する）
+SHEETS_NON_IDEMPOTENT = {"append_row", "append_rows", "add_cols", "add_rows", "add_worksheet"}
+# 戻り値の Spreadsheet / Worksheet も流量制御の対象にするメソッド
+SHEETS_HANDLE_METHODS = {"open", "worksheet", "add_worksheet"}
+
+# サービスアカウントのアクセストークンは1時間で失効するため、少し早めに再認証する
+AUTH_TTL_SEC = 50 * 60
+# 読み込みでは、行番号索引をこの秒数以上確認していなければ A 列のキーを1セルだけ読んで確かめる（書き込み前は毎回確かめる）
+ROW_INDEX_VERIFY_SEC = 300
+
+class SheetsPool:
+    """全セッションで共有する認証済みクライアント・スプレッドシート・ワークシートのキャッシュ"""
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.reset()
+
+    def reset(self):
+        """認証切れなどで全体を作り直すときに呼ぶ"""
+        with self.lock:
+            self.client = None
+            self.spreadsheet = None
+            self.authorized_at = 0.0
+            self.worksheets = {}  # title -> Worksheet
+            self.checked = set()  # スキーマ確認済みのシート名
+            self.row_index = {}   # title -> {A列のキー: [行番号, 最終確認時刻]}
+            self.user_configs = {}  # user_id -> シートに入っている (api_key, last_project_id)
+
+    def invalidate(self, title):
+        with self.lock:
+            self.worksheets.pop(title, None)
+            self.checked.discard(title)
+            self.row_index.pop(title, None)
+            if title == "config":
+                self.user_configs.clear()
+
+    def set_row_index(self, title, keys):
+        """2行目以降の A 列の値の並びから索引を作る"""
+        now = time.time()
+        index = {}
+        for i, key in enumerate(keys):
+            key = str(key)
+            if key and key not in index:
+                index[key] = [i + 2, now]
+        with self.lock:
+            self.row_index[title] = index
+
+class RateLimitedSheets:
+    """gspread の Client / Spreadsheet / Worksheet を包み、API を呼ぶメソッドを rate_limiter に通す"""
+
+    def __init__(self, target):
+        self._target = target
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if name.startswith("_") or not callable(attr):
+            return attr
+        bucket = "sheets.write" if name in SHEETS_WRITE_METHODS else "sheets.read"
+
+        @functools.wraps(attr)
+        def call(*args, **kwargs):
+            result = rate_limiter.run([(bucket, 1)], lambda: attr(*args, **kwargs),
+                                      retry_transient=name not in SHEETS_NON_IDEMPOTENT)
+            return RateLimitedSheets(result) if name in SHEETS_HANDLE_METHODS else result
+        return call
+
+@st.cache_resource
+def get_sheets_pool():
+    return SheetsPool()
+
+def _is_auth_error(e):
+    msg = str(e)
+    return any(s in msg for s in ("401", "UNAUTHENTICATED", "invalid_grant", "Token has been expired"))
+
+def mark_dirty(proj, *fields):
+    """次回の保存で書き込む項目を記録する"""
+    proj.setdefault("_dirty", set()).update(fields)
+
+def _merge_fields(a, b):
+    """差分保存の対象項目をまとめる（None は行全体の書き込み）"""
+    if a is None or b is None: return None
+    return a | b
+
+def _project_cells(project_id, data, columns, updated_at):
+    """指定した列の値を {列: 値} で返す。json_data は F 列を書くときだけ組み立てる"""
+    getters = {
+        "A": lambda: project_id,
+        "B": lambda: data["confirmed"],
+        "C": lambda: data["pending"],
+        "D": lambda: data["director_memo"],
+        "E": lambda: data["full_transcript"],
+        "F": lambda: json.dumps({
+            "meeting_history": data["meeting_history"],
+            "chat_history": data["chat_history"],
+            "chat_context": data["chat_context"],
+            "transcript_digest": data.get("transcript_digest", {}),
+            "history_archived": data.get("history_archived", {}),
+            "transcript_base_seq": data.get("transcript_base_seq", 0),
+            "transcript_seq": data.get("transcript_seq"),
+            "instruction_book": data.get("instruction_book", {})
+        }, ensure_ascii=False),
+        "G": lambda: updated_at,
+        "H": lambda: data.get("strategy", ""),
+    }
+    return {col: getters[col]() for col in sorted(columns)}
+
+def pack_cell(text, version=None):
+    """(セルに書く値, 続きのチャンクのリスト) を返す。
+    圧縮形式は "#zc1:<チャンク数>:<base64の先頭>"。短い値や圧縮が効かない値は平文のまま。
+    続きのチャンクがあるときに version を渡すと "#zc1:<チャンク数>.<version>:..." にする（_overflow_key を参照）"""
+    text = "" if text is None else str(text)
+    must_pack = len(text) > CELL_CHAR_LIMIT or text.startswith(CODEC_TAG)
+    if not must_pack and len(text) < CODEC_MIN_CHARS:
+        return text, []
+    raw = text.encode("utf-8")
+    packed = base64.b64encode(zlib.compress(raw, 6)).decode("ascii")
+    if not must_pack and len(packed) >= len(raw):
+        return text, []
+    chunks = [packed[i:i + CELL_CHAR_LIMIT] for i in range(0, len(packed), CELL_CHAR_LIMIT)]
+    header = f"{len(chunks)}.{version}" if version and len(chunks) > 1 else str(len(chunks))
+    return f"{CODEC_TAG}{header}:{chunks[0]}", chunks[1:]
+
+def _codec_header(text):
+    """圧縮形式の値から (チャンク数, version, base64の先頭) を取り出す"""
+    header, _, first = text[len(CODEC_TAG):].partition(":")
+    count, _, version = header.partition(".")
+    return int(count), version, first
+
+def unpack_cell(value, overflow=()):
+    """pack_cell の逆変換。overflow には _overflow シートの続きのチャンクを渡す"""
+    text = "" if value is None else str(value)
+    if not text.startswith(CODEC_TAG):
+        return text
+    count, _, first = _codec_header(text)
+    chunks = [first, *list(overflow)[:count - 1]]
+    if len(chunks) != count:
+        raise ValueError("分割データが不足しています")
+    return zlib.decompress(base64.b64decode("".join(chunks))).decode("utf-8")
+
+def _overflow_key(key, value):
+    """値の続きのチャンクを置く _overflow シートのキー。version 付きの値は書き込みごとに別のキーになる"""
+    version = _codec_header(str(value))[1]
+    return f"{key}/{version}" if version else key
+
+def _has_overflow(value):
+    text = str(value)
+    return text.startswith(CODEC_TAG) and not text.startswith(f"{CODEC_TAG}1:")
+
+def _appended_row(response):
+    """append_row のレスポンス（updatedRange: 'user'!A5:H5）から追記された行番号を取り出す"""
+    try:
+        match = re.search(r"![A-Z]+(\d+)", response["updates"]["updatedRange"])
+        return int(match.group(1))
+    except Exception:
+        return None
+
+def _worksheet_not_found():
+    """gspread の WorksheetNotFound（古い gspread では場所が違い、無ければ判定しない）"""
+    import gspread
+    try:
+        from gspread.exceptions import WorksheetNotFound
+    except ImportError:
+        WorksheetNotFound = getattr(gspread, "WorksheetNotFound", None)
+    return WorksheetNotFound
+
+def _is_missing_sheet_error(e):
+    not_found = _worksheet_not_found()
+    if not_found is not None and isinstance(e, not_found):
+        return True
+    msg = str(e)
+    return "Unable to parse range" in msg or ("404" in msg and "not found" in msg.lower())
+
 class SpreadsheetDB:
     def __init__(self):
-        self.client = self._auth()
+        self.pool = get_sheets_pool()
         self.sheet_name = st.secrets.get("SPREADSHEET_NAME", "ai_director_db")
+
+    @property
+    def client(self):
+        pool = self.pool
+        with pool.lock:
+            if pool.client is None or time.time() - pool.authorized_at > AUTH_TTL_SEC:
+                pool.reset()
+                client = self._auth()
+                pool.client = RateLimitedSheets(client) if client else None
+                pool.authorized_at = time.time()
+            return pool.client
         
+    @instrumented("sheets.auth", measure_result=False)
     def _auth(self):
+        import gspread
+        from oauth2client.service_account import ServiceAccountCredentials
         try:
             scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
             if "gcp_service_account" in st.secrets:
@@ -109,10 +630,21 @@ class SpreadsheetDB:
             st.error(f"認証エラー: {e}")
         return None
 
+    def _spreadsheet(self):
+        client = self.client
+        with self.pool.lock:
+            if self.pool.spreadsheet is None:
+                self.pool.spreadsheet = client.open(self.sheet_name)
+            return self.pool.spreadsheet
+
     def _get_or_create_worksheet(self, title, headers):
-        """シートを取得し、列不足があれば自動拡張する"""
+        """シートを取得し、列不足があれば自動拡張する（取得済みのハンドルは全セッションで共有）"""
+        pool = self.pool
+        with pool.lock:
+            if title in pool.checked:
+                return pool.worksheets[title]
         try:
-            spreadsheet = self.client.open(self.sheet_name)
+            spreadsheet = self._spreadsheet()
             try:
                 ws = spreadsheet.worksheet(title)
                 
@@ -131,153 +663,1497 @@ class SpreadsheetDB:
                     except:
                         ws.update('A1', [headers])
                         
-            except WorksheetNotFound:
+            except Exception as e:
+                if not _is_missing_sheet_error(e): raise
                 ws = spreadsheet.add_worksheet(title=title, rows=100, cols=len(headers))
                 ws.append_row(headers)
+            with pool.lock:
+                pool.worksheets[title] = ws
+                pool.checked.add(title)
             return ws
         except Exception as e:
+            if _is_auth_error(e):
+                pool.reset()
             st.error(f"シート操作エラー: {e}")
             return None
 
-    def get_user_config(self, user_id):
-        ws = self._get_or_create_worksheet("config", ["user_id", "api_key", "last_project_id"])
-        if not ws: return None, None
-        try:
-            records = ws.get_all_records()
-            for r in records:
-                if str(r["user_id"]) == user_id:
-                    return r["api_key"], r["last_project_id"]
-        except: pass
+    def _with_worksheet(self, title, headers, fn, default=None):
+        """キャッシュしたシートで fn(ws) を実行する。
+        認証切れ・シート消失でハンドルが古くなっていた場合は1度だけ取り直して再試行する。"""
+        for attempt in range(2):
+            ws = self._get_or_create_worksheet(title, headers)
+            if not ws: return default
+            try:
+                return fn(ws)
+            except Exception as e:
+                if attempt == 0 and _is_auth_error(e):
+                    self.pool.reset()
+                elif attempt == 0 and _is_missing_sheet_error(e):
+                    self.pool.invalidate(title)
+                    with self.pool.lock:
+                        self.pool.spreadsheet = None
+                else:
+                    raise
+
+    def _find_row(self, ws, title, key, for_write=False):
+        """索引からキーの行番号を返す（無ければ None）。
+        索引が無いとき、または古い索引の行に別のキーが入っていたときは A 列を読み直す。
+        for_write=True（その行を書き換える前）なら、索引を確かめた時刻に関係なく A 列のキーを必ず確かめる"""
+        pool = self.pool
+        with pool.lock:
+            index = pool.row_index.get(title)
+        if index is None:
+            pool.set_row_index(title, ws.col_values(1)[1:])
+            with pool.lock:
+                index = pool.row_index[title]
+        entry = index.get(key)
+        if entry is None: return None
+        row, verified_at = entry
+        if for_write or time.time() - verified_at > ROW_INDEX_VERIFY_SEC:
+            if str(ws.acell(f"A{row}").value) != key:
+                # 手動編集などで行がずれている
+                pool.set_row_index(title, ws.col_values(1)[1:])
+                with pool.lock:
+                    entry = pool.row_index[title].get(key)
+                return entry[0] if entry else None
+            entry[1] = time.time()
+        return row
+
+    def _append_keyed_row(self, ws, title, row_data):
+        response = ws.append_row(row_data)
+        row = _appended_row(response)
+        with self.pool.lock:
+            index = self.pool.row_index.get(title)
+            if index is not None:
+                if row: index[str(row_data[0])] = [row, time.time()]
+                else: self.pool.row_index.pop(title, None)
+
+    def _save_overflow(self, key, chunks):
+        """セルに収まらない圧縮データの続きを _overflow シートのキーの行に書く。
+        書けなかった場合は例外を投げる（続きの無い本体を書かせない）"""
+        def write(ws):
+            if ws.col_count < len(chunks) + 1:
+                ws.add_cols(len(chunks) + 1 - ws.col_count)
+            row = self._find_row(ws, OVERFLOW_SHEET, key, for_write=True)
+            if row is None:
+                self._append_keyed_row(ws, OVERFLOW_SHEET, [key, *chunks])
+            else:
+                ws.update(range_name=f"A{row}", values=[[key, *chunks]])
+            return True
+        if not self._with_worksheet(OVERFLOW_SHEET, OVERFLOW_HEADERS, write, default=False):
+            raise RuntimeError(f"{OVERFLOW_SHEET} シートを開けません")
+
+    def _read_overflow(self, key):
+        """1つのキーの続きのチャンクだけを読む"""
+        def read(ws):
+            row = self._find_row(ws, OVERFLOW_SHEET, key)
+            return ws.row_values(row)[1:] if row else []
+        return self._with_worksheet(OVERFLOW_SHEET, OVERFLOW_HEADERS, read, default=[])
+
+    def _parse_project(self, user_id, pid, r, overflow):
+        """シートの1行（ヘッダー名 → 値）をプロジェクトの dict にする。
+        overflow(key) は続きのチャンクを返す関数。
+        復元できない値は ValueError にする（空の履歴として返すと、次の保存で Sheets の値を上書きしてしまう）"""
+        def unpack(col, value):
+            return unpack_cell(value, overflow(_overflow_key(f"{user_id}/{pid}/{col}", value)) if _has_overflow(value) else ())
+        try:
+            transcript = unpack("E", r["transcript"])
+            json_text = unpack("F", r["json_data"])
+            extra_data = json.loads(json_text) if json_text else {}
+        except (ValueError, zlib.error) as e:
+            raise ValueError(f"{pid}: 圧縮データの復元に失敗しました ({e})") from e
+
+        return {
+            "confirmed": r["confirmed"],
+            "pending": r["pending"],
+            "director_memo": r["memo"],
+            "full_transcript": transcript,
+            "strategy": r.get("strategy", ""),
+            "meeting_history": extra_data.get("meeting_history", []),
+            "chat_history": extra_data.get("chat_history", []),
+            "chat_context": extra_data.get("chat_context", []),
+            "transcript_digest": extra_data.get("transcript_digest", {}),
+            "history_archived": extra_data.get("history_archived", {}),
+            "transcript_base_seq": extra_data.get("transcript_base_seq", 0),
+            # 項目ができる前に保存した行は None（追記分の有無が分からないので読みに行く）
+            "transcript_seq": extra_data.get("transcript_seq"),
+            "instruction_book": extra_data.get("instruction_book", {}),
+            "_dirty": set()
+        }
+
+    @instrumented("sheets.get_user_config")
+    def get_user_config(self, user_id, strict=False):
+        """strict=True なら読み込みエラーを握りつぶさずに投げる（ReplicatedStore 用）。
+        一度読んだ・書いた値は pool に持ち、シートは索引で引いたそのユーザーの行だけを読む"""
+        with self.pool.lock:
+            cached = self.pool.user_configs.get(user_id)
+        if cached is not None:
+            return cached
+        def read(ws):
+            row = self._find_row(ws, "config", user_id)
+            values = ws.row_values(row)[1:3] if row else []
+            config = tuple(str(v) for v in values + [""] * (2 - len(values)))
+            with self.pool.lock:
+                self.pool.user_configs[user_id] = config
+            return config
+        try:
+            return self._with_worksheet("config", CONFIG_HEADERS, read, default=(None, None))
+        except Exception:
+            if strict: raise
         return "", ""
 
+    @instrumented("sheets.save_user_config", measure_result=False)
     def save_user_config(self, user_id, api_key, last_project_id):
-        ws = self._get_or_create_worksheet("config", ["user_id", "api_key", "last_project_id"])
-        if not ws: return
-        try:
-            cell = ws.find(user_id, in_column=1)
-            ws.update_cell(cell.row, 2, api_key)
-            ws.update_cell(cell.row, 3, last_project_id)
-        except CellNotFound:
-            ws.append_row([user_id, api_key, last_project_id])
-
-    def get_user_projects(self, user_id):
-        headers = ["project_id", "confirmed", "pending", "memo", "transcript", "json_data", "updated_at", "strategy"]
-        ws = self._get_or_create_worksheet(user_id, headers)
-        if not ws: return {}
-
-        projects = {}
-        try:
-            records = ws.get_all_records()
-            for r in records:
-                pid = str(r["project_id"])
-                if not pid: continue
+        """保存に失敗した場合はエラーメッセージを返す。シートの値と同じなら書き込まない"""
+        config = (api_key or "", last_project_id or "")
+        with self.pool.lock:
+            if self.pool.user_configs.get(user_id) == config:
+                telemetry.annotate(skipped=True)
+                return None
+        def write(ws):
+            row = self._find_row(ws, "config", user_id, for_write=True)
+            if row is None:
+                self._append_keyed_row(ws, "config", [user_id, *config])
+            else:
+                ws.update(range_name=f"B{row}:C{row}", values=[list(config)])
+            with self.pool.lock:
+                self.pool.user_configs[user_id] = config
+            return None
+        try:
+            return self._with_worksheet("config", CONFIG_HEADERS, write, default="シートを開けません")
+        except Exception as e:
+            telemetry.annotate(error=type(e).__name__)
+            return f"設定保存エラー: {e}"
+
+    @instrumented("sheets.archive_entries", measure_result=False)
+    def archive_entries(self, user_id, project_id, kind, entries):
+        """退避する履歴 [(連番, 1件分の dict)...] を _archive シートに追記する。
+        失敗した場合はエラーメッセージを返す"""
+        key = f"{user_id}/{project_id}/{kind}"
+        rows = []
+        for seq, entry in entries:
+            value, chunks = pack_cell(json.dumps(entry, ensure_ascii=False))
+            if chunks: self._save_overflow(f"{key}/{seq}", chunks)
+            rows.append([key, str(seq), value])  # 連番は文字列で送り、指数表記に丸められないようにする
+        telemetry.annotate(bytes_out=_approx_bytes(rows))
+
+        def write(ws):
+            ws.append_rows(rows)
+            return None
+        try:
+            return self._with_worksheet(ARCHIVE_SHEET, ARCHIVE_HEADERS, write, default="シートを開けません")
+        except Exception as e:
+            telemetry.annotate(error=type(e).__name__)
+            return f"履歴の退避エラー: {e}"
+
+    def _read_keyed_rows(self, title, headers, key, after=None):
+        """全ユーザー共通の追記専用シート（_archive / _transcript）から、A 列がキーの行の B 列以降を
+        シートの並び順で返す。after を渡すと連番（B 列）がそれより大きい行だけにする。
+        キーと連番の列だけを読んで行を決め、該当する行だけを取りに行く"""
+        last = chr(ord("A") + len(headers) - 1)
+
+        def read(ws):
+            rows = []
+            for i, r in enumerate(ws.batch_get(["A2:B"])[0]):
+                if len(r) < 2 or r[0] != key: continue
                 try:
-                    extra_data = json.loads(r["json_data"]) if r["json_data"] else {}
-                except:
-                    extra_data = {}
-
-                projects[pid] = {
-                    "confirmed": r["confirmed"],
-                    "pending": r["pending"],
-                    "director_memo": r["memo"],
-                    "full_transcript": r["transcript"],
-                    "strategy": r.get("strategy", ""),
-                    "meeting_history": extra_data.get("meeting_history", []),
-                    "chat_history": extra_data.get("chat_history", []),
-                    "chat_context": extra_data.get("chat_context", [])
-                }
+                    if after is None or int(r[1]) > after: rows.append(i + 2)
+                except ValueError:
+                    continue  # 壊れた行は飛ばす
+            if not rows: return []
+            return [values[0] if values else [] for values in ws.batch_get([f"B{row}:{last}{row}" for row in rows])]
+        values = self._with_worksheet(title, headers, read, default=[])
+        telemetry.annotate(rows=len(values))
+        return values
+
+    @instrumented("sheets.load_archive")
+    def load_archive(self, user_id, project_id, kind, strict=False):
+        """退避した履歴を [(連番, dict)...] の連番順で返す"""
+        key = f"{user_id}/{project_id}/{kind}"
+        try:
+            rows = self._read_keyed_rows(ARCHIVE_SHEET, ARCHIVE_HEADERS, key)
+        except Exception as e:
+            if strict: raise
+            st.warning(f"履歴の読み込みエラー: {e}")
+            return []
+        entries = {}
+        for r in rows:
+            if len(r) < 2: continue
+            try:
+                overflow = self._read_overflow(f"{key}/{r[0]}") if _has_overflow(r[1]) else ()
+                entries[int(r[0])] = json.loads(unpack_cell(r[1], overflow))
+            except (ValueError, zlib.error):
+                continue  # 壊れた行は飛ばす（再送で重複した行は連番で1つにまとまる）
+        return sorted(entries.items())
+
+    @instrumented("sheets.append_transcript", measure_result=False)
+    def append_transcript(self, user_id, project_id, segments):
+        """会議ログの追記分 [(連番, 追記日時, テキスト)...] を _transcript シートに行として足す（既存の行は書き換えない）。
+        失敗した場合はエラーメッセージを返す"""
+        key = f"{user_id}/{project_id}"
+        rows = []
+        for seq, at, text in segments:
+            value, chunks = pack_cell(text)
+            if chunks: self._save_overflow(f"{key}/{seq}", chunks)
+            rows.append([key, str(seq), at, value])
+        telemetry.annotate(bytes_out=_approx_bytes(rows))
+
+        def write(ws):
+            ws.append_rows(rows)
+            return None
+        try:
+            return self._with_worksheet(TRANSCRIPT_SHEET, TRANSCRIPT_HEADERS, write, default="シートを開けません")
+        except Exception as e:
+            telemetry.annotate(error=type(e).__name__)
+            return f"ログの保存エラー: {e}"
+
+    @instrumented("sheets.load_transcript")
+    def load_transcript(self, user_id, project_id, after=0, strict=False, latest=None):
+        """連番が after より大きい追記分を [(連番, 追記日時, テキスト)...] の連番順で返す。
+        latest は ReplicatedStore と呼び方を揃えるための引数で、ここでは使わない"""
+        key = f"{user_id}/{project_id}"
+        try:
+            rows = self._read_keyed_rows(TRANSCRIPT_SHEET, TRANSCRIPT_HEADERS, key, after)
+        except Exception as e:
+            if strict: raise
+            st.warning(f"ログの読み込みエラー: {e}")
+            return []
+        segments = {}
+        for r in rows:
+            r = r + [""] * 3
+            try:
+                seq = int(r[0])
+                overflow = self._read_overflow(f"{key}/{seq}") if _has_overflow(r[2]) else ()
+                segments[seq] = (seq, r[1], unpack_cell(r[2], overflow))
+            except (ValueError, zlib.error):
+                continue  # 壊れた行は飛ばす（再送で重複した行は連番で1つにまとまる）
+        return [segments[seq] for seq in sorted(segments)]
+
+    @instrumented("sheets.get_project_index")
+    def get_project_index(self, user_id, strict=False):
+        """ログイン時用の軽量な一覧。A列（project_id）と G列（updated_at）だけを読み、
+        {project_id: updated_at} をシートの並び順で返す"""
+        def read(ws):
+            return ws.batch_get(["A2:A", "G2:G"])
+        try:
+            columns = self._with_worksheet(user_id, PROJECT_HEADERS, read)
+            if columns is None: raise RuntimeError("シートを開けません")
+            return self._index_from_columns(user_id, *columns)
+        except Exception as e:
+            if strict: raise
+            st.warning(f"データ読み込みエラー: {e}")
+        return {}
+
+    def _index_from_columns(self, user_id, ids, dates):
+        """A列・G列の値（行ごとのリスト）から一覧を作り、行番号索引も更新する"""
+        ids = [r[0] if r else "" for r in ids]
+        dates = [r[0] if r else "" for r in dates]
+        self.pool.set_row_index(user_id, ids)
+        index = {}
+        for i, pid in enumerate(ids):
+            pid = str(pid)
+            if pid and pid not in index:
+                index[pid] = dates[i] if i < len(dates) else ""
+        return index
+
+    @instrumented("sheets.get_login_data")
+    def get_login_data(self, user_id, strict=False):
+        """ログイン時の ((api_key, last_project_id), {project_id: updated_at}) を1回の values_batch_get で読む。
+        シートがまだ無いなどでまとめて読めないときは、get_user_config と get_project_index で別々に読む"""
+        title = user_id.replace("'", "''")
+        try:
+            response = self._spreadsheet().values_batch_get(["config!A2:C", f"'{title}'!A2:A", f"'{title}'!G2:G"])
+            config_rows, ids, dates = [r.get("values", []) for r in response["valueRanges"]]
+        except Exception:
+            return self.get_user_config(user_id, strict=strict), self.get_project_index(user_id, strict=strict)
+        self.pool.set_row_index("config", [r[0] if r else "" for r in config_rows])
+        row = next((r for r in config_rows if r and str(r[0]) == user_id), [])
+        config = tuple(str(v) for v in (row[1:3] + [""] * 2)[:2])
+        with self.pool.lock:
+            self.pool.user_configs[user_id] = config
+        return config, self._index_from_columns(user_id, ids, dates)
+
+    @instrumented("sheets.get_project")
+    def get_project(self, user_id, project_id, strict=False):
+        """1プロジェクト分の行だけを読んで返す。行が無ければ None"""
+        def read(ws):
+            row = self._find_row(ws, user_id, project_id)
+            if row is None: return None
+            values = ws.row_values(row)
+            return dict(zip(PROJECT_HEADERS, values + [""] * (len(PROJECT_HEADERS) - len(values))))
+        try:
+            r = self._with_worksheet(user_id, PROJECT_HEADERS, read)
+            if r is None: return None
+            return self._parse_project(user_id, project_id, r, self._read_overflow)
         except Exception as e:
+            if strict: raise
             st.warning(f"データ読み込みエラー: {e}")
-        return projects
+            return None
 
-    def save_project(self, user_id, project_id, data):
-        headers = ["project_id", "confirmed", "pending", "memo", "transcript", "json_data", "updated_at", "strategy"]
-        ws = self._get_or_create_worksheet(user_id, headers)
-        if not ws: return
+    @instrumented("sheets.save_project", measure_result=False)
+    def save_project(self, user_id, project_id, data, fields=None, updated_at=None):
+        """fields（項目名の集合）を渡すと、既存行はその項目の列と updated_at だけを書き換える。
+        updated_at を渡すとその値を書く（複製元と同じ時刻にして突き合わせられるようにする）。
+        保存に失敗した場合はエラーメッセージを返す（裏スレッドからも呼ばれるため st.error は使わない）"""
+        updated_at = updated_at or datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+        def build(columns):
+            cells = _project_cells(project_id, data, columns, updated_at)
+            version = uuid.uuid4().hex[:8]
+            for col in PACKED_COLUMNS:
+                if col in cells:
+                    # 続きのチャンクは本体より先に、書き込みごとに別のキーで書く。
+                    # 本体の書き込みが失敗しても、古い本体は古いチャンクを指したままになる
+                    cells[col], chunks = pack_cell(cells[col], version)
+                    if chunks: self._save_overflow(_overflow_key(f"{user_id}/{project_id}/{col}", cells[col]), chunks)
+            telemetry.annotate(bytes_out=_approx_bytes(list(cells.values())), columns="".join(cells))
+            return cells
+
+        def write(ws):
+            row = self._find_row(ws, user_id, project_id, for_write=True)
+            if row is None:
+                cells = build("ABCDEFGH")
+                self._append_keyed_row(ws, user_id, list(cells.values()))
+            elif fields is None:
+                cells = build("ABCDEFGH")
+                ws.update(range_name=f"A{row}:H{row}", values=[list(cells.values())])
+            else:
+                cells = build({FIELD_COLUMNS[f] for f in fields if f in FIELD_COLUMNS} | {"G"})
+                ws.batch_update([{"range": f"{col}{row}", "values": [[value]]} for col, value in cells.items()])
+            return None
 
-        json_pack = json.dumps({
-            "meeting_history": data["meeting_history"],
-            "chat_history": data["chat_history"],
-            "chat_context": data["chat_context"]
-        }, ensure_ascii=False)
-        
-        updated_at = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        
-        row_data = [
-            project_id, 
-            data["confirmed"], 
-            data["pending"], 
-            data["director_memo"], 
-            data["full_transcript"], 
-            json_pack,
-            updated_at,
-            data.get("strategy", "")
-        ]
-
-        try:
-            cell = ws.find(project_id, in_column=1)
-            range_name = f"A{cell.row}:H{cell.row}"
-            ws.update(range_name, [row_data])
-        except CellNotFound:
-            ws.append_row(row_data)
+        try:
+            return self._with_worksheet(user_id, PROJECT_HEADERS, write, default="シートを開けません")
         except Exception as e:
+            telemetry.annotate(error=type(e).__name__)
             if "400" in str(e) and "50000" in str(e):
-                st.error("⚠️ 保存失敗: データ量が多すぎます。")
+                return "⚠️ 保存失敗: データ量が多すぎます。"
+            return f"保存エラー: {e}"
+
+# --- ローカル保存（SQLite）と Sheets への複製 ---
+class SQLiteStore:
+    """ローカルの SQLite（WAL）。1プロジェクト = 1行で、本文は JSON で data 列に入れる。
+    data が NULL の行は「一覧には載っているが本文は Sheets にしかない」プロジェクト。
+    dirty は Sheets にまだ送っていない項目（"*" は行全体）、version は書き込みごとに増える"""
+
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory: os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS projects (
+                user_id TEXT NOT NULL,
+                project_id TEXT NOT NULL,
+                data TEXT,
+                updated_at TEXT NOT NULL DEFAULT '',
+                dirty TEXT,
+                version INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (user_id, project_id)
+            );
+            CREATE INDEX IF NOT EXISTS projects_dirty ON projects (dirty) WHERE dirty IS NOT NULL;
+            CREATE TABLE IF NOT EXISTS config (
+                user_id TEXT PRIMARY KEY,
+                api_key TEXT NOT NULL DEFAULT '',
+                last_project_id TEXT NOT NULL DEFAULT '',
+                dirty INTEGER NOT NULL DEFAULT 0,
+                version INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE TABLE IF NOT EXISTS archive (
+                user_id TEXT NOT NULL,
+                project_id TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                entry TEXT NOT NULL,
+                dirty INTEGER NOT NULL DEFAULT 1,
+                PRIMARY KEY (user_id, project_id, kind, seq)
+            );
+            CREATE TABLE IF NOT EXISTS transcript (
+                user_id TEXT NOT NULL,
+                project_id TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                at TEXT NOT NULL,
+                text TEXT NOT NULL,
+                dirty INTEGER NOT NULL DEFAULT 1,
+                PRIMARY KEY (user_id, project_id, seq)
+            );
+        """)
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._conn
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    def _query(self, sql, params=()):
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    @staticmethod
+    def _decode_fields(dirty):
+        """dirty 列の値を save_project の fields にする（None は行全体）"""
+        return None if dirty == "*" else set(dirty.split(","))
+
+    def get_user_config(self, user_id):
+        """(api_key, last_project_id)。ローカルに無ければ None"""
+        rows = self._query("SELECT api_key, last_project_id FROM config WHERE user_id = ?", (user_id,))
+        return tuple(rows[0]) if rows else None
+
+    def save_user_config(self, user_id, api_key, last_project_id, dirty=True):
+        with self._transaction() as conn:
+            conn.execute("""
+                INSERT INTO config (user_id, api_key, last_project_id, dirty, version) VALUES (?, ?, ?, ?, 1)
+                ON CONFLICT (user_id) DO UPDATE SET
+                    api_key = excluded.api_key, last_project_id = excluded.last_project_id,
+                    dirty = MAX(config.dirty, excluded.dirty), version = config.version + 1
+            """, (user_id, api_key or "", last_project_id or "", int(dirty)))
+
+    def project_index(self, user_id):
+        """{project_id: updated_at} を追加された順で返す"""
+        rows = self._query("SELECT project_id, updated_at FROM projects WHERE user_id = ? ORDER BY rowid", (user_id,))
+        return {pid: updated_at for pid, updated_at in rows}
+
+    def load_project(self, user_id, project_id):
+        """本文の dict。行が無いか本文がまだ無ければ None"""
+        rows = self._query("SELECT data FROM projects WHERE user_id = ? AND project_id = ?", (user_id, project_id))
+        if not rows or rows[0][0] is None: return None
+        return json.loads(rows[0][0])
+
+    def save_project(self, user_id, project_id, data, fields, updated_at):
+        """変更を書き込み、Sheets に送る項目を dirty に合算する。
+        Sheets にある（reconcile で本文なしで置いた）行を、読み込んでいない本文で丸ごと上書きしようとした場合は
+        書き込まずにエラーメッセージを返す"""
+        body = json.dumps({k: v for k, v in data.items() if not k.startswith("_")}, ensure_ascii=False)
+        with self._transaction() as conn:
+            row = conn.execute("SELECT data, dirty FROM projects WHERE user_id = ? AND project_id = ?",
+                               (user_id, project_id)).fetchone()
+            if row is None:
+                fields = None  # Sheets 側にもまだ無いので行全体を送る
+            elif row[0] is None:
+                # 本文を捨てた後の変更は、読み込み済みの本文に対する項目単位のものだけ受け付ける
+                if fields is None: return f"保存エラー: 「{project_id}」の本文を読み込む前に上書きしようとしました"
+            elif row[1] is not None:
+                fields = _merge_fields(self._decode_fields(row[1]), fields)
+            dirty = "*" if fields is None else ",".join(sorted(fields))
+            conn.execute("""
+                INSERT INTO projects (user_id, project_id, data, updated_at, dirty, version) VALUES (?, ?, ?, ?, ?, 1)
+                ON CONFLICT (user_id, project_id) DO UPDATE SET
+                    data = excluded.data, updated_at = excluded.updated_at, dirty = excluded.dirty,
+                    version = projects.version + 1
+            """, (user_id, project_id, body, updated_at, dirty))
+
+    def put_remote_project(self, user_id, project_id, data):
+        """Sheets から読んだ本文を置く。未複製の変更がある行は上書きしない"""
+        body = json.dumps({k: v for k, v in data.items() if not k.startswith("_")}, ensure_ascii=False)
+        with self._transaction() as conn:
+            conn.execute("""
+                INSERT INTO projects (user_id, project_id, data) VALUES (?, ?, ?)
+                ON CONFLICT (user_id, project_id) DO UPDATE SET data = excluded.data
+                WHERE projects.dirty IS NULL
+            """, (user_id, project_id, body))
+
+    def reconcile(self, user_id, remote_index):
+        """Sheets の一覧 {project_id: updated_at} と突き合わせる。
+        ローカルに無いものは本文なしで追加し、Sheets の方が新しい（かつ未複製の変更が無い）ものは本文を捨てて読み直させる"""
+        with self._transaction() as conn:
+            conn.executemany("""
+                INSERT INTO projects (user_id, project_id, updated_at) VALUES (?, ?, ?)
+                ON CONFLICT (user_id, project_id) DO UPDATE SET data = NULL, updated_at = excluded.updated_at
+                WHERE projects.dirty IS NULL AND excluded.updated_at > projects.updated_at
+            """, [(user_id, pid, updated_at or "") for pid, updated_at in remote_index.items()])
+
+    def archive_entries(self, user_id, project_id, kind, entries, dirty=True):
+        """退避した履歴 [(連番, dict)...] を書き込む（同じ連番は上書きしない）"""
+        with self._transaction() as conn:
+            conn.executemany("""
+                INSERT OR IGNORE INTO archive (user_id, project_id, kind, seq, entry, dirty) VALUES (?, ?, ?, ?, ?, ?)
+            """, [(user_id, project_id, kind, seq, json.dumps(entry, ensure_ascii=False), int(dirty))
+                  for seq, entry in entries])
+
+    def load_archive(self, user_id, project_id, kind):
+        rows = self._query("SELECT seq, entry FROM archive WHERE user_id = ? AND project_id = ? AND kind = ? ORDER BY seq",
+                           (user_id, project_id, kind))
+        return [(seq, json.loads(entry)) for seq, entry in rows]
+
+    def dirty_archives(self):
+        """未複製の退避履歴を {(user_id, project_id, kind): [(連番, dict)...]} で返す"""
+        rows = self._query("SELECT user_id, project_id, kind, seq, entry FROM archive WHERE dirty = 1 ORDER BY seq")
+        groups = {}
+        for user_id, project_id, kind, seq, entry in rows:
+            groups.setdefault((user_id, project_id, kind), []).append((seq, json.loads(entry)))
+        return groups
+
+    def mark_archive_synced(self, user_id, project_id, kind, seqs):
+        with self._transaction() as conn:
+            conn.executemany("UPDATE archive SET dirty = 0 WHERE user_id = ? AND project_id = ? AND kind = ? AND seq = ?",
+                             [(user_id, project_id, kind, seq) for seq in seqs])
+
+    def append_transcript(self, user_id, project_id, segments, dirty=True):
+        """会議ログの追記分 [(連番, 追記日時, テキスト)...] を書き込む（同じ連番は上書きしない）"""
+        with self._transaction() as conn:
+            conn.executemany("""
+                INSERT OR IGNORE INTO transcript (user_id, project_id, seq, at, text, dirty) VALUES (?, ?, ?, ?, ?, ?)
+            """, [(user_id, project_id, seq, at, text, int(dirty)) for seq, at, text in segments])
+
+    def load_transcript(self, user_id, project_id, after=0):
+        rows = self._query("SELECT seq, at, text FROM transcript WHERE user_id = ? AND project_id = ? AND seq > ? ORDER BY seq",
+                           (user_id, project_id, after))
+        return [tuple(r) for r in rows]
+
+    def last_transcript_seq(self, user_id, project_id):
+        """ローカルにある追記分の最大の連番（無ければ 0）"""
+        rows = self._query("SELECT MAX(seq) FROM transcript WHERE user_id = ? AND project_id = ?", (user_id, project_id))
+        return rows[0][0] or 0
+
+    def dirty_transcripts(self):
+        """未複製の追記分を {(user_id, project_id): [(連番, 追記日時, テキスト)...]} で返す"""
+        rows = self._query("SELECT user_id, project_id, seq, at, text FROM transcript WHERE dirty = 1 ORDER BY seq")
+        groups = {}
+        for user_id, project_id, seq, at, text in rows:
+            groups.setdefault((user_id, project_id), []).append((seq, at, text))
+        return groups
+
+    def mark_transcript_synced(self, user_id, project_id, seqs):
+        with self._transaction() as conn:
+            conn.executemany("UPDATE transcript SET dirty = 0 WHERE user_id = ? AND project_id = ? AND seq = ?",
+                             [(user_id, project_id, seq) for seq in seqs])
+
+    def dirty_configs(self):
+        return self._query("SELECT user_id, api_key, last_project_id, version FROM config WHERE dirty = 1")
+
+    def dirty_projects(self):
+        rows = self._query("""
+            SELECT user_id, project_id, data, updated_at, dirty, version FROM projects
+            WHERE dirty IS NOT NULL ORDER BY rowid
+        """)
+        return [(user_id, pid, json.loads(data), updated_at, self._decode_fields(dirty), version)
+                for user_id, pid, data, updated_at, dirty, version in rows]
+
+    def mark_config_synced(self, user_id, version):
+        """送った後に書き換えられていなければ複製済みにする"""
+        with self._transaction() as conn:
+            conn.execute("UPDATE config SET dirty = 0 WHERE user_id = ? AND version = ?", (user_id, version))
+
+    def mark_project_synced(self, user_id, project_id, version):
+        with self._transaction() as conn:
+            conn.execute("UPDATE projects SET dirty = NULL WHERE user_id = ? AND project_id = ? AND version = ?",
+                         (user_id, project_id, version))
+
+    def pending_count(self, user_id):
+        rows = self._query("""
+            SELECT (SELECT COUNT(*) FROM projects WHERE user_id = ? AND dirty IS NOT NULL)
+                 + (SELECT COUNT(*) FROM config WHERE user_id = ? AND dirty = 1)
+                 + (SELECT COUNT(DISTINCT project_id || '/' || kind) FROM archive WHERE user_id = ? AND dirty = 1)
+                 + (SELECT COUNT(DISTINCT project_id) FROM transcript WHERE user_id = ? AND dirty = 1)
+        """, (user_id, user_id, user_id, user_id))
+        return rows[0][0]
+
+class ReplicatedStore:
+    """SQLiteStore を主、SpreadsheetDB を非同期の複製にした保存先（SpreadsheetDB と同じメソッドを持つ）。
+    読み書きはローカルで完結し、変更は裏スレッドが Sheets に送る。Sheets が遅い・制限中でもローカルで動き続ける。
+    ログイン時は Sheets の updated_at と突き合わせ、他の環境で更新されたプロジェクトは開くときに読み直す"""
+
+    def __init__(self, local, remote, delay, read_timeout):
+        self.local = local
+        self.remote = remote
+        self.delay = delay
+        self.read_timeout = read_timeout
+        self._reader = ThreadPoolExecutor(max_workers=2, thread_name_prefix="sheets-read")
+        self._sync_lock = threading.Lock()  # 裏スレッドと flush が同時に送らないようにする
+        self._wakeup = threading.Event()
+        self._status = {}  # user_id -> {"synced_at", "error"}
+        self._backoff = 0.0
+        self._worker = threading.Thread(target=self._run, name="sheets-replica", daemon=True)
+        self._worker.start()
+        self._wakeup.set()  # 前回の終了時に送り残した変更があれば送る
+        atexit.register(self.flush)
+
+    @instrumented("local.get_user_config")
+    def get_user_config(self, user_id):
+        config = self.local.get_user_config(user_id)
+        if config is not None:
+            return config
+        try:
+            config = self.remote.get_user_config(user_id, strict=True)
+        except Exception as e:
+            st.warning(f"設定の読み込みエラー: {e}")
+            return "", ""
+        if None not in config:
+            self.local.save_user_config(user_id, *config, dirty=False)
+        return config
+
+    @instrumented("local.save_user_config", measure_result=False)
+    def save_user_config(self, user_id, api_key, last_project_id):
+        try:
+            self.local.save_user_config(user_id, api_key, last_project_id)
+        except sqlite3.Error as e:
+            return f"設定保存エラー: {e}"
+        self._wakeup.set()
+        return None
+
+    @instrumented("local.get_project_index")
+    def get_project_index(self, user_id, strict=False):
+        """Sheets の一覧と突き合わせてからローカルの一覧を返す。
+        ローカルにデータがあるユーザーは read_timeout 秒で待つのをやめ、突き合わせは裏で続ける。
+        ローカルにデータが無く Sheets も読めないとき、strict=True なら空の一覧を返さずに例外を投げる"""
+        has_local = bool(self.local.project_index(user_id))
+        future = self._reader.submit(telemetry.wrap(self._reconcile), user_id)
+        try:
+            future.result(timeout=self.read_timeout if has_local else None)
+        except FutureTimeoutError:
+            st.toast("⏳ Sheets の応答が遅いため、ローカルのデータで開きました")
+        except Exception as e:
+            if has_local:
+                st.toast(f"⚠️ Sheets に接続できないため、ローカルのデータで開きました ({e})")
+            elif strict:
+                raise
+            else:
+                st.warning(f"データ読み込みエラー: {e}")
+        return self.local.project_index(user_id)
+
+    @instrumented("local.get_login_data")
+    def get_login_data(self, user_id, strict=False):
+        """ログイン時の設定と一覧。設定がローカルに無い（初回）ときは、Sheets の設定と一覧を並行して読む"""
+        if self.local.get_user_config(user_id) is not None:
+            return self.get_user_config(user_id), self.get_project_index(user_id, strict=strict)
+        future = self._reader.submit(telemetry.wrap(self.get_user_config), user_id)
+        index = self.get_project_index(user_id, strict=strict)
+        return future.result(), index
+
+    def _reconcile(self, user_id):
+        self.local.reconcile(user_id, self.remote.get_project_index(user_id, strict=True))
+
+    @instrumented("local.get_project")
+    def get_project(self, user_id, project_id, strict=False):
+        data = self.local.load_project(user_id, project_id)
+        if data is not None:
+            data["_dirty"] = set()
+            return data
+        # ローカルに本文が無い（初回・他の環境で更新された）ときだけ Sheets から読む
+        try:
+            proj = self.remote.get_project(user_id, project_id, strict=True)
+        except Exception as e:
+            if strict: raise
+            st.warning(f"データ読み込みエラー: {e}")
+            return None
+        if proj is not None:
+            self.local.put_remote_project(user_id, project_id, proj)
+        return proj
+
+    @instrumented("local.save_project", measure_result=False)
+    def save_project(self, user_id, project_id, data, fields=None):
+        updated_at = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        try:
+            error = self.local.save_project(user_id, project_id, data, fields, updated_at)
+        except sqlite3.Error as e:
+            return f"保存エラー: {e}"
+        if error: return error
+        self._wakeup.set()
+        return None
+
+    @instrumented("local.archive_entries", measure_result=False)
+    def archive_entries(self, user_id, project_id, kind, entries):
+        try:
+            self.local.archive_entries(user_id, project_id, kind, entries)
+        except sqlite3.Error as e:
+            return f"履歴の退避エラー: {e}"
+        self._wakeup.set()
+        return None
+
+    @instrumented("local.load_archive")
+    def load_archive(self, user_id, project_id, kind):
+        """ローカルに無ければ（他の環境で退避された場合など）Sheets から読んで置いておく"""
+        entries = self.local.load_archive(user_id, project_id, kind)
+        if entries: return entries
+        try:
+            entries = self.remote.load_archive(user_id, project_id, kind, strict=True)
+        except Exception as e:
+            st.warning(f"履歴の読み込みエラー: {e}")
+            return []
+        if entries: self.local.archive_entries(user_id, project_id, kind, entries, dirty=False)
+        return entries
+
+    @instrumented("local.append_transcript", measure_result=False)
+    def append_transcript(self, user_id, project_id, segments):
+        try:
+            self.local.append_transcript(user_id, project_id, segments)
+        except sqlite3.Error as e:
+            return f"ログの保存エラー: {e}"
+        self._wakeup.set()
+        return None
+
+    @instrumented("local.load_transcript")
+    def load_transcript(self, user_id, project_id, after=0, latest=None):
+        """latest（本文の transcript_seq）がローカルの最大の連番より新しいとき（他の環境で追記された場合など）だけ
+        Sheets から読んで置いておく。latest が分からない（None）ときはローカルに1件も無い場合に読む"""
+        local_seq = self.local.last_transcript_seq(user_id, project_id)
+        behind = not local_seq if latest is None else latest > local_seq
+        if not behind:
+            return self.local.load_transcript(user_id, project_id, after)
+        try:
+            segments = self.remote.load_transcript(user_id, project_id, after=after, strict=True)
+        except Exception as e:
+            st.warning(f"ログの読み込みエラー: {e}")
+            return self.local.load_transcript(user_id, project_id, after)
+        if segments: self.local.append_transcript(user_id, project_id, segments, dirty=False)
+        return self.local.load_transcript(user_id, project_id, after)
+
+    def _replicate_once(self):
+        """未複製の変更を Sheets に送る。失敗した行は残して次回に回し、最後のエラーメッセージを返す"""
+        last_error = None
+        # ログの追記分と退避した履歴は、それを前提にした本文より先に送る
+        for (user_id, project_id), segments in self.local.dirty_transcripts().items():
+            error = self.remote.append_transcript(user_id, project_id, segments)
+            if not error: self.local.mark_transcript_synced(user_id, project_id, [seq for seq, _, _ in segments])
+            last_error = self._set_status(user_id, error) or last_error
+        for (user_id, project_id, kind), entries in self.local.dirty_archives().items():
+            error = self.remote.archive_entries(user_id, project_id, kind, entries)
+            if not error: self.local.mark_archive_synced(user_id, project_id, kind, [seq for seq, _ in entries])
+            last_error = self._set_status(user_id, error) or last_error
+        for user_id, api_key, last_project_id, version in self.local.dirty_configs():
+            error = self.remote.save_user_config(user_id, api_key, last_project_id)
+            if not error: self.local.mark_config_synced(user_id, version)
+            last_error = self._set_status(user_id, error) or last_error
+        for user_id, project_id, data, updated_at, fields, version in self.local.dirty_projects():
+            error = self.remote.save_project(user_id, project_id, data, fields, updated_at=updated_at)
+            if not error: self.local.mark_project_synced(user_id, project_id, version)
+            last_error = self._set_status(user_id, error) or last_error
+        return last_error
+
+    def _set_status(self, user_id, error):
+        status = self._status.setdefault(user_id, {"synced_at": None, "error": None})
+        status["error"] = error
+        if not error:
+            status["synced_at"] = datetime.datetime.now()
+        return error
+
+    def _run(self):
+        rate_limiter.mark_background()
+        retry_at = 0.0
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            # 続けて来る変更をまとめる。失敗の後はバックオフが明けるまで送らない
+            time.sleep(max(self.delay, retry_at - time.monotonic()))
+            try:
+                with self._sync_lock:
+                    error = self._replicate_once()
+            except Exception as e:
+                error = str(e)
+            if error:
+                self._backoff = min(REPLICA_MAX_BACKOFF_SEC, max(self.delay, self._backoff * 2))
+                retry_at = time.monotonic() + self._backoff
+                self._wakeup.set()
             else:
-                st.error(f"保存エラー: {e}")
+                self._backoff = 0.0
 
-db = SpreadsheetDB()
+    def flush(self, timeout=30):
+        """未複製の変更を今すぐ送る。送り切れなかった場合は False"""
+        if not self._sync_lock.acquire(timeout=timeout):
+            return False
+        try:
+            return self._replicate_once() is None
+        except Exception:
+            return False
+        finally:
+            self._sync_lock.release()
+
+    def status(self, user_id):
+        status = self._status.get(user_id, {"synced_at": None, "error": None})
+        return {"pending": self.local.pending_count(user_id), **status}
+
+@st.cache_resource
+def get_store():
+    """STORAGE_BACKEND に応じた保存先（全セッションで共有）"""
+    if STORAGE_BACKEND == "sheets":
+        return SpreadsheetDB()
+    return ReplicatedStore(SQLiteStore(LOCAL_DB_PATH), SpreadsheetDB(), REPLICA_DELAY_SEC, REMOTE_READ_TIMEOUT_SEC)
+
+class SaveQueue:
+    """auto_save の書き込みを裏スレッドで行うライトビハインドキュー。
+    同じプロジェクトへの連続保存は window 秒以内なら1回の書き込みにまとめる。"""
+    MAX_RETRY = 3
+
+    def __init__(self, window):
+        self.window = window
+        self.max_delay = window * 5  # 編集が続いてもこの秒数以内には必ず書き込む
+        self._cond = threading.Condition()
+        self._pending = {}   # (user_id, kind, key) -> job
+        self._inflight = {}  # user_id -> 書き込み中の件数
+        self._status = {}    # user_id -> {"saved_at", "error"}
+        self._force_full = set()  # 差分保存に失敗したキー（次回は行全体を書き込む）
+        self._worker = threading.Thread(target=self._run, name="save-queue", daemon=True)
+        self._worker.start()
+        atexit.register(self.flush)
+
+    def submit_project(self, db, user_id, project_id, data, fields=None):
+        """fields は変更された項目の集合。None なら行全体を書き込む"""
+        # "_" で始まるキー（_dirty・組み立て済みの全ログ）は画面側の状態なので保存しない
+        data = copy.deepcopy({k: v for k, v in data.items() if not k.startswith("_")})
+        key = (user_id, "project", project_id)
+        with self._cond:
+            if key in self._force_full:
+                self._force_full.discard(key)
+                fields = None
+            self._submit(key, telemetry.wrap(db.save_project), (user_id, project_id, data), {"fields": fields})
+
+    def submit_config(self, db, user_id, api_key, last_project_id):
+        self._submit((user_id, "config", user_id), telemetry.wrap(db.save_user_config), (user_id, api_key, last_project_id))
+
+    def _submit(self, key, fn, args, kwargs=None, attempt=0):
+        """新しいデータで保留中の書き込みを置き換える（差分保存の対象項目は合算する）"""
+        now = time.monotonic()
+        kwargs = dict(kwargs or {})
+        with self._cond:
+            job = self._pending.get(key)
+            first = job["first"] if job else now
+            if job and "fields" in kwargs:
+                kwargs["fields"] = _merge_fields(job["kwargs"].get("fields"), kwargs["fields"])
+            self._pending[key] = {
+                "fn": fn, "args": args, "kwargs": kwargs, "attempt": attempt, "first": first,
+                "due": min(now + self.window, first + self.max_delay),
+            }
+            self._cond.notify_all()
+
+    def _requeue(self, key, job):
+        """失敗した書き込みを再送する。新しい保存が既に来ていれば、失敗分の項目だけそちらに合算する"""
+        with self._cond:
+            pending = self._pending.get(key)
+            if pending:
+                if "fields" in job["kwargs"]:
+                    pending["kwargs"]["fields"] = _merge_fields(pending["kwargs"].get("fields"), job["kwargs"]["fields"])
+            elif job["attempt"] + 1 < self.MAX_RETRY:
+                self._submit(key, job["fn"], job["args"], job["kwargs"], attempt=job["attempt"] + 1)
+            elif "fields" in job["kwargs"]:
+                self._force_full.add(key)
+
+    def _has_work(self, user_id):
+        if any(user_id is None or k[0] == user_id for k in self._pending):
+            return True
+        if user_id is None:
+            return any(self._inflight.values())
+        return self._inflight.get(user_id, 0) > 0
+
+    def _run(self):
+        rate_limiter.mark_background()
+        while True:
+            with self._cond:
+                while True:
+                    now = time.monotonic()
+                    due = [k for k, j in self._pending.items() if j["due"] <= now]
+                    if due: break
+                    next_due = min((j["due"] for j in self._pending.values()), default=now + 60)
+                    self._cond.wait(next_due - now)
+                jobs = [(k, self._pending.pop(k)) for k in due]
+                for k, _ in jobs:
+                    self._inflight[k[0]] = self._inflight.get(k[0], 0) + 1
+
+            for key, job in jobs:
+                try:
+                    error = job["fn"](*job["args"], **job["kwargs"])
+                except Exception as e:
+                    error = str(e)
+                if error:
+                    self._requeue(key, job)
+                with self._cond:
+                    user_id = key[0]
+                    self._inflight[user_id] -= 1
+                    status = self._status.setdefault(user_id, {"saved_at": None, "error": None})
+                    if error:
+                        status["error"] = error
+                    else:
+                        status["saved_at"] = datetime.datetime.now()
+                        status["error"] = None
+                    self._cond.notify_all()
+
+    def flush(self, user_id=None, timeout=30):
+        """保留中の書き込みをすぐに実行し、完了まで待つ。タイムアウトした場合は False"""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            for key, job in self._pending.items():
+                if user_id is None or key[0] == user_id:
+                    job["due"] = 0
+            self._cond.notify_all()
+            while self._has_work(user_id):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0: return False
+                self._cond.wait(remaining)
+        return True
+
+    def status(self, user_id):
+        with self._cond:
+            pending = sum(1 for k in self._pending if k[0] == user_id) + self._inflight.get(user_id, 0)
+            status = self._status.get(user_id, {"saved_at": None, "error": None})
+            return {"pending": pending, **status}
+
+@st.cache_resource
+def get_save_queue():
+    return SaveQueue(SAVE_DEBOUNCE_SEC)
+
+# --- AI応答キャッシュ ---
+class ResponseCache:
+    """generate_with_model の応答キャッシュ。
+    キーは (モデル名, プロンプト, 安全設定) のハッシュ。メモリとディスクの2段で、TTL と件数上限（LRU）を持つ"""
+
+    def __init__(self, directory, ttl, memory_items, disk_items):
+        self.directory = directory
+        self.ttl = ttl
+        self.memory_items = memory_items
+        self.disk_items = disk_items
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()  # key -> (作成時刻, テキスト)
+        self.stats = {"hits": 0, "disk_hits": 0, "misses": 0}
+
+    @staticmethod
+    def make_key(model_name, prompt, settings):
+        settings = sorted((str(k), str(v)) for k, v in settings.items())
+        payload = json.dumps([model_name, prompt, settings], ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def _remember(self, key, entry):
+        self._memory[key] = entry
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_items:
+            self._memory.popitem(last=False)
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry and now - entry[0] <= self.ttl:
+                self._memory.move_to_end(key)
+                self.stats["hits"] += 1
+                return entry[1]
+            self._memory.pop(key, None)
+
+        path = self._path(key)
+        try:
+            with open(path, encoding="utf-8") as f:
+                stored = json.load(f)
+            if now - stored["created_at"] <= self.ttl:
+                os.utime(path)  # LRU 用に最終利用時刻を更新
+                with self._lock:
+                    self._remember(key, (stored["created_at"], stored["text"]))
+                    self.stats["hits"] += 1
+                    self.stats["disk_hits"] += 1
+                return stored["text"]
+            os.remove(path)
+        except (OSError, ValueError, KeyError):
+            pass
+        with self._lock:
+            self.stats["misses"] += 1
+        return None
+
+    def put(self, key, text):
+        created_at = time.time()
+        with self._lock:
+            self._remember(key, (created_at, text))
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            tmp_path = f"{self._path(key)}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"created_at": created_at, "text": text}, f, ensure_ascii=False)
+            os.replace(tmp_path, self._path(key))
+            self._prune_disk()
+        except OSError:
+            pass
+
+    def _prune_disk(self):
+        files = [os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith(".json")]
+        if len(files) <= self.disk_items: return
+        files.sort(key=os.path.getmtime)
+        for path in files[:len(files) - self.disk_items]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+@st.cache_resource
+def get_response_cache():
+    return ResponseCache(LLM_CACHE_DIR, LLM_CACHE_TTL_SEC, LLM_CACHE_MEMORY_ITEMS, LLM_CACHE_DISK_ITEMS)
+
+# --- コンテキストキャッシュ ---
+# ContextCache はログイン前の run で作られ、その run の名前空間を参照し続けるので st.stop() より前に定義する
+def estimate_tokens(text):
+    """トークン数の概算（英数字は4文字で1、日本語は1文字で1トークン程度）"""
+    ascii_chars = sum(1 for c in text if c < "\x80")
+    return ascii_chars // 4 + (len(text) - ascii_chars)
+
+class GeminiContextBackend:
+    """google.generativeai.caching を使う本番用のバックエンド"""
+
+    def create(self, model_name, context, ttl_sec):
+        from google.generativeai import caching
+        name = model_name if model_name.startswith("models/") else f"models/{model_name}"
+        return caching.CachedContent.create(model=name, contents=[context], ttl=datetime.timedelta(seconds=ttl_sec))
+
+    def model(self, handle):
+        import google.generativeai as genai
+        return genai.GenerativeModel.from_cached_content(cached_content=handle)
+
+    def delete(self, handle):
+        handle.delete()
+
+class ContextCache:
+    """プロンプトの共通プレフィックス（プロジェクト情報）をキャッシュ済みコンテンツとして使い回す。
+    プレフィックスが変わったときだけ作り直し、作れない場合（短すぎる・未対応モデルなど）は None を返して
+    呼び出し側でプロンプトに直接連結させる。backend は create / model / delete を持つ任意の実装に差し替えられる"""
+    RETRY_AFTER_SEC = 600
+
+    def __init__(self, backend, ttl_sec, min_tokens, max_entries):
+        self.backend = backend
+        self.ttl_sec = ttl_sec
+        self.min_tokens = min_tokens
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # (モデル名, プレフィックスのハッシュ) -> (handle, 有効期限)
+        self._failed = {}              # 作成に失敗したキー -> 再試行してよい時刻
+        self._creating = {}            # キー -> 作成中の Lock（同じキャッシュを二重に作らない）
+        self.stats = {"hits": 0, "created": 0, "fallbacks": 0}
+
+    @staticmethod
+    def _key(model_name, context):
+        return model_name, hashlib.sha256(context.encode("utf-8")).hexdigest()
+
+    def model_for(self, model_name, context):
+        """キャッシュ済みコンテンツに紐づいたモデルを返す。使えない場合は None"""
+        if estimate_tokens(context) < self.min_tokens:
+            return None
+        key = self._key(model_name, context)
+        with self._lock:
+            creating = self._creating.setdefault(key, threading.Lock())
+        try:
+            with creating:
+                now = time.time()
+                with self._lock:
+                    entry = self._entries.get(key)
+                    if entry and entry[1] - now > 60:
+                        self._entries.move_to_end(key)
+                        self.stats["hits"] += 1
+                        return self.backend.model(entry[0])
+                    if self._failed.get(key, 0) > now:
+                        self.stats["fallbacks"] += 1
+                        return None
+                try:
+                    with telemetry.span("gemini.cache_create", model=model_name):
+                        handle = self.backend.create(model_name, context, self.ttl_sec)
+                except Exception:
+                    with self._lock:
+                        self._failed[key] = now + self.RETRY_AFTER_SEC
+                        self.stats["fallbacks"] += 1
+                    return None
+                evicted = []
+                with self._lock:
+                    self._entries[key] = (handle, now + self.ttl_sec)
+                    self.stats["created"] += 1
+                    while len(self._entries) > self.max_entries:
+                        evicted.append(self._entries.popitem(last=False)[1][0])
+                for old in evicted:
+                    try:
+                        self.backend.delete(old)
+                    except Exception:
+                        pass
+                return self.backend.model(handle)
+        finally:
+            # ヒット・失敗のときも外す（残すとキーの種類だけ増え続ける）。外した後に来たスレッドは
+            # 新しい Lock を使うが、作成済みのエントリか失敗の記録を見て返るので二重には作らない
+            with self._lock:
+                if self._creating.get(key) is creating:
+                    self._creating.pop(key, None)
+
+    def invalidate(self, model_name, context):
+        """サーバー側で期限切れになっていた場合などに呼ぶ"""
+        with self._lock:
+            self._entries.pop(self._key(model_name, context), None)
+
+@st.cache_resource
+def get_context_cache():
+    return ContextCache(GeminiContextBackend(), CONTEXT_CACHE_TTL_SEC, CONTEXT_CACHE_MIN_TOKENS, CONTEXT_CACHE_MAX_ENTRIES)
+
+@st.cache_resource
+def get_llm_executor():
+    return ThreadPoolExecutor(max_workers=LLM_MAX_CONCURRENCY, thread_name_prefix="llm")
+
+@st.cache_resource
+def get_hedge_executor():
+    """ヘッジ付きの生成で各モデルへの依頼を並べて走らせるスレッド（get_llm_executor の中からも使うので別にする）"""
+    return ThreadPoolExecutor(max_workers=LLM_MAX_CONCURRENCY * 2, thread_name_prefix="llm-hedge")
+
+# --- モデルのレイテンシとヘッジ ---
+class ModelRouter:
+    """モデルごとの直近のレイテンシを記録し、ヘッジ（別モデルへの同じ依頼）をいつ投げるかを決める"""
+
+    def __init__(self, hedge_after, window_sec, min_samples):
+        self.hedge_after = hedge_after
+        self.window_sec = window_sec
+        self.min_samples = min_samples
+        self._lock = threading.Lock()
+        self._samples = {}  # model -> deque[(時刻, 秒数)]
+
+    def record(self, model_name, seconds):
+        """1回分の所要時間を記録する（打ち切った・失敗した呼び出しはそこまでの時間を下限として入れる）"""
+        now = time.time()
+        with self._lock:
+            samples = self._samples.setdefault(model_name, deque())
+            samples.append((now, seconds))
+            while samples and samples[0][0] < now - self.window_sec:
+                samples.popleft()
+
+    def percentile(self, model_name, q):
+        """直近 window_sec 秒の q 分位点（秒）。件数が足りなければ None"""
+        cutoff = time.time() - self.window_sec
+        with self._lock:
+            values = sorted(s for t, s in self._samples.get(model_name, ()) if t >= cutoff)
+        if len(values) < self.min_samples: return None
+        return values[min(len(values) - 1, int(len(values) * q))]
+
+    def hedge_delay(self, model_name, hedge_model):
+        """hedge_model に投げるまでの秒数。ヘッジしない場合は None。
+        model_name が最近ずっと遅い（中央値が閾値以上）なら最初から両方に投げる"""
+        if not hedge_model or hedge_model == model_name or self.hedge_after <= 0:
+            return None
+        p50 = self.percentile(model_name, 0.5)
+        return 0.0 if p50 is not None and p50 >= self.hedge_after else self.hedge_after
+
+    def stats(self):
+        """{モデル: (件数, p50, p95)}"""
+        with self._lock:
+            models = list(self._samples)
+        cutoff = time.time() - self.window_sec
+        result = {}
+        for model_name in models:
+            with self._lock:
+                count = sum(1 for t, _ in self._samples[model_name] if t >= cutoff)
+            if count:
+                result[model_name] = (count, self.percentile(model_name, 0.5), self.percentile(model_name, 0.95))
+        return result
+
+# --- 全ログ・履歴の検索 ---
+def _bigrams(text):
+    """検索用の語（文字 bigram）。分かち書きが要らないので日本語でもそのまま引ける。記号・空白で区切り、1文字の語はそのまま使う"""
+    grams = []
+    for run in re.split(r"[\W_]+", unicodedata.normalize("NFKC", text).lower()):
+        if len(run) == 1: grams.append(run)
+        grams.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return grams
+
+class PassageIndex:
+    """1プロジェクト分のパッセージの BM25 索引。パッセージはキーで管理し、sync で増えた・変わった分だけ索引し直す"""
+    K1, B = 1.2, 0.75
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.archived = {}     # 項目 -> (退避済みの件数, 読み込んだ [(連番, dict)...])
+        self._docs = {}        # キー -> (テキスト, 語数, 含む語)
+        self._postings = {}    # 語 -> {キー: 出現回数}
+        self._total_len = 0
+
+    def __len__(self):
+        return len(self._docs)
+
+    def sync(self, passages):
+        """索引を {キー: テキスト} に合わせる"""
+        for key in [k for k in self._docs if k not in passages]:
+            self._remove(key)
+        for key, text in passages.items():
+            doc = self._docs.get(key)
+            if doc and doc[0] == text: continue
+            if doc: self._remove(key)
+            self._add(key, text)
+
+    def _add(self, key, text):
+        counts = {}
+        for gram in _bigrams(text):
+            counts[gram] = counts.get(gram, 0) + 1
+        for gram, tf in counts.items():
+            self._postings.setdefault(gram, {})[key] = tf
+        length = sum(counts.values())
+        self._docs[key] = (text, length, tuple(counts))
+        self._total_len += length
+
+    def _remove(self, key):
+        _, length, grams = self._docs.pop(key)
+        for gram in grams:
+            posting = self._postings[gram]
+            posting.pop(key, None)
+            if not posting: del self._postings[gram]
+        self._total_len -= length
+
+    def search(self, query, budget_tokens, top_k, accept=None):
+        """query に近いパッセージをスコア順に、top_k 件・budget_tokens 以内で [(キー, テキスト)...] で返す。
+        accept(キー) が False のものは飛ばす"""
+        if not self._docs: return []
+        n, avg_len = len(self._docs), max(1.0, self._total_len / len(self._docs))
+        scores = {}
+        for gram in set(_bigrams(query)):
+            posting = self._postings.get(gram)
+            if not posting: continue
+            idf = math.log(1 + (n - len(posting) + 0.5) / (len(posting) + 0.5))
+            for key, tf in posting.items():
+                norm = self.K1 * (1 - self.B + self.B * self._docs[key][1] / avg_len)
+                scores[key] = scores.get(key, 0.0) + idf * tf * (self.K1 + 1) / (tf + norm)
+        results, used = [], 0
+        for key in sorted(scores, key=scores.get, reverse=True):
+            if accept and not accept(key): continue
+            text = self._docs[key][0]
+            cost = estimate_tokens(text)
+            if used + cost > budget_tokens: continue
+            results.append((key, text))
+            used += cost
+            if len(results) >= top_k: break
+        return results
+
+@st.cache_resource
+def get_passage_indexes():
+    return {"lock": threading.Lock(), "indexes": OrderedDict()}
+
+def get_passage_index(user_id, project_id):
+    """プロジェクトの索引（最近使った RETRIEVAL_MAX_PROJECTS 件だけメモリに持つ）"""
+    state = get_passage_indexes()
+    with state["lock"]:
+        indexes = state["indexes"]
+        key = (user_id, project_id)
+        if key not in indexes: indexes[key] = PassageIndex()
+        indexes.move_to_end(key)
+        while len(indexes) > RETRIEVAL_MAX_PROJECTS:
+            indexes.popitem(last=False)
+        return indexes[key]
+
+# --- 長い生成のジョブ ---
+class JobRunner:
+    """Gemini の長い呼び出しを裏スレッドで実行する。submit は ID を返すだけで、画面は status/latest で結果を見に行く。
+    ジョブは (ユーザー, プロジェクト, 種類) ごとに最新のものを覚えておき、再実行・プロジェクト切替・再接続の後でも結果を返せる。
+    ユーザーごとの同時実行数を max_per_user に抑え、超えた分はそのユーザーの待ち行列に入れる"""
+
+    def __init__(self, max_workers, max_per_user, ttl):
+        self.max_per_user = max_per_user
+        self.ttl = ttl
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job")
+        self._lock = threading.Lock()
+        self._jobs = {}     # job_id -> job
+        self._latest = {}   # (user_id, project_id, kind) -> job_id
+        self._queues = {}   # user_id -> deque[job_id]
+        self._running = {}  # user_id -> 実行中の件数
+
+    def submit(self, user_id, project_id, kind, fn, *args):
+        """fn(job, *args) を実行するジョブを積み、ID を返す。
+        同じプロジェクト・種類のジョブが待ち・実行中ならそれの ID を返す（二重に投げない）"""
+        key = (user_id, project_id, kind)
+        with self._lock:
+            self._prune()
+            current = self._jobs.get(self._latest.get(key))
+            if current and current["status"] in ("queued", "running"):
+                return current["id"]
+            job = {
+                "id": uuid.uuid4().hex[:12], "user_id": user_id, "project_id": project_id, "kind": kind,
+                "status": "queued", "partial": None, "result": None, "error": None, "dismissed": False,
+                "submitted_at": time.time(), "finished_at": None, "fn": telemetry.wrap(fn), "args": args,
+            }
+            self._jobs[job["id"]] = job
+            self._latest[key] = job["id"]
+            self._queues.setdefault(user_id, deque()).append(job["id"])
+            self._start_next(user_id)
+            return job["id"]
+
+    def _start_next(self, user_id):
+        """ロックを持った状態で呼ぶ。ユーザーの枠が空いていれば待ち行列の先頭を始める"""
+        queue = self._queues.get(user_id)
+        while queue and self._running.get(user_id, 0) < self.max_per_user:
+            job = self._jobs[queue.popleft()]
+            job["status"] = "running"
+            self._running[user_id] = self._running.get(user_id, 0) + 1
+            self._executor.submit(self._run, job)
+
+    def _run(self, job):
+        try:
+            result, error = job["fn"](job, *job["args"]), None
+        except Exception as e:
+            result, error = None, str(e)
+        with self._lock:
+            job.update(result=result, error=error, status="error" if error else "done", finished_at=time.time())
+            # プロンプトなどは結果が出たら手放す
+            job.pop("fn", None)
+            job.pop("args", None)
+            self._running[job["user_id"]] -= 1
+            self._start_next(job["user_id"])
+
+    def _prune(self):
+        """ロックを持った状態で呼ぶ。TTL を過ぎた終了済みのジョブを捨てる"""
+        cutoff = time.time() - self.ttl
+        for job_id in [i for i, j in self._jobs.items() if j["finished_at"] and j["finished_at"] < cutoff]:
+            job = self._jobs.pop(job_id)
+            key = (job["user_id"], job["project_id"], job["kind"])
+            if self._latest.get(key) == job_id:
+                del self._latest[key]
+
+    def latest(self, user_id, project_id, kind):
+        """そのプロジェクト・種類の最新のジョブ（無ければ None）"""
+        with self._lock:
+            return self._jobs.get(self._latest.get((user_id, project_id, kind)))
+
+    def status(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return job["status"] if job else None
+
+    def active(self, user_id):
+        """ユーザーの待ち・実行中のジョブ"""
+        with self._lock:
+            return [j for j in self._jobs.values() if j["user_id"] == user_id and j["status"] in ("queued", "running")]
+
+    def dismiss(self, job_id):
+        """結果を反映し終えた（他のセッションで開き直しても出さない）"""
+        with self._lock:
+            if job_id in self._jobs:
+                self._jobs[job_id]["dismissed"] = True
+
+@st.cache_resource
+def get_job_runner():
+    return JobRunner(JOB_MAX_WORKERS, JOB_MAX_PER_USER, JOB_RESULT_TTL_SEC)
+
+@st.cache_resource
+def get_genai_config():
+    return {"api_key": None, "lock": threading.Lock()}
+
+def configure_genai(api_key=None):
+    """このセッションの API キー（batch.py からは渡されたキー）で genai を設定する。最初の AI 呼び出しの直前に呼び、
+    ログイン直後の画面を先に出す。genai.configure はプロセス全体の設定なので、キーが変わったときだけ呼び直す"""
+    api_key = api_key or st.session_state.api_key
+    state = get_genai_config()
+    with state["lock"]:
+        if api_key and state["api_key"] != api_key:
+            import google.generativeai as genai
+            genai.configure(api_key=api_key)
+            state["api_key"] = api_key
+
+@st.cache_resource
+def get_model_router():
+    return ModelRouter(HEDGE_AFTER_SEC, LATENCY_WINDOW_SEC, LATENCY_MIN_SAMPLES)
+
+db = get_store()
+save_queue = get_save_queue()
+response_cache = get_response_cache()
+context_cache = get_context_cache()
+model_router = get_model_router()
+job_runner = get_job_runner()
+
+# batch.py から import されたときは画面を作らない（保存先・AI 呼び出し・プロンプトの関数だけを使う）
+HEADLESS = __name__ != "__main__"
+
+# 計測用: このセッションと実行回（rerun）の番号を記録先に結び付ける
+if not HEADLESS:
+    if "telemetry_session" not in st.session_state:
+        st.session_state.telemetry_session = uuid.uuid4().hex[:8]
+    st.session_state.telemetry_run = st.session_state.get("telemetry_run", 0) + 1
+    telemetry.bind(st.session_state.telemetry_session, st.session_state.telemetry_run)
 
 # ==========================================
 # 3. ログイン処理
 # ==========================================
-if "logged_in_user" not in st.session_state:
+if not HEADLESS and "logged_in_user" not in st.session_state:
     st.session_state.logged_in_user = None
 
 def login():
     user_id = st.session_state.login_input
     if user_id in ALLOWED_USERS:
         st.session_state.logged_in_user = user_id
-        initialize_user_session(user_id)
+        if not initialize_user_session(user_id):
+            st.session_state.logged_in_user = None
     else:
         st.error("IDが間違っています")
 
 def logout():
+    with st.spinner("保存中..."):
+        if not save_queue.flush(st.session_state.logged_in_user):
+            st.warning("一部の保存が完了していません")
     st.session_state.logged_in_user = None
-    st.session_state.projects_cache = {}
+    st.session_state.projects_cache = OrderedDict()
+    st.session_state.project_index = {}
     st.rerun()
 
+def new_project():
+    return {
+        "confirmed": DEFAULT_TEMPLATE,
+        "pending": "【次回確認事項】\n- ",
+        "strategy": "【戦略・分析】\n- ",
+        "director_memo": "",
+        "full_transcript": "",
+        "meeting_history": [],
+        "chat_history": [],
+        "chat_context": [],
+        "transcript_digest": {},
+        "history_archived": {},
+        "transcript_base_seq": 0,
+        "transcript_seq": 0,
+        "instruction_book": {}
+    }
+
+def get_project_body(user_id, project_id):
+    """プロジェクト本文を LRU キャッシュから返す。無ければその1行だけをシートから読む。
+    読み込みに失敗した場合は例外をそのまま投げ、キャッシュには何も置かない"""
+    cache = st.session_state.projects_cache
+    if project_id in cache:
+        cache.move_to_end(project_id)
+        return cache[project_id]
+
+    # 保存待ちの書き込みがあれば先に反映させてから読む
+    save_queue.flush(user_id)
+    proj = db.get_project(user_id, project_id, strict=True)
+    if proj is None:
+        # 行が無いと確かめられたときだけ空のプロジェクトにする
+        proj = new_project()
+    cache[project_id] = proj
+
+    while len(cache) > PROJECT_CACHE_SIZE:
+        old_id, old_proj = cache.popitem(last=False)
+        if old_proj.get("_dirty"):
+            save_queue.submit_project(db, user_id, old_id, old_proj, set(old_proj["_dirty"]))
+    return proj
+
 def initialize_user_session(user_id):
+    """ログイン時の読み込み。一覧が読めなかった場合はエラーを表示して False を返す（セッションには何も置かない）"""
     with st.spinner("データを読み込んでいます..."):
-        api_key, last_proj = db.get_user_config(user_id)
+        # 他セッションの未書き込み分を先に反映させる
+        save_queue.flush(user_id)
+        # 設定と一覧（project_id と updated_at）をまとめて読む。本文は選択時に読み込む
+        try:
+            (api_key, last_proj), index = db.get_login_data(user_id, strict=True)
+        except Exception as e:
+            # 読めないまま空の一覧として「Default Project」を作ると、Sheets にある同名の行を白紙で上書きしてしまう
+            st.error(f"データを読み込めませんでした: {e}")
+            return False
+        st.session_state.saved_config = (api_key, last_proj)
         default_key = st.secrets.get("GEMINI_API_KEY", "")
         st.session_state.api_key = default_key if default_key else api_key
         
-        projects = db.get_user_projects(user_id)
-        if not projects:
-            projects = {
-                "Default Project": {
-                    "confirmed": DEFAULT_TEMPLATE,
-                    "pending": "【次回確認事項】\n- ",
-                    "strategy": "【戦略・分析】\n- ",
-                    "director_memo": "",
-                    "full_transcript": "",
-                    "meeting_history": [],
-                    "chat_history": [],
-                    "chat_context": []
-                }
-            }
-            db.save_project(user_id, "Default Project", projects["Default Project"])
+        st.session_state.projects_cache = OrderedDict()
+        if not index:
+            default_proj = new_project()
+            error = db.save_project(user_id, "Default Project", default_proj)
+            if error: st.error(error)
+            index = {"Default Project": ""}
+            st.session_state.projects_cache["Default Project"] = default_proj
         
-        st.session_state.projects_cache = projects
+        st.session_state.project_index = index
         
         # インデント修正箇所
-        if last_proj and last_proj in projects:
+        if last_proj and last_proj in index:
             st.session_state.current_project_id = last_proj
         else:
-            st.session_state.current_project_id = list(projects.keys())[0]
+            st.session_state.current_project_id = list(index.keys())[0]
+    return True
 
-if not st.session_state.logged_in_user:
+if not HEADLESS and not st.session_state.logged_in_user:
     st.markdown("## 🔒 Login")
     st.text_input("User ID", key="login_input", on_change=login)
     if st.button("Login"):
@@ -287,66 +2163,171 @@ if not st.session_state.logged_in_user:
 # ==========================================
 # 4. アプリ本体
 # ==========================================
-CURRENT_USER = st.session_state.logged_in_user
-st.title(f"🚀 AI Web Direction Assistant (User: {CURRENT_USER})")
-
-with st.expander("ℹ️ 初めての方へ：このツールの使い方"):
-    st.markdown("""
-    **AIと協力して「最強の制作指示書」を作り上げるコックピットです。**
-    * **👈 左側：情報の保管庫**（プロジェクトの正解データ）
-    * **👉 右側：AI作業スペース**（STEP 1から順に進める）
-    """)
-
-if "projects_cache" not in st.session_state:
-    initialize_user_session(CURRENT_USER)
-
-if st.session_state.current_project_id not in st.session_state.projects_cache:
-    st.session_state.current_project_id = list(st.session_state.projects_cache.keys())[0]
+if not HEADLESS:
+    CURRENT_USER = st.session_state.logged_in_user
+    st.title(f"🚀 AI Web Direction Assistant (User: {CURRENT_USER})")
+
+    with st.expander("ℹ️ 初めての方へ：このツールの使い方"):
+        st.markdown("""
+        **AIと協力して「最強の制作指示書」を作り上げるコックピットです。**
+        * **👈 左側：情報の保管庫**（プロジェクトの正解データ）
+        * **👉 右側：AI作業スペース**（STEP 1から順に進める）
+        """)
+
+    if "projects_cache" not in st.session_state and not initialize_user_session(CURRENT_USER):
+        st.button("再読み込み", key="retry_login_load")
+        st.stop()
+
+    if st.session_state.current_project_id not in st.session_state.project_index:
+        st.session_state.current_project_id = list(st.session_state.project_index.keys())[0]
     
-curr_proj = st.session_state.projects_cache[st.session_state.current_project_id]
-if "strategy" not in curr_proj:
-    curr_proj["strategy"] = "【戦略・分析】\n- "
-
-if st.session_state.api_key:
-    genai.configure(api_key=st.session_state.api_key)
-
-if "ui_version" not in st.session_state:
-    st.session_state.ui_version = 0
+    try:
+        curr_proj = get_project_body(CURRENT_USER, st.session_state.current_project_id)
+    except Exception as e:
+        # 空の本文で画面を作ると、次の保存で Sheets の行を上書きしてしまうので、ここで止める
+        st.error(f"「{st.session_state.current_project_id}」を読み込めませんでした: {e}")
+        st.button("再読み込み", key="retry_project_load")
+        other = st.selectbox("別のプロジェクトを開く", list(st.session_state.project_index.keys()),
+                             index=None, key="fallback_project")
+        if other and other != st.session_state.current_project_id:
+            st.session_state.current_project_id = other
+            st.rerun()
+        st.stop()
+    if "strategy" not in curr_proj:
+        curr_proj["strategy"] = "【戦略・分析】\n- "
+
+    if "ui_version" not in st.session_state:
+        st.session_state.ui_version = 0
+        # モデル名はサイドバーで変えられる。各タブは再実行のたびにここから読む
+        st.session_state.model_high_quality = model_high_quality
+        st.session_state.model_high_speed = model_high_speed
+    if "history_shown" not in st.session_state:
+        st.session_state.history_shown = {}  # (project_id, 項目) -> 表示する履歴の件数
+        st.session_state.archived_history = {}  # (project_id, 項目) -> 退避済みの履歴（新しい順）
+    if "taken_jobs" not in st.session_state:
+        st.session_state.taken_jobs = set()  # 結果を受け取ったジョブの ID
+        # project_id -> STEP 1・3 の更新案 / STEP 4 の指示書
+        st.session_state.pre_res = {}
+        st.session_state.post_res = {}
+        st.session_state.final_res = {}
 
 # --- 保存ロジック ---
+def archive_old_history(user_id, project_id, proj):
+    """履歴が HISTORY_MAX_ITEMS 件を超えたら古い方を退避先に移して本文から外す。
+    chat_context はプロンプトで使う直近 CHAT_CONTEXT_TURNS 件だけを残す"""
+    if len(proj["chat_context"]) > CHAT_CONTEXT_TURNS:
+        proj["chat_context"] = proj["chat_context"][-CHAT_CONTEXT_TURNS:]
+        mark_dirty(proj, "chat_context")
+    keep = HISTORY_MAX_ITEMS // 2
+    base = time.time_ns() // 1000
+    for kind in ("meeting_history", "chat_history"):
+        items = proj[kind]
+        if len(items) <= HISTORY_MAX_ITEMS: continue
+        # meeting_history は新しい順、chat_history は古い順に並んでいる
+        old = list(reversed(items[keep:])) if kind == "meeting_history" else items[:-keep]
+        error = db.archive_entries(user_id, project_id, kind, [(base + i, entry) for i, entry in enumerate(old)])
+        if error:
+            st.toast(f"⚠️ {error}")  # 退避できなかった分は本文に残し、次回の保存で再度試す
+            continue
+        proj[kind] = items[:keep] if kind == "meeting_history" else items[-keep:]
+        archived = proj.setdefault("history_archived", {})
+        archived[kind] = archived.get(kind, 0) + len(old)
+        mark_dirty(proj, kind, "history_archived")
+        st.session_state.archived_history.pop((project_id, kind), None)
+
 def auto_save(refresh=False):
-    db.save_project(CURRENT_USER, st.session_state.current_project_id, curr_proj)
-    db.save_user_config(CURRENT_USER, st.session_state.api_key, st.session_state.current_project_id)
+    # 書き込みはキューに積むだけ（実際の保存は裏スレッドでまとめて行う）
+    project_id = st.session_state.current_project_id
+    proj = st.session_state.projects_cache[project_id]
+    if proj.get("_dirty"): archive_old_history(CURRENT_USER, project_id, proj)
+    fields = proj.get("_dirty")  # 未記録（新規作成など）なら行全体を保存
+    if fields is None or fields:
+        save_queue.submit_project(db, CURRENT_USER, project_id, proj, None if fields is None else set(fields))
+    proj["_dirty"] = set()
+    st.session_state.project_index[project_id] = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    # 設定（APIキー・最後に開いたプロジェクト）は変わったときだけ保存する
+    config = (st.session_state.api_key, project_id)
+    if config != st.session_state.get("saved_config"):
+        save_queue.submit_config(db, CURRENT_USER, *config)
+        st.session_state.saved_config = config
     if refresh:
         st.session_state.ui_version += 1
 
-def on_text_change(key, field):
+def get_archived_history(project_id, kind):
+    """退避した履歴を新しい順で返す（セッションに置いておき、次に退避するまで読み直さない）"""
+    cache = st.session_state.archived_history
+    if (project_id, kind) not in cache:
+        entries = db.load_archive(CURRENT_USER, project_id, kind)
+        cache[(project_id, kind)] = [entry for _, entry in reversed(entries)]
+    return cache[(project_id, kind)]
+
+def history_window(project_id, kind, proj):
+    """表示する履歴を新しい順で返す。(本文の履歴の件数, 退避済みの履歴のリスト, まだ続きがあるか)。
+    表示件数は HISTORY_PAGE_SIZE 件ずつ show_more_history で増やし、本文の分を超えたら退避先から読む"""
+    body = proj[kind]
+    shown = st.session_state.history_shown.get((project_id, kind), HISTORY_PAGE_SIZE)
+    archived_count = proj.get("history_archived", {}).get(kind, 0)
+    if shown <= len(body):
+        return shown, [], shown < len(body) + archived_count
+    archived = get_archived_history(project_id, kind)
+    return len(body), archived[:shown - len(body)], shown < len(body) + len(archived)
+
+def show_more_history(project_id, kind):
+    shown = st.session_state.history_shown.get((project_id, kind), HISTORY_PAGE_SIZE)
+    st.session_state.history_shown[(project_id, kind)] = shown + HISTORY_PAGE_SIZE
+
+def on_text_change(proj, key, field):
     new_value = st.session_state[key]
-    curr_proj[field] = new_value
+    proj[field] = new_value
+    mark_dirty(proj, field)
     auto_save(refresh=False)
-    st.toast(f"💾 保存しました")
+    st.toast(f"💾 自動保存します")
 
-def on_history_change(index, key):
+def on_history_change(proj, index, key):
     new_value = st.session_state[key]
-    curr_proj["meeting_history"][index]["content"] = new_value
+    proj["meeting_history"][index]["content"] = new_value
+    mark_dirty(proj, "meeting_history")
     auto_save(refresh=False)
     st.toast("💾 履歴を更新しました")
 
 # ==========================================
 # 5. サイドバー
 # ==========================================
-with st.sidebar:
+@st.fragment
+def sidebar_panel():
+    """保存状況・プロジェクト選択・設定。ここでの操作はサイドバーだけを再実行し、
+    プロジェクトの切り替えや作成など画面全体に関わるものだけ st.rerun() で全体を再実行する"""
     st.header(f"👤 {CURRENT_USER}")
     if st.button("ログアウト", type="secondary"):
         logout()
+
+    save_status = save_queue.status(CURRENT_USER)
+    if save_status["error"]:
+        st.warning(f"⚠️ {save_status['error']}")
+    if save_status["pending"]:
+        st.caption(f"⏳ 保存待ち: {save_status['pending']}件")
+        # コールバックは再実行の前に走るので、上の保存状況は送った後の値になる
+        st.button("今すぐ保存", key="flush_saves", on_click=save_queue.flush, args=(CURRENT_USER,))
+    elif save_status["saved_at"]:
+        st.caption(f"💾 保存済み ({save_status['saved_at'].strftime('%H:%M:%S')})")
+    if isinstance(db, ReplicatedStore):
+        replica_status = db.status(CURRENT_USER)
+        if replica_status["error"]:
+            st.caption(f"☁️ Sheets への同期を再試行中（{replica_status['pending']}件）: {replica_status['error']}")
+        elif replica_status["pending"]:
+            st.caption(f"☁️ Sheets 同期待ち: {replica_status['pending']}件")
     
     st.markdown("---")
     st.header("🗂️ プロジェクト")
     
-    project_names = list(st.session_state.projects_cache.keys())
+    project_index = st.session_state.project_index
+    project_names = list(project_index.keys())
     current_index = project_names.index(st.session_state.current_project_id)
     
-    selected_project = st.selectbox("選択中", project_names, index=current_index)
+    selected_project = st.selectbox(
+        "選択中", project_names, index=current_index,
+        format_func=lambda pid: f"{pid}  ({project_index[pid]})" if project_index.get(pid) else pid
+    )
     
     if selected_project != st.session_state.current_project_id:
         st.session_state.current_project_id = selected_project
@@ -356,23 +2337,15 @@ with st.sidebar:
     with st.expander("＋ 新規プロジェクト作成"):
         new_proj_name = st.text_input("案件名", placeholder="例: 株式会社〇〇様")
         if st.button("作成"):
-            if new_proj_name and new_proj_name not in st.session_state.projects_cache:
-                st.session_state.projects_cache[new_proj_name] = {
-                    "confirmed": DEFAULT_TEMPLATE,
-                    "pending": "【次回確認事項】\n- ",
-                    "strategy": "【戦略・分析】\n- ",
-                    "director_memo": "",
-                    "full_transcript": "",
-                    "meeting_history": [],
-                    "chat_history": [],
-                    "chat_context": []
-                }
+            if new_proj_name and new_proj_name not in st.session_state.project_index:
+                st.session_state.projects_cache[new_proj_name] = new_project()
+                st.session_state.project_index[new_proj_name] = ""
                 st.session_state.current_project_id = new_proj_name
                 auto_save(refresh=True)
                 st.success(f"作成: {new_proj_name}")
                 time.sleep(0.5)
                 st.rerun()
-            elif new_proj_name in st.session_state.projects_cache:
+            elif new_proj_name in st.session_state.project_index:
                 st.error("同名のプロジェクトが既に存在します")
 
     st.markdown("---")
@@ -387,305 +2360,1007 @@ with st.sidebar:
             st.rerun()
 
     with st.expander("🤖 モデル設定"):
-        model_high_quality = st.text_input("分析用", value=model_high_quality)
-        model_high_speed = st.text_input("対話用", value=model_high_speed)
+        st.text_input("分析用", key="model_high_quality")
+        st.text_input("対話用", key="model_high_speed")
+        cache_stats = response_cache.stats
+        st.caption(f"応答キャッシュ: ヒット {cache_stats['hits']} / ミス {cache_stats['misses']}")
+        ctx_stats = context_cache.stats
+        st.caption(f"コンテキストキャッシュ: 利用 {ctx_stats['hits']} / 作成 {ctx_stats['created']} / 直書き {ctx_stats['fallbacks']}")
+
+if not HEADLESS:
+    with st.sidebar:
+        sidebar_panel()
 
 # ==========================================
 # 6. メインUI
 # ==========================================
+if not HEADLESS:
+    ui_suffix = f"{st.session_state.current_project_id}_{st.session_state.ui_version}"
 
-ui_suffix = f"{st.session_state.current_project_id}_{st.session_state.ui_version}"
-
-st.markdown(f"### 📂 Project: **{st.session_state.current_project_id}**")
+    st.markdown(f"### 📂 Project: **{st.session_state.current_project_id}**")
 
-left_col, right_col = st.columns([1, 1])
+    left_col, right_col = st.columns([1, 1])
 
 # --- 左カラム（保管庫） ---
-with left_col:
+@st.fragment
+def project_editors(proj, ui_suffix):
+    """左カラムの4つの編集欄。入力してもこのカラムだけを再実行する"""
     with st.container(border=True):
         st.subheader("🗂 プロジェクト情報管理")
         
         st.markdown("#### 📂 決定事項（要件定義）")
         conf_key = f"conf_{ui_suffix}"
         st.text_area(
-            "決定事項", value=curr_proj["confirmed"], height=500, 
+            "決定事項", value=proj["confirmed"], height=500, 
             key=conf_key, label_visibility="collapsed",
-            on_change=on_text_change, args=(conf_key, "confirmed")
+            on_change=on_text_change, args=(proj, conf_key, "confirmed")
         )
 
         st.markdown("#### ❓ 未決・確認リスト")
         pend_key = f"pend_{ui_suffix}"
         st.text_area(
-            "未定事項", value=curr_proj["pending"], height=200, 
+            "未定事項", value=proj["pending"], height=200, 
             key=pend_key, label_visibility="collapsed",
-            on_change=on_text_change, args=(pend_key, "pending")
+            on_change=on_text_change, args=(proj, pend_key, "pending")
         )
 
         st.markdown("#### 💡 戦略・分析・キラークエスチョン")
         strat_key = f"strat_{ui_suffix}"
         st.text_area(
-            "戦略メモ", value=curr_proj["strategy"], height=200, 
+            "戦略メモ", value=proj["strategy"], height=200, 
             key=strat_key, label_visibility="collapsed",
-            on_change=on_text_change, args=(strat_key, "strategy")
+            on_change=on_text_change, args=(proj, strat_key, "strategy")
         )
 
         st.markdown("#### 📝 自由メモ・備忘録")
         memo_key = f"memo_{ui_suffix}"
         st.text_area(
-            "自由メモ", value=curr_proj["director_memo"], height=150, 
+            "自由メモ", value=proj["director_memo"], height=150, 
             key=memo_key, label_visibility="collapsed",
-            on_change=on_text_change, args=(memo_key, "director_memo")
+            on_change=on_text_change, args=(proj, memo_key, "director_memo")
         )
 
+if not HEADLESS:
+    with left_col:
+        project_editors(curr_proj, ui_suffix)
+
 # --- 右カラム（AIツール） ---
-def generate_with_model(model_name, prompt):
+def generate_with_model(model_name, prompt, force=False, context=None):
+    """force=True で応答キャッシュを使わずに生成し直す（結果はキャッシュに上書きする）。
+    context には呼び出しをまたいで変わらない前半部分（project_context）を渡す。
+    分析用モデルの応答が遅いときは対話用モデルにも投げ、先に返った方を使う"""
     if not st.session_state.api_key: return None, "APIキー未設定"
+    configure_genai()
+    meta = {}
+    text, error = _generate(model_name, prompt, force, context, hedge_model=st.session_state.model_high_speed, meta=meta)
+    if text and meta["model"] != model_name:
+        st.toast(f"⚡ {model_name} の応答が遅いため、{meta['model']} の結果を表示しています")
+    return text, error
+
+def _prepare_model(model_name, prompt, context):
+    """(モデル, 送るプロンプト) を返す。context はキャッシュできればキャッシュ済みモデルに載せ、
+    できなければプロンプトの先頭に直接連結する"""
+    import google.generativeai as genai
+    if context:
+        model = context_cache.model_for(model_name, context) if CONTEXT_CACHE_ENABLED else None
+        if model is not None:
+            return model, prompt
+        return genai.GenerativeModel(model_name), f"{context}\n{prompt}"
+    return genai.GenerativeModel(model_name), prompt
+
+def _is_context_cache_error(e):
+    msg = str(e).lower()
+    return "cachedcontent" in msg or "cached content" in msg
+
+def _gemini_costs(model_name, prompt):
+    return [(f"gemini.rpm:{model_name}", 1), (f"gemini.tpm:{model_name}", estimate_tokens(prompt))]
+
+def _start_stream(model, contents, generation_config=None):
+    """ストリームを開始して最初のチャンクまで受け取る（ここまでの失敗は再試行できる）"""
+    chunks = iter(model.generate_content(contents, safety_settings=safety_settings, stream=True,
+                                         generation_config=generation_config,
+                                         request_options={"timeout": LLM_DEADLINE_SEC}))
+    first = next(chunks, None)
+    return itertools.chain([first] if first is not None else [], chunks)
+
+def _open_stream(model_name, prompt, context, generation_config=None):
+    """流量制御・再試行付きでストリームを開始する。コンテキストキャッシュが失効していたらプロンプト直書きで送り直す"""
+    full_prompt = f"{context}\n{prompt}" if context else prompt
+    model, contents = _prepare_model(model_name, prompt, context)
+    costs = _gemini_costs(model_name, full_prompt)
     try:
-        model = genai.GenerativeModel(model_name)
-        response = model.generate_content(prompt, safety_settings=safety_settings)
-        if not response.parts: return None, "応答が空です"
-        return response.text, None
+        return rate_limiter.run(costs, lambda: _start_stream(model, contents, generation_config))
     except Exception as e:
-        return None, str(e)
+        if not (context and _is_context_cache_error(e)): raise
+        context_cache.invalidate(model_name, context)
+        import google.generativeai as genai
+        fallback = genai.GenerativeModel(model_name)
+        return rate_limiter.run(costs, lambda: _start_stream(fallback, full_prompt, generation_config))
+
+def _record_usage(record, response):
+    """usage_metadata のトークン数をスパンに記録する"""
+    usage = getattr(response, "usage_metadata", None)
+    if usage:
+        record["prompt_tokens"] = getattr(usage, "prompt_token_count", 0) or 0
+        record["response_tokens"] = getattr(usage, "candidates_token_count", 0) or 0
+        record["cached_tokens"] = getattr(usage, "cached_content_token_count", 0) or 0
+
+def _generate(model_name, prompt, force=False, context=None, hedge_model=None, meta=None):
+    """generate_with_model の本体。session_state に触れないので裏スレッドからも呼べる。
+    hedge_model を渡すとヘッジ付きで生成する。meta を渡すと、応答を返したモデル名を meta["model"] に入れる"""
+    full_prompt = f"{context}\n{prompt}" if context else prompt
+    if meta is not None: meta["model"] = model_name
+    with telemetry.span("gemini.generate", model=model_name) as record:
+        record["bytes_out"] = len(full_prompt.encode("utf-8"))
+        if not force:
+            cached = response_cache.get(ResponseCache.make_key(model_name, full_prompt, safety_settings))
+            if cached is not None:
+                record["response_cache"] = "hit"
+                return cached, None
+        delay = model_router.hedge_delay(model_name, hedge_model)
+        try:
+            if delay is None:
+                text, used = _generate_once(model_name, prompt, context, record), model_name
+            else:
+                text, used = _generate_hedged(model_name, hedge_model, delay, prompt, context, record)
+        except Exception as e:
+            record["error"] = type(e).__name__
+            return None, str(e)
+        if not text:
+            record["error"] = "EmptyResponse"
+            return None, "応答が空です"
+        record["model_used"] = used
+        if meta is not None: meta["model"] = used
+        record["bytes_in"] = len(text.encode("utf-8"))
+        # ヘッジ先が返した応答は、そのモデルの応答としてキャッシュする
+        response_cache.put(ResponseCache.make_key(used, full_prompt, safety_settings), text)
+        return text, None
+
+def _generate_once(model_name, prompt, context, record):
+    """1モデルに1回だけ投げる。応答のテキスト（空なら ""）を返す"""
+    full_prompt = f"{context}\n{prompt}" if context else prompt
+    model, contents = _prepare_model(model_name, prompt, context)
+    costs = _gemini_costs(model_name, full_prompt)
+    options = {"safety_settings": safety_settings, "request_options": {"timeout": LLM_DEADLINE_SEC}}
+    started = time.perf_counter()
+    try:
+        try:
+            response = rate_limiter.run(costs, lambda: model.generate_content(contents, **options))
+        except Exception as e:
+            if not (context and _is_context_cache_error(e)): raise
+            # サーバー側でキャッシュが失効していた: 作り直さずに今回はプロンプト直書きで送る
+            context_cache.invalidate(model_name, context)
+            import google.generativeai as genai
+            fallback = genai.GenerativeModel(model_name)
+            response = rate_limiter.run(costs, lambda: fallback.generate_content(full_prompt, **options))
+    finally:
+        model_router.record(model_name, time.perf_counter() - started)
+    _record_usage(record, response)
+    return response.text if response.parts else ""
+
+def _stream_attempt(model_name, prompt, context, cancel):
+    """ヘッジ用に1モデル分をストリームで受け取る。cancel がセットされたら受信をやめて None を返す"""
+    with telemetry.span("gemini.attempt", model=model_name) as record:
+        started = time.perf_counter()
+        text = ""
+        try:
+            for chunk in _open_stream(model_name, prompt, context):
+                if cancel.is_set():
+                    record["cancelled"] = True
+                    return None
+                _record_usage(record, chunk)
+                try:
+                    text += chunk.text or ""
+                except ValueError:
+                    continue  # parts が空のチャンク（安全フィルタなど）
+        finally:
+            # 打ち切り・失敗もそこまでの時間を記録し、遅いモデルへのヘッジが早まるようにする
+            model_router.record(model_name, time.perf_counter() - started)
+        if cancel.is_set():
+            record["cancelled"] = True
+            return None
+        record["bytes_in"] = len(text.encode("utf-8"))
+        return text
+
+def _generate_hedged(model_name, hedge_model, delay, prompt, context, record):
+    """model_name に投げ、delay 秒で返らなければ（または失敗したら）hedge_model にも投げる。
+    先に返った方の (テキスト, モデル名) を返し、もう一方は打ち切る。LLM_DEADLINE_SEC を過ぎたら TimeoutError"""
+    executor = get_hedge_executor()
+    cancel = threading.Event()
+    deadline = time.monotonic() + LLM_DEADLINE_SEC
+    hedge_at = time.monotonic() + delay
+    attempt = telemetry.wrap(_stream_attempt)
+    futures = {executor.submit(attempt, model_name, prompt, context, cancel): model_name}
+    pending, hedged, errors = set(futures), False, []
+    try:
+        while pending or not hedged:
+            now = time.monotonic()
+            if not hedged and (now >= hedge_at or not pending):
+                future = executor.submit(attempt, hedge_model, prompt, context, cancel)
+                futures[future] = hedge_model
+                pending.add(future)
+                hedged = record["hedged"] = True
+            if now >= deadline:
+                raise TimeoutError(f"{LLM_DEADLINE_SEC:.0f}秒以内に応答がありませんでした")
+            wake_at = deadline if hedged else min(hedge_at, deadline)
+            done, pending = wait(pending, timeout=wake_at - now, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    text = future.result()
+                except Exception as e:
+                    errors.append(f"{futures[future]}: {e}")
+                    continue
+                if text:
+                    return text, futures[future]
+                errors.append(f"{futures[future]}: 応答が空です")
+        raise RuntimeError(" / ".join(errors))
+    finally:
+        cancel.set()  # 負けた方のストリームを閉じる
+
+def stream_with_model(model_name, prompt, result, context=None, generation_config=None):
+    """generate_with_model のストリーミング版。届いたテキストを順に yield する。
+    終了後、全文は result["text"]、エラーは result["error"] に入る"""
+    if not st.session_state.api_key:
+        result.update(text="", error="APIキー未設定")
+        return
+    configure_genai()
+    yield from _stream(model_name, prompt, result, context, generation_config)
+
+def _stream(model_name, prompt, result, context=None, generation_config=None):
+    """stream_with_model の本体。session_state に触れないので裏スレッドからも呼べる"""
+    result.update(text="", error=None)
+    full_prompt = f"{context}\n{prompt}" if context else prompt
+    with telemetry.span("gemini.stream", model=model_name) as record:
+        record["bytes_out"] = len(full_prompt.encode("utf-8"))
+        started = time.perf_counter()
+        try:
+            for chunk in _open_stream(model_name, prompt, context, generation_config):
+                _record_usage(record, chunk)  # 最後のチャンクに全体の usage が入る
+                try:
+                    piece = chunk.text
+                except ValueError:
+                    continue  # parts が空のチャンク（安全フィルタなど）
+                if piece:
+                    if not result["text"]:
+                        record["ttft_ms"] = round((time.perf_counter() - started) * 1000, 1)
+                    result["text"] += piece
+                    yield piece
+            record["bytes_in"] = len(result["text"].encode("utf-8"))
+            if not result["text"]: result["error"] = "応答が空です"
+        except Exception as e:
+            record["error"] = type(e).__name__
+            result["error"] = str(e)
+
+def project_context(proj):
+    """STEP 2〜4・AI相談で共通の前半部分。内容が変わらない限り同じ文字列になる（コンテキストキャッシュのキー）"""
+    return f"""【決定事項】{proj["confirmed"]}
+【未決】{proj["pending"]}
+【戦略】{proj["strategy"]}
+【メモ】{proj["director_memo"]}"""
+
+# --- STEP 1・3 の更新案（決定事項・未決・戦略）を届いた分から組み立てる ---
+PROPOSAL_KEYS = ("conf", "pend", "strat")
+PROPOSAL_SCHEMA = {"type": "object", "properties": {k: {"type": "string"} for k in PROPOSAL_KEYS}, "required": list(PROPOSAL_KEYS)}
+
+class MarkerSectionParser:
+    """===SECTION1=== のような区切りで分かれた出力を、チャンクが届くたびに区間ごとに振り分ける。
+    モデルが "=== SECTION1 ===" のように空白を入れても区切りとして扱う。
+    最初の区切りが出てこなかった場合は、最初に見つかった区切りより前のテキストを最初の区間として扱う"""
+
+    def __init__(self, markers):
+        self._pattern = re.compile(r"={2,}\s*(" + "|".join(map(re.escape, markers)) + r")\s*={2,}")
+        self._order = {name: i for i, name in enumerate(markers)}
+        self.sections = [""] * len(markers)
+        self.found = set()  # 区切りが見つかった区間
+        self.raw = ""
+        self._current = None  # 最初に見つかった区切りより前は _preamble に入れる
+        self._preamble = ""
+        self._buffer = ""
+
+    def feed(self, piece):
+        self.raw += piece
+        self._buffer += piece
+        pos = 0
+        for match in self._pattern.finditer(self._buffer):
+            self._append(self._buffer[pos:match.start()])
+            self._current = self._order[match.group(1)]
+            self.found.add(self._current)
+            pos = match.end()
+        rest = self._buffer[pos:]
+        # 区切りの途中で切れているかもしれない末尾は次のチャンクまで持ち越す
+        partial = re.search(r"=[=\sA-Z0-9]*$", rest)
+        keep = len(rest) - partial.start() if partial and len(rest) - partial.start() < 40 else 0
+        self._append(rest[:len(rest) - keep])
+        self._buffer = rest[len(rest) - keep:]
+
+    def _append(self, text):
+        if self._current is None:
+            self._preamble += text
+        else:
+            self.sections[self._current] += text
+
+    def close(self):
+        self._append(self._buffer)
+        self._buffer = ""
+        # 区切りが1つも無い出力は run_proposal_job が全体を最初の区間に入れる
+        if self.found and 0 not in self.found and self._preamble.strip():
+            self.sections[0] = self._preamble
+            self.found.add(0)
+
+    def values(self):
+        sections = list(self.sections)
+        if 0 not in self.found: sections[0] = self._preamble
+        return [s.strip() for s in sections]
+
+class JsonSectionParser:
+    """構造化出力（{"conf": ..., "pend": ..., "strat": ...} の JSON）を、閉じていない文字列も含めて途中まで読む"""
+
+    def __init__(self, keys):
+        self.keys = keys
+        self.sections = [""] * len(keys)
+        self.found = set()
+        self.raw = ""
+        self._complete = set()  # 値の文字列が閉じた区間
+
+    def feed(self, piece):
+        self.raw += piece
+        for i, key in enumerate(self.keys):
+            if i in self._complete: continue
+            value, complete = self._partial_string(key)
+            if value is None: continue
+            self.sections[i] = value
+            self.found.add(i)
+            if complete: self._complete.add(i)
+
+    def _partial_string(self, key):
+        """"key": "..." の値を届いているところまでデコードし、(値, 閉じたか) を返す。まだ始まっていなければ (None, False)"""
+        match = re.search(r'"' + re.escape(key) + r'"\s*:\s*"', self.raw)
+        if not match: return None, False
+        end, escaped, complete = len(self.raw), False, False
+        for i in range(match.end(), len(self.raw)):
+            ch = self.raw[i]
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                end, complete = i, True
+                break
+        text = self.raw[match.end():end]
+        # 途中で切れたエスケープ（\ や \u12 など）は削って、次のチャンクを待つ
+        for cut in range(1 if complete else 6):
+            try:
+                return json.loads(f'"{text[:len(text) - cut]}"'), complete
+            except ValueError:
+                continue
+        return None, False
 
-with right_col:
-    with st.container(border=True):
-        st.subheader("🤖 AI作業スペース")
-        
-        tab1, tab2, tab3, tab4, tab5 = st.tabs([
-            "STEP 1: 準備・予習", 
-            "STEP 2: 会議中サポート", 
-            "STEP 3: 会議後まとめ", 
-            "STEP 4: 指示書作成", 
-            "💬 AI相談"
-        ])
-
-        # --- STEP 1 ---
-        with tab1:
-            st.info("💡 **ここでやること**: 問い合わせメモから初期情報を整理し、戦略を立てます。")
-            tool_a_input = st.text_area("メモを入力", height=150, key="tool_a_input")
-            
-            if "pre_res" not in st.session_state: 
-                st.session_state.pre_res = {"conf": "", "pend": "", "strat": ""}
-
-            if st.button("▶ 分析実行", key="btn_a", type="primary"):
-                with st.spinner("分析中..."):
-                    prompt = f"""
-                    あなたはWebディレクターです。
-                    以下のメモから情報を抽出し、以下の3つに分類して出力してください。
-
-                    【入力メモ】{tool_a_input}
-                    【現在のテンプレート】{curr_proj["confirmed"]}
-
-                    【指示】
-                    1. テンプレートの空欄を埋める（決定事項）。
-                    2. 不足情報や事務的な確認事項を抽出する（未決リスト）。
-                    3. **業界トレンド、競合分析、打ち合わせ時のキラークエスチョン（戦略）** を提案する。
-
-                    **マークダウン禁止。プレーンテキストのみ。**
-                    出力形式: ===SECTION1=== (決定事項全文) ===SECTION2=== (未決リスト) ===SECTION3=== (戦略・トレンド・質問案)
-                    """
-                    text, error = generate_with_model(model_high_quality, prompt)
+    def close(self):
+        try:
+            data = json.loads(self.raw)
+        except ValueError:
+            return  # 途中までしか読めなかった: 読めた分だけを使う
+        if isinstance(data, dict):
+            for i, key in enumerate(self.keys):
+                if isinstance(data.get(key), str):
+                    self.sections[i] = data[key]
+                    self.found.add(i)
+
+    def values(self):
+        return [s.strip() for s in self.sections]
+
+def proposal_request(markers, labels):
+    """(パーサ, プロンプトに入れる出力形式の指示, generation_config) を返す。
+    STRUCTURED_OUTPUT が有効なら JSON の構造化出力、無効なら区切り文字列で受け取る"""
+    if STRUCTURED_OUTPUT:
+        fields = "、".join(f'"{key}" に{label}' for key, label in zip(PROPOSAL_KEYS, labels))
+        config = {"response_mime_type": "application/json", "response_schema": PROPOSAL_SCHEMA}
+        return JsonSectionParser(PROPOSAL_KEYS), f"出力形式: JSON オブジェクト（{fields}を文字列で入れる）", config
+    layout = " ".join(f"==={marker}=== ({label})" for marker, label in zip(markers, labels))
+    return MarkerSectionParser(markers), f"出力形式: {layout}", None
+
+def post_meeting_request(log_text, add_inst=""):
+    """STEP 3（会議後まとめ）の (パーサ, プロンプト, generation_config)。画面と batch.py で共通"""
+    parser, output_format, generation_config = proposal_request(
+        ("CONFIRMED", "PENDING", "STRATEGY"), ("全文", "未決", "戦略"))
+    # 応答キャッシュのキーが変わらないよう、プロンプトの字下げは画面にあったときのまま
+    prompt = f"""
+            あなたは統括ディレクターです。
+            【全ログ】{log_text}
+            【指示】{add_inst}
+            1. テンプレートの空欄を埋める。2. 未定は未決へ。3. 今後の戦略を更新。
+            **マークダウン禁止。**
+            {output_format}
+            """
+    return parser, prompt, generation_config
+
+# STEP 4（指示書）のプロンプト。決定事項・戦略・メモは project_context で前に付ける
+INSTRUCTION_PROMPT = """
+            上記の決定事項・戦略・メモからデザイナーへの指示書を作成してください。
+            **マークダウン禁止。プレーンテキストで。**
+            """
+
+def run_proposal_job(job, model_name, prompt, parser, current, force=False, context=None, generation_config=None):
+    """更新案を作るジョブ（JobRunner から裏スレッドで呼ばれる）。届いた区間は job["partial"] に入れていき、
+    画面はそれを表示する。応答キャッシュも使う。返り値は {"proposal": {キー: 案}, "warning": 警告}。
+    区間が欠けていた場合は current（今の値）で補い、1つも読めなければ出力全体を決定事項の案に入れる"""
+    full_prompt = f"{context}\n{prompt}" if context else prompt
+    cache_key = ResponseCache.make_key(model_name, full_prompt, {**safety_settings, "generation_config": generation_config})
+    cached = None if force else response_cache.get(cache_key)
+    if cached is not None:
+        parser.feed(cached)
+    else:
+        result = {}
+        for piece in _stream(model_name, prompt, result, context, generation_config):
+            parser.feed(piece)
+            job["partial"] = parser.values()
+        if result["error"]: raise RuntimeError(result["error"])
+        response_cache.put(cache_key, result["text"])
+    parser.close()
+
+    values, warning = parser.values(), None
+    missing = [i for i in range(len(values)) if i not in parser.found]
+    if len(missing) == len(values):
+        values = [parser.raw.strip(), current[1], current[2]]
+        warning = "出力の区切りを読み取れなかったため、出力全体を決定事項の案に入れました"
+    elif missing:
+        for i in missing: values[i] = current[i]
+        warning = "一部の項目が出力に含まれていなかったため、現在の内容のままにしています"
+    return {"proposal": dict(zip(PROPOSAL_KEYS, values)), "warning": warning}
+
+def run_generate_job(job, model_name, prompt, force=False, context=None, hedge_model=None):
+    """generate_with_model のジョブ版。返り値は {"text": 本文, "model": 応答したモデル}"""
+    meta = {}
+    text, error = _generate(model_name, prompt, force, context, hedge_model=hedge_model, meta=meta)
+    if error: raise RuntimeError(error)
+    return {"text": text, "model": meta["model"]}
+
+def show_job_progress(job, labels=None):
+    """実行中のジョブの状態を表示する。labels を渡すと、届いた更新案の区間をタブで表示する"""
+    if job["status"] == "queued":
+        st.info("⏳ 順番待ちです（他の分析が終わりしだい始まります）")
+        return
+    st.info("⏳ 生成中です。別のタブやプロジェクトに移っても、結果はこのプロジェクトに届きます")
+    if labels and job["partial"]:
+        for tab, value in zip(st.tabs(labels), job["partial"]):
+            with tab:
+                if value: st.text(value)
+                else: st.caption("⏳ 生成中...")
+
+def take_job_result(project_id, kind):
+    """このプロジェクトの kind のジョブが終わっていて、まだ受け取っていなければ返す（同じ結果は1度だけ返す）"""
+    job = job_runner.latest(CURRENT_USER, project_id, kind)
+    if job is None or job["status"] not in ("done", "error") or job["dismissed"]: return None
+    if job["id"] in st.session_state.taken_jobs: return None
+    st.session_state.taken_jobs.add(job["id"])
+    return job
+
+# --- 全ログの要約（長い会議向け） ---
+def _text_hash(text):
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+def split_transcript(text, size):
+    """先頭から約 size 文字ごと（直後の改行まで）に区切った区間の終端位置を返す。
+    追記しても既存の区切りは変わらない。末尾の未完成の区間は含めない"""
+    ends, pos = [], 0
+    while True:
+        cut = text.find("\n", pos + size, pos + size * 2)
+        if cut < 0:
+            if len(text) < pos + size * 2: break
+            cut = pos + size * 2 - 1  # 改行の無い長文は強制的に区切る
+        ends.append(cut + 1)
+        pos = cut + 1
+    return ends
+
+def update_transcript_digest(proj, text, ends, model_name):
+    """proj["transcript_digest"] を ends[-1] 文字目まで進め、全体の要約を返す（失敗時は None）。
+    要約済みの区間はそのまま使い、新しい区間だけを要約してローリング要約に足し込む。genai は呼び出し元で設定しておく"""
+    state = proj.get("transcript_digest") or {}
+    chunks = state.get("chunks", [])  # [区間のハッシュ, 終端位置, 要約]
+    covered = chunks[-1][1] if chunks else 0
+    known = {}
+    if chunks and (covered > len(text) or _text_hash(text[:covered]) != state.get("covered_hash")):
+        # ログが途中で編集された: 内容が変わっていない区間の要約だけ再利用して作り直す
+        known = {c[0]: c[2] for c in chunks}
+        chunks, covered = [], 0
+    digest = state.get("digest", "") if chunks else ""
+    if covered >= ends[-1]:
+        return digest
+
+    starts = [0] + ends[:-1]
+    new_ranges = [(start, end) for start, end in zip(starts, ends) if end > covered]
+    summary_chars = max(300, TRANSCRIPT_CHUNK_CHARS // 8)
+    futures = {}
+    for start, end in new_ranges:
+        segment_hash = _text_hash(text[start:end])
+        if segment_hash in known: continue
+        prompt = f"""
+        以下は打ち合わせログの一部です。決定事項・要望・懸念点・数値・固有名詞を落とさずに箇条書きで要約してください。
+        **{summary_chars}文字以内。マークダウン禁止。**
+        【ログ】{text[start:end]}
+        """
+        futures[segment_hash] = get_llm_executor().submit(telemetry.wrap(_generate), model_name, prompt)
+    for segment_hash, future in futures.items():
+        summary, _ = future.result()
+        if not summary: return None
+        known[segment_hash] = summary
+
+    new_chunks = [[_text_hash(text[start:end]), end, known[_text_hash(text[start:end])]] for start, end in new_ranges]
+    digest_chars = int(TRANSCRIPT_TOKEN_BUDGET * (1 - TRANSCRIPT_TAIL_RATIO))
+    new_summaries = "\n".join(c[2] for c in new_chunks)
+    prompt = f"""
+    打ち合わせ全体の要約を、新しい区間の要約を反映して更新してください。
+    古い情報が新しい情報で覆された場合は新しい方を残してください。
+    **{digest_chars}文字以内。決定事項・未決事項・数値・固有名詞は省略しない。マークダウン禁止。**
+    【これまでの要約】{digest or "（なし）"}
+    【新しい区間の要約】{new_summaries}
+    """
+    digest, _ = _generate(model_name, prompt)
+    if not digest: return None
+
+    proj["transcript_digest"] = {
+        "chunks": chunks + new_chunks,
+        "digest": digest,
+        "covered_hash": _text_hash(text[:ends[-1]]),
+    }
+    mark_dirty(proj, "transcript_digest")
+    return digest
+
+def _transcript_seq():
+    return time.time_ns() // 1000
+
+def transcript_text(user_id, project_id, proj):
+    """全ログ（ベース + 追記分）。初めて使うときだけ追記分を読んで組み立て、proj["_transcript"] に置いておく。
+    ベースより後に追記していない（transcript_seq が transcript_base_seq 以下の）ときは読みに行かない"""
+    if "_transcript" not in proj:
+        base_seq, latest = proj.get("transcript_base_seq", 0), proj.get("transcript_seq")
+        segments = []
+        if latest is None or latest > base_seq:
+            segments = db.load_transcript(user_id, project_id, after=base_seq, latest=latest)
+        proj["_transcript"] = proj["full_transcript"] + "".join("\n" + text for _, _, text in segments)
+    return proj["_transcript"]
+
+def append_transcript(project_id, proj, text):
+    """会議ログに追記する。書き込むのは追記分の1行だけで、本文（transcript 列）は書き換えない"""
+    current = transcript_text(CURRENT_USER, project_id, proj)
+    seq = _transcript_seq()
+    at = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    error = db.append_transcript(CURRENT_USER, project_id, [(seq, at, text)])
+    if error:
+        # 追記できなかったときは従来どおり全文をベースとして本文ごと保存する
+        st.toast(f"⚠️ {error}")
+        replace_transcript(project_id, proj, current + "\n" + text)
+        return
+    proj["_transcript"] = current + "\n" + text
+    proj["transcript_seq"] = seq
+    mark_dirty(proj, "transcript_seq")
+
+def replace_transcript(project_id, proj, text):
+    """全ログを書き換える（手で編集したとき）。それまでの追記分はベースに含めたものとして読まなくする"""
+    proj["full_transcript"] = text
+    proj["transcript_base_seq"] = _transcript_seq()
+    proj["_transcript"] = text
+    mark_dirty(proj, "full_transcript", "transcript_base_seq")
+
+def _passage_pieces(text):
+    """長いテキストを RETRIEVAL_PASSAGE_CHARS ごと（直後の改行まで）に区切った [(開始, 終端)...]"""
+    starts_ends, start = [], 0
+    for end in split_transcript(text, RETRIEVAL_PASSAGE_CHARS) + [len(text)]:
+        if end > start: starts_ends.append((start, end))
+        start = end
+    return starts_ends
+
+def history_passage_key(kind, text):
+    return f"{kind}:{_text_hash(text)[:16]}"
+
+def _history_passage_text(kind, entry):
+    if kind == "meeting_history":
+        return f"（会議中の出力 {entry.get('time', '')}）\n{entry.get('content', '')}"
+    return f"{'User' if entry.get('role') == 'user' else 'AI'}: {entry.get('text', '')}"
+
+def project_passages(user_id, project_id, proj, index):
+    """索引に入れるパッセージ {キー: テキスト}。全ログは "log:開始:終端"、履歴は "項目:ハッシュ:番号" をキーにする。
+    退避済みの履歴は件数が変わったときだけ読み直して index に置いておく"""
+    text = transcript_text(user_id, project_id, proj)
+    passages = {f"log:{start}:{end}": text[start:end] for start, end in _passage_pieces(text)}
+    for kind in ("meeting_history", "chat_history"):
+        archived_count = proj.get("history_archived", {}).get(kind, 0)
+        if index.archived.get(kind, (None,))[0] != archived_count:
+            index.archived[kind] = (archived_count, db.load_archive(user_id, project_id, kind) if archived_count else [])
+        entries = [entry for _, entry in index.archived[kind][1]] + proj[kind]
+        for entry in entries:
+            body = _history_passage_text(kind, entry)
+            base = history_passage_key(kind, body)
+            for i, (start, end) in enumerate(_passage_pieces(body)):
+                passages[f"{base}:{i}"] = body[start:end]
+    return passages
+
+def related_passages(user_id, project_id, proj, query, accept=None):
+    """query に関連する全ログ・履歴の一部を、RETRIEVAL_TOKEN_BUDGET 以内でテキストのリストにして返す。
+    索引は呼ばれたときに変わった分だけ更新する"""
+    if not RETRIEVAL_ENABLED or not query.strip(): return []
+    index = get_passage_index(user_id, project_id)
+    with index.lock, telemetry.span("local.retrieval") as record:
+        index.sync(project_passages(user_id, project_id, proj, index))
+        results = index.search(query, RETRIEVAL_TOKEN_BUDGET, RETRIEVAL_TOP_K, accept)
+        record.update(passages=len(index), hits=len(results))
+    return [text for _, text in results]
+
+def format_passages(passages):
+    return "\n---\n".join(passages)
+
+def transcript_for_prompt(user_id, project_id, proj, model_name, query=None):
+    """プロンプトに入れる全ログ。予算内なら生ログ全文、超える場合は「要約 + 直近の生ログ」（要約は model_name で作る）。
+    要約した部分からは、query（省略時は直近のログ）に関連する箇所を生ログのまま足す"""
+    text = transcript_text(user_id, project_id, proj)
+    if estimate_tokens(text) <= TRANSCRIPT_TOKEN_BUDGET:
+        return text
+    tail_chars = int(TRANSCRIPT_TOKEN_BUDGET * TRANSCRIPT_TAIL_RATIO)
+    ends = [end for end in split_transcript(text, TRANSCRIPT_CHUNK_CHARS) if end <= len(text) - tail_chars]
+    if not ends:
+        return text
+    with st.spinner("長いログを要約しています..."):
+        digest = update_transcript_digest(proj, text, ends, model_name)
+    if digest is None:
+        return text  # 要約に失敗したときは生ログ全文で続行する
+    summarized = lambda key: key.startswith("log:") and int(key.rsplit(":", 1)[1]) <= ends[-1]
+    related = related_passages(user_id, project_id, proj, query or text[-RETRIEVAL_PASSAGE_CHARS * 2:], summarized)
+    related_text = f"（要約した部分のうち関連する箇所）\n{format_passages(related)}\n\n" if related else ""
+    return f"（これまでの要約）\n{digest}\n\n{related_text}（直近のログ）\n{text[ends[-1]:]}"
+
+# --- 右カラムの各タブ（st.fragment で個別に再実行する） ---
+# 実行中のジョブがある間だけ、STEP 1・3・4 のタブが JOB_POLL_SEC ごとに自分だけを再実行して進み具合を見る
+job_poll_sec = JOB_POLL_SEC if not HEADLESS and job_runner.active(CURRENT_USER) else None
+
+def stop_polling_when_idle():
+    """ジョブが全部終わったら画面全体を再実行し、結果の反映とポーリングの停止を行う"""
+    if job_poll_sec and not job_runner.active(CURRENT_USER):
+        st.rerun()
+
+def show_proposal_job(project_id, kind, results, labels):
+    """kind のジョブが実行中なら進み具合を表示し、終わっていれば更新案を results[project_id] に入れる"""
+    job = job_runner.latest(CURRENT_USER, project_id, kind)
+    if job and job["status"] in ("queued", "running"):
+        show_job_progress(job, labels)
+    job = take_job_result(project_id, kind)
+    if job is None: return
+    if job["error"]:
+        st.error(job["error"])
+        return
+    results[project_id] = job["result"]["proposal"]
+    if job["result"]["warning"]: st.warning(job["result"]["warning"])
+
+def dismiss_job(project_id, kind):
+    job = job_runner.latest(CURRENT_USER, project_id, kind)
+    if job: job_runner.dismiss(job["id"])
+
+@st.fragment(run_every=job_poll_sec)
+def step1_tab(proj):
+    """STEP 1（準備・予習）のタブ。ここでの操作はこのタブだけを再実行する"""
+    stop_polling_when_idle()
+    project_id = st.session_state.current_project_id
+    st.info("💡 **ここでやること**: 問い合わせメモから初期情報を整理し、戦略を立てます。")
+    tool_a_input = st.text_area("メモを入力", height=150, key="tool_a_input")
+
+    force_a = st.checkbox("🔄 キャッシュを使わず再生成", key="force_a")
+    if st.button("▶ 分析実行", key="btn_a", type="primary"):
+        if not st.session_state.api_key:
+            st.error("APIキー未設定")
+        else:
+            parser, output_format, generation_config = proposal_request(
+                ("SECTION1", "SECTION2", "SECTION3"), ("決定事項全文", "未決リスト", "戦略・トレンド・質問案"))
+            prompt = f"""
+            あなたはWebディレクターです。
+            以下のメモから情報を抽出し、以下の3つに分類して出力してください。
+
+            【入力メモ】{tool_a_input}
+            【現在のテンプレート】{proj["confirmed"]}
+
+            【指示】
+            1. テンプレートの空欄を埋める（決定事項）。
+            2. 不足情報や事務的な確認事項を抽出する（未決リスト）。
+            3. **業界トレンド、競合分析、打ち合わせ時のキラークエスチョン（戦略）** を提案する。
+
+            **マークダウン禁止。プレーンテキストのみ。**
+            {output_format}
+            """
+            current = (proj["confirmed"], proj["pending"], proj["strategy"])
+            configure_genai()
+            job_runner.submit(CURRENT_USER, project_id, "step1", run_proposal_job, st.session_state.model_high_quality,
+                              prompt, parser, current, force_a, None, generation_config)
+            st.rerun()  # ポーリングを有効にして描き直す
+
+    # 決定事項の案から順に、届いた区間をタブに表示していく
+    show_proposal_job(project_id, "step1", st.session_state.pre_res, ["決定事項 案", "未決リスト 案", "戦略・分析 案"])
+    pre_res = st.session_state.pre_res.get(project_id)
+    if pre_res and pre_res["conf"]:
+        st.success("✅ 更新案を作成しました")
+        c1, c2, c3 = st.tabs(["決定事項 案", "未決リスト 案", "戦略・分析 案"])
+        with c1:
+            new_c = st.text_area("決定事項", value=pre_res["conf"], height=400, key=f"edit_pre_c_{project_id}")
+        with c2:
+            new_p = st.text_area("未決リスト", value=pre_res["pend"], height=300, key=f"edit_pre_p_{project_id}")
+        with c3:
+            new_s = st.text_area("戦略・分析", value=pre_res["strat"], height=300, key=f"edit_pre_s_{project_id}")
+
+        if st.button("⬅️ 左側に反映", key="reflect_pre", type="primary"):
+            proj["confirmed"] = new_c
+            proj["pending"] = new_p
+            proj["strategy"] = new_s
+            mark_dirty(proj, "confirmed", "pending", "strategy")
+            st.session_state.pre_res.pop(project_id, None)
+            dismiss_job(project_id, "step1")
+            auto_save(refresh=True)
+            st.rerun()
+
+@st.fragment
+def step2_tab(proj):
+    """STEP 2（会議中サポート）のタブ。ここでの操作はこのタブだけを再実行する"""
+    project_id = st.session_state.current_project_id
+    st.info("💡 **ここでやること**: 会議ログを記録し、AIのサポートを受けます。")
+    new_log = st.text_area("会話ログ（追記）", height=100, key="log_in", placeholder="録音テキストを貼り付け")
+
+    c1, c2 = st.columns(2)
+    chk_sum = c1.checkbox("まとめ")
+    chk_iss = c2.checkbox("問題抽出")
+    chk_leak = c1.checkbox("漏れチェック")
+    chk_prop = c2.checkbox("提案作成")
+    fan_out = st.checkbox("⚡ 項目ごとに並列実行", value=True, help="チェックした項目を別々のリクエストで同時に実行し、終わったものから表示します")
+
+    if st.button("▶ AI実行", key="btn_b", type="primary"):
+        if not new_log and not transcript_text(CURRENT_USER, project_id, proj):
+            st.warning("ログがありません")
+        else:
+            if new_log:
+                append_transcript(project_id, proj, new_log)
+
+            tasks = []
+            if chk_sum: tasks.append("要約")
+            if chk_iss: tasks.append("矛盾・問題点")
+            if chk_leak: tasks.append("ヒアリング漏れ")
+            if chk_prop: tasks.append("提案")
+
+            configure_genai()
+            log_text = transcript_for_prompt(CURRENT_USER, project_id, proj, st.session_state.model_high_speed, new_log)
+
+            context = project_context(proj)
+
+            def step2_prompt(task_names):
+                task_text = "".join(f"- {name}\n" for name in task_names)
+                return f"""
+            【全ログ】{log_text}
+            【指示】{task_text}
+            **マークダウン禁止。箇条書きで簡潔に。**
+            """
+
+            content, error = None, None
+            if fan_out and len(tasks) > 1 and not st.session_state.api_key:
+                error = "APIキー未設定"
+            elif fan_out and len(tasks) > 1:
+                # 項目ごとに別リクエストで並列実行し、終わったものから表示する
+                executor = get_llm_executor()
+                slots = {name: st.empty() for name in tasks}
+                for name, slot in slots.items():
+                    slot.info(f"⏳ {name} を生成中...")
+                futures = {executor.submit(telemetry.wrap(_generate), st.session_state.model_high_speed, step2_prompt([name]), False, context): name for name in tasks}
+                outputs, errors = {}, []
+                for future in as_completed(futures):
+                    name = futures[future]
+                    text, task_error = future.result()
                     if text:
-                        conf_val = curr_proj["confirmed"]
-                        pend_val = curr_proj["pending"]
-                        strat_val = curr_proj["strategy"]
-
-                        if "===SECTION3===" in text:
-                            parts = text.split("===SECTION3===")
-                            strat_val = parts[1].strip()
-                            remain = parts[0]
-                            if "===SECTION2===" in remain:
-                                p2 = remain.split("===SECTION2===")
-                                pend_val = p2[1].strip()
-                                conf_val = p2[0].replace("===SECTION1===", "").strip()
-                        
-                        st.session_state.pre_res["conf"] = conf_val
-                        st.session_state.pre_res["pend"] = pend_val
-                        st.session_state.pre_res["strat"] = strat_val
-                    elif error: error_container.error(error)
-
-            if st.session_state.pre_res["conf"]:
-                st.success("✅ 更新案を作成しました")
-                c1, c2, c3 = st.tabs(["決定事項 案", "未決リスト 案", "戦略・分析 案"])
-                with c1:
-                    new_c = st.text_area("決定事項", value=st.session_state.pre_res["conf"], height=400, key="edit_pre_c")
-                with c2:
-                    new_p = st.text_area("未決リスト", value=st.session_state.pre_res["pend"], height=300, key="edit_pre_p")
-                with c3:
-                    new_s = st.text_area("戦略・分析", value=st.session_state.pre_res["strat"], height=300, key="edit_pre_s")
-                
-                if st.button("⬅️ 左側に反映", key="reflect_pre", type="primary"):
-                    curr_proj["confirmed"] = new_c
-                    curr_proj["pending"] = new_p
-                    curr_proj["strategy"] = new_s
-                    st.session_state.pre_res = {"conf": "", "pend": "", "strat": ""}
-                    auto_save(refresh=True)
-                    st.rerun()
-
-        # --- STEP 2 ---
-        with tab2:
-            st.info("💡 **ここでやること**: 会議ログを記録し、AIのサポートを受けます。")
-            new_log = st.text_area("会話ログ（追記）", height=100, key="log_in", placeholder="録音テキストを貼り付け")
-            
-            c1, c2 = st.columns(2)
-            chk_sum = c1.checkbox("まとめ")
-            chk_iss = c2.checkbox("問題抽出")
-            chk_leak = c1.checkbox("漏れチェック")
-            chk_prop = c2.checkbox("提案作成")
-
-            if st.button("▶ AI実行", key="btn_b", type="primary"):
-                if not new_log and not curr_proj["full_transcript"]:
-                    st.warning("ログがありません")
-                else:
-                    if new_log: curr_proj["full_transcript"] += "\n" + new_log
-                    
-                    tasks = ""
-                    if chk_sum: tasks += "- 要約\n"
-                    if chk_iss: tasks += "- 矛盾・問題点\n"
-                    if chk_leak: tasks += "- ヒアリング漏れ\n"
-                    if chk_prop: tasks += "- 提案\n"
-                    
-                    prompt = f"""
-                    【決定事項】{curr_proj["confirmed"]}
-                    【未決】{curr_proj["pending"]}
-                    【戦略】{curr_proj["strategy"]}
-                    【全ログ】{curr_proj["full_transcript"]}
-                    【指示】{tasks}
-                    **マークダウン禁止。箇条書きで簡潔に。**
-                    """
-                    
-                    with st.spinner("分析中..."):
-                        text, error = generate_with_model(model_high_speed, prompt)
-                        if text:
-                            now = datetime.datetime.now().strftime("%H:%M")
-                            unique_id = str(uuid.uuid4())
-                            curr_proj["meeting_history"].insert(0, {"id": unique_id, "time": now, "content": text})
-                            auto_save(refresh=True)
-                            st.rerun()
-                        elif error: error_container.error(error)
-
-            st.markdown("---")
-            for i, item in enumerate(curr_proj["meeting_history"]):
-                item_id = item.get("id", f"legacy_{i}")
-                with st.expander(f"出力 #{len(curr_proj['meeting_history'])-i} ({item['time']})", expanded=(i==0)):
-                    hk = f"hist_{item_id}"
-                    st.text_area("", value=item['content'], height=200, key=hk, on_change=on_history_change, args=(i, hk))
-
-        # --- STEP 3 ---
-        with tab3:
-            st.info("💡 **ここでやること**: 会議後、全ログを分析して情報を最新化します。")
-            with st.expander("全ログ確認"):
-                edited_log = st.text_area("全ログ", value=curr_proj["full_transcript"], height=200)
-                if edited_log != curr_proj["full_transcript"]:
-                    curr_proj["full_transcript"] = edited_log
-            
-            add_inst = st.text_area("追加指示", height=80)
-            
-            if "post_res" not in st.session_state: st.session_state.post_res = {"conf": "", "pend": "", "strat": ""}
-
-            if st.button("▶ 更新案を作成", key="btn_post", type="primary"):
-                if not curr_proj["full_transcript"]:
-                    st.warning("ログがありません")
+                        outputs[name] = text
+                        with slots[name].container(border=True):
+                            st.markdown(f"**{name}**")
+                            st.text(text)
+                    else:
+                        errors.append(f"{name}: {task_error}")
+                        slots[name].error(f"{name}: {task_error}")
+                if outputs:
+                    content = "\n\n".join(f"【{name}】\n{outputs[name]}" for name in tasks if name in outputs)
+                    if errors: st.toast("⚠️ 一部の項目が失敗しました: " + " / ".join(errors))
                 else:
-                    with st.spinner("全体分析中..."):
-                        prompt = f"""
-                        あなたは統括ディレクターです。
-                        【決定事項】{curr_proj["confirmed"]}
-                        【未決】{curr_proj["pending"]}
-                        【戦略】{curr_proj["strategy"]}
-                        【メモ】{curr_proj["director_memo"]}
-                        【全ログ】{curr_proj["full_transcript"]}
-                        【指示】{add_inst}
-                        1. テンプレートの空欄を埋める。2. 未定は未決へ。3. 今後の戦略を更新。
-                        **マークダウン禁止。**
-                        出力形式: ===CONFIRMED=== (全文) ===PENDING=== (未決) ===STRATEGY=== (戦略)
-                        """
-                        text, error = generate_with_model(model_high_quality, prompt)
-                        if text:
-                            conf_val = curr_proj["confirmed"]
-                            pend_val = curr_proj["pending"]
-                            strat_val = curr_proj["strategy"]
-
-                            if "===STRATEGY===" in text:
-                                parts = text.split("===STRATEGY===")
-                                strat_val = parts[1].strip()
-                                remain = parts[0]
-                                if "===PENDING===" in remain:
-                                    p2 = remain.split("===PENDING===")
-                                    pend_val = p2[1].strip()
-                                    conf_val = p2[0].replace("===CONFIRMED===", "").strip()
-                            
-                            st.session_state.post_res["conf"] = conf_val
-                            st.session_state.post_res["pend"] = pend_val
-                            st.session_state.post_res["strat"] = strat_val
-                        elif error: error_container.error(error)
-
-            if st.session_state.post_res["conf"]:
-                st.success("✅ 更新案を作成しました")
-                c1, c2, c3 = st.tabs(["決定事項 案", "未決リスト 案", "戦略 案"])
-                with c1:
-                    new_c = st.text_area("決定事項 案", value=st.session_state.post_res["conf"], height=400, key="edit_post_c")
-                with c2:
-                    new_p = st.text_area("未決リスト 案", value=st.session_state.post_res["pend"], height=300, key="edit_post_p")
-                with c3:
-                    new_s = st.text_area("戦略 案", value=st.session_state.post_res["strat"], height=200, key="edit_post_s")
-                
-                if st.button("⬅️ 左側に反映", key="reflect_post", type="primary"):
-                    curr_proj["confirmed"] = new_c
-                    curr_proj["pending"] = new_p
-                    curr_proj["strategy"] = new_s
-                    st.session_state.post_res = {"conf": "", "pend": "", "strat": ""}
-                    auto_save(refresh=True)
-                    st.rerun()
-
-        # --- STEP 4 ---
-        with tab4:
-            st.info("💡 **ここでやること**: 最終的な指示書を出力します。")
-            if st.button("▶ 指示書出力", key="btn_final", type="primary"):
-                 with st.spinner("作成中..."):
-                    prompt = f"""
-                    以下の情報からデザイナーへの指示書を作成してください。
-                    【決定事項】{curr_proj["confirmed"]}
-                    【戦略】{curr_proj["strategy"]}
-                    【メモ】{curr_proj["director_memo"]}
-                    **マークダウン禁止。プレーンテキストで。**
-                    """
-                    text, error = generate_with_model(model_high_quality, prompt)
-                    if text: st.text_area("指示書", value=text, height=600)
-                    elif error: error_container.error(error)
-
-        # --- AI相談 ---
-        with tab5:
-            st.info("💡 **ここでやること**: フリーチャットで相談できます。")
-            chat_c = st.container()
-            with chat_c:
-                for msg in curr_proj["chat_history"]:
-                    with st.chat_message(msg["role"]): st.write(msg["text"])
-
-            if u_in := st.chat_input("質問..."):
-                curr_proj["chat_history"].append({"role": "user", "text": u_in})
-                with chat_c:
-                    with st.chat_message("user"): st.write(u_in)
-                
-                hist = "\n".join(curr_proj["chat_context"][-5:])
-                prompt = f"""
-                【状況】{curr_proj["confirmed"]}
-                【未決】{curr_proj["pending"]}
-                【戦略】{curr_proj["strategy"]}
-                【メモ】{curr_proj["director_memo"]}
-                【履歴】{hist}
-                User: {u_in}
-                **マークダウン禁止。**
-                """
-                with chat_c:
-                    with st.chat_message("assistant"):
-                        with st.spinner("..."):
-                            text, error = generate_with_model(model_high_speed, prompt)
-                            if text: st.write(text)
-                            elif error: st.error(error)
-                
-                if text:
-                    curr_proj["chat_history"].append({"role": "assistant", "text": text})
-                    curr_proj["chat_context"].append(f"AI: {text}")
-                    auto_save(refresh=False)
+                    error = " / ".join(errors)
+            else:
+                # 生成中のテキストを逐次表示し、完了した全文だけを履歴に保存する
+                result = {}
+                with st.container(border=True):
+                    st.write_stream(stream_with_model(st.session_state.model_high_speed, step2_prompt(tasks), result, context=context))
+                content, error = result["text"], result["error"]
+
+            if not error:
+                now = datetime.datetime.now().strftime("%H:%M")
+                unique_id = str(uuid.uuid4())
+                proj["meeting_history"].insert(0, {"id": unique_id, "time": now, "content": content})
+                mark_dirty(proj, "meeting_history")
+                auto_save(refresh=False)
+            if not error or new_log:
+                # 追記した全ログを STEP 3 の欄にも出すため、画面全体を再実行する
+                if error: st.toast(f"⚠️ {error}")
+                st.rerun()
+            st.error(error)
+
+    st.markdown("---")
+    # 新しい順に HISTORY_PAGE_SIZE 件ずつ表示する。退避済みの分は読み取り専用
+    body_count, archived, has_more = history_window(project_id, "meeting_history", proj)
+    total = len(proj["meeting_history"]) + proj.get("history_archived", {}).get("meeting_history", 0)
+    for i, item in enumerate(proj["meeting_history"][:body_count]):
+        item_id = item.get("id", f"legacy_{i}")
+        with st.expander(f"出力 #{total-i} ({item['time']})", expanded=(i==0)):
+            hk = f"hist_{item_id}"
+            st.text_area("", value=item['content'], height=200, key=hk, on_change=on_history_change, args=(proj, i, hk))
+    for j, item in enumerate(archived):
+        with st.expander(f"出力 #{total-body_count-j} ({item['time']}・過去分)"):
+            st.text(item["content"])
+    if has_more:
+        st.button("さらに表示", key="more_meeting_history", on_click=show_more_history, args=(project_id, "meeting_history"))
+
+@st.fragment(run_every=job_poll_sec)
+def step3_tab(proj):
+    """STEP 3（会議後まとめ）のタブ。ここでの操作はこのタブだけを再実行する"""
+    stop_polling_when_idle()
+    project_id = st.session_state.current_project_id
+    st.info("💡 **ここでやること**: 会議後、全ログを分析して情報を最新化します。")
+    with st.expander("全ログ確認"):
+        full_log = transcript_text(CURRENT_USER, project_id, proj)
+        # ログが変わったら（STEP 2 で追記したときなど）作り直し、古い内容への編集で上書きしない
+        edited_log = st.text_area("全ログ", value=full_log, height=200, key=f"full_log_{project_id}_{_text_hash(full_log)[:12]}")
+        if edited_log != full_log:
+            replace_transcript(project_id, proj, edited_log)
+
+    add_inst = st.text_area("追加指示", height=80)
+
+    force_post = st.checkbox("🔄 キャッシュを使わず再生成", key="force_post")
+    if st.button("▶ 更新案を作成", key="btn_post", type="primary"):
+        if not transcript_text(CURRENT_USER, project_id, proj):
+            st.warning("ログがありません")
+        elif not st.session_state.api_key:
+            st.error("APIキー未設定")
+        else:
+            configure_genai()
+            log_text = transcript_for_prompt(CURRENT_USER, project_id, proj, st.session_state.model_high_speed,
+                                             f"{add_inst}\n{proj['pending']}")
+            parser, prompt, generation_config = post_meeting_request(log_text, add_inst)
+            current = (proj["confirmed"], proj["pending"], proj["strategy"])
+            job_runner.submit(CURRENT_USER, project_id, "step3", run_proposal_job, st.session_state.model_high_quality,
+                              prompt, parser, current, force_post, project_context(proj), generation_config)
+            st.rerun()  # ポーリングを有効にして描き直す
+
+    show_proposal_job(project_id, "step3", st.session_state.post_res, ["決定事項 案", "未決リスト 案", "戦略 案"])
+    post_res = st.session_state.post_res.get(project_id)
+    if post_res and post_res["conf"]:
+        st.success("✅ 更新案を作成しました")
+        c1, c2, c3 = st.tabs(["決定事項 案", "未決リスト 案", "戦略 案"])
+        with c1:
+            new_c = st.text_area("決定事項 案", value=post_res["conf"], height=400, key=f"edit_post_c_{project_id}")
+        with c2:
+            new_p = st.text_area("未決リスト 案", value=post_res["pend"], height=300, key=f"edit_post_p_{project_id}")
+        with c3:
+            new_s = st.text_area("戦略 案", value=post_res["strat"], height=200, key=f"edit_post_s_{project_id}")
+
+        if st.button("⬅️ 左側に反映", key="reflect_post", type="primary"):
+            proj["confirmed"] = new_c
+            proj["pending"] = new_p
+            proj["strategy"] = new_s
+            mark_dirty(proj, "confirmed", "pending", "strategy")
+            st.session_state.post_res.pop(project_id, None)
+            dismiss_job(project_id, "step3")
+            auto_save(refresh=True)
+            st.rerun()
+
+@st.fragment(run_every=job_poll_sec)
+def step4_tab(proj):
+    """STEP 4（指示書作成）のタブ。ここでの操作はこのタブだけを再実行する"""
+    stop_polling_when_idle()
+    project_id = st.session_state.current_project_id
+    st.info("💡 **ここでやること**: 最終的な指示書を出力します。")
+    force_final = st.checkbox("🔄 キャッシュを使わず再生成", key="force_final")
+    if st.button("▶ 指示書出力", key="btn_final", type="primary"):
+        if not st.session_state.api_key:
+            st.error("APIキー未設定")
+        else:
+            configure_genai()
+            job_runner.submit(CURRENT_USER, project_id, "step4", run_generate_job, st.session_state.model_high_quality,
+                              INSTRUCTION_PROMPT, force_final, project_context(proj), st.session_state.model_high_speed)
+            st.rerun()  # ポーリングを有効にして描き直す
+
+    job = job_runner.latest(CURRENT_USER, project_id, "step4")
+    if job and job["status"] in ("queued", "running"):
+        show_job_progress(job)
+    job = take_job_result(project_id, "step4")
+    if job and job["error"]:
+        st.error(job["error"])
+    elif job:
+        st.session_state.final_res[project_id] = job["result"]["text"]
+        if job["result"]["model"] != st.session_state.model_high_quality:
+            st.toast(f"⚡ {st.session_state.model_high_quality} の応答が遅いため、{job['result']['model']} の結果を表示しています")
+    if st.session_state.final_res.get(project_id):
+        st.text_area("指示書", value=st.session_state.final_res[project_id], height=600, key=f"final_{project_id}")
+    elif proj.get("instruction_book", {}).get("text"):
+        # batch.py でまとめて作った指示書
+        st.caption(f"一括生成した指示書（{proj['instruction_book']['at']}）")
+        st.text_area("指示書", value=proj["instruction_book"]["text"], height=600, key=f"final_batch_{project_id}")
+
+@st.fragment
+def chat_tab(proj):
+    """AI相談のタブ。ここでの操作はこのタブだけを再実行する"""
+    st.info("💡 **ここでやること**: フリーチャットで相談できます。")
+    project_id = st.session_state.current_project_id
+    body_count, archived, has_more = history_window(project_id, "chat_history", proj)
+    if has_more:
+        st.button("過去のメッセージを表示", key="more_chat_history", on_click=show_more_history, args=(project_id, "chat_history"))
+    chat_c = st.container()
+    with chat_c:
+        # 古い順に表示する（退避済みの分 → 本文の直近の分）
+        for msg in reversed(archived):
+            with st.chat_message(msg["role"]): st.write(msg["text"])
+        for msg in proj["chat_history"][-body_count:] if body_count else []:
+            with st.chat_message(msg["role"]): st.write(msg["text"])
+
+    if u_in := st.chat_input("質問..."):
+        proj["chat_history"].append({"role": "user", "text": u_in})
+        with chat_c:
+            with st.chat_message("user"): st.write(u_in)
+
+        hist = "\n".join(proj["chat_context"][-CHAT_CONTEXT_TURNS:])
+        # 直近のやり取り（今の質問を含む）は【履歴】にあるので、それより前の記録と全ログから探す
+        recent = {history_passage_key("chat_history", _history_passage_text("chat_history", m))
+                  for m in proj["chat_history"][-CHAT_CONTEXT_TURNS * 2:]}
+        related = related_passages(CURRENT_USER, project_id, proj, u_in, lambda key: key.rsplit(":", 1)[0] not in recent)
+        prompt = f"""
+        【関連する過去の記録】{format_passages(related) or "（なし）"}
+        【履歴】{hist}
+        User: {u_in}
+        **マークダウン禁止。**
+        """
+        with chat_c:
+            with st.chat_message("assistant"):
+                result = {}
+                st.write_stream(stream_with_model(st.session_state.model_high_speed, prompt, result, context=project_context(proj)))
+                text = result["text"] if not result["error"] else None
+                if result["error"]: st.error(result["error"])
+
+        if text:
+            proj["chat_history"].append({"role": "assistant", "text": text})
+            proj["chat_context"].append(f"AI: {text}")
+            mark_dirty(proj, "chat_history", "chat_context")
+            auto_save(refresh=False)
+
+if not HEADLESS:
+    with right_col:
+        with st.container(border=True):
+            st.subheader("🤖 AI作業スペース")
+        
+            tab1, tab2, tab3, tab4, tab5 = st.tabs([
+                "STEP 1: 準備・予習", 
+                "STEP 2: 会議中サポート", 
+                "STEP 3: 会議後まとめ", 
+                "STEP 4: 指示書作成", 
+                "💬 AI相談"
+            ])
+
+            with tab1:
+                step1_tab(curr_proj)
+            with tab2:
+                step2_tab(curr_proj)
+            with tab3:
+                step3_tab(curr_proj)
+            with tab4:
+                step4_tab(curr_proj)
+            with tab5:
+                chat_tab(curr_proj)
+
+# ==========================================
+# 7. 計測パネル（この実行で行った呼び出しまで集計するため最後に描画する）
+# ==========================================
+if not HEADLESS:
+    with st.sidebar:
+        with st.expander("📊 パフォーマンス計測"):
+            telemetry_rows = telemetry.summary(st.session_state.telemetry_session, st.session_state.telemetry_run)
+            if telemetry_rows:
+                st.dataframe(telemetry_rows, hide_index=True)
+                for model_name, (count, p50, p95) in model_router.stats().items():
+                    if p50 is not None:
+                        st.caption(f"{model_name}: 直近{count}件 p50 {p50:.1f}秒 / p95 {p95:.1f}秒")
+                st.caption("今回 = この再実行での呼び出し回数。保存キューの書き込みは実行されたタイミングで計上されます")
+            else:
+                st.caption("まだ記録がありません")
@@ -0,0 +1,283 @@
+"""STEP 3（会議後まとめ）・STEP 4（指示書）を、画面を使わずに多数のプロジェクトへまとめて実行する。
+
+app.py を import して、保存先（STORAGE_BACKEND）・AI 呼び出し（流量制御・再試行・応答キャッシュ）・
+プロンプトを画面と同じものを使う。設定は画面と同じ .streamlit/secrets.toml から読む。
+結果はプロジェクトごとに終わった順でチェックポイントに残し、ユーザーごとにまとめて書き戻す。
+
+    python batch.py                                      # 全ユーザー・全プロジェクトの STEP 3 → STEP 4
+    python batch.py --users wada --projects "株式会社*" --steps step4
+    python batch.py --checkpoint batch_state.jsonl       # 中断したら同じコマンドで続きから
+    python batch.py --dry-run --json batch_report.json   # プロジェクトには書き込まない
+"""
+import argparse
+import datetime
+import fnmatch
+import json
+import os
+import statistics
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import streamlit as st
+from streamlit import logger
+
+# bare mode の警告（ScriptRunContext が無いなど）で出力が流れないようにする
+logger.set_log_level("error")
+import app
+
+STEPS = ("step3", "step4")
+TELEMETRY_SESSION = "batch"
+
+
+class Checkpoint:
+    """終わった処理を JSONL に1行ずつ残す。同じファイルで再実行すると、結果のある処理は生成し直さず、
+    書き戻し済みの処理は飛ばす"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self.results = {}     # (user_id, project_id, kind) -> 結果
+        self.applied = set()  # 書き戻し済みの (user_id, project_id, kind)
+        if not path or not os.path.exists(path):
+            return
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # 書き込みの途中で止まった行
+                key = (record["user"], record["project"], record["kind"])
+                if record.get("applied"):
+                    self.applied.add(key)
+                elif "result" in record:
+                    self.results[key] = record["result"]
+
+    def _write(self, record):
+        if not self.path:
+            return
+        record["at"] = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        with self._lock, open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def add_result(self, user_id, project_id, kind, result):
+        self.results[(user_id, project_id, kind)] = result
+        self._write({"user": user_id, "project": project_id, "kind": kind, "result": result})
+
+    def mark_applied(self, user_id, project_id, kinds):
+        for kind in kinds:
+            self.applied.add((user_id, project_id, kind))
+            self._write({"user": user_id, "project": project_id, "kind": kind, "applied": True})
+
+
+def run_step3(user_id, project_id, proj, args):
+    """更新案 {"proposal": {...}, "warning": ...} を返す。ログが無ければ None"""
+    if not app.transcript_text(user_id, project_id, proj):
+        return None
+    log_text = app.transcript_for_prompt(user_id, project_id, proj, args.speed_model,
+                                         f"{args.instruction}\n{proj['pending']}")
+    parser, prompt, generation_config = app.post_meeting_request(log_text, args.instruction)
+    current = (proj["confirmed"], proj["pending"], proj["strategy"])
+    return app.run_proposal_job({}, args.model, prompt, parser, current, args.force,
+                                app.project_context(proj), generation_config)
+
+
+def run_step4(user_id, project_id, proj, args):
+    """指示書 {"text": ..., "model": ...} を返す"""
+    return app.run_generate_job({}, args.model, app.INSTRUCTION_PROMPT, args.force,
+                                app.project_context(proj), args.speed_model)
+
+
+STEP_RUNNERS = {"step3": run_step3, "step4": run_step4}
+
+
+def review_result(kind, result):
+    """人が確かめずに書き戻してはいけない結果なら、その理由を返す。
+    画面では案を見てから「左側に反映」するが、バッチはそのまま本番のデータを書き換えるため、
+    区切りが読めなかった・項目が欠けていた STEP 3 の案は反映しない"""
+    if kind == "step3":
+        return result.get("warning")
+    return None
+
+
+def apply_result(proj, kind, result):
+    """結果をプロジェクトに反映する（画面の「左側に反映」と同じ項目を書き換える）"""
+    if kind == "step3":
+        proposal = result["proposal"]
+        proj["confirmed"], proj["pending"], proj["strategy"] = proposal["conf"], proposal["pend"], proposal["strat"]
+        app.mark_dirty(proj, "confirmed", "pending", "strategy")
+    else:
+        at = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        proj["instruction_book"] = {"text": result["text"], "model": result["model"], "at": at}
+        app.mark_dirty(proj, "instruction_book")
+
+
+def run_project(user_id, project_id, steps, args, checkpoint):
+    """1プロジェクト分の STEP を順に実行する。STEP 3 の案は反映してから STEP 4 の前提に使う。
+    (プロジェクト, 反映した STEP, [{"kind", "status", "sec", "error"}...]) を返す"""
+    try:
+        # 読み込み・復元に失敗した本文は書き戻さない（空の履歴などで上書きしてしまう）
+        proj = app.db.get_project(user_id, project_id, strict=True)
+        error = None if proj is not None else "見つかりません"
+    except Exception as e:
+        proj, error = None, f"読み込めません: {e}"
+    if proj is None:
+        return None, [], [{"kind": kind, "status": "error", "sec": 0.0, "error": error} for kind in steps]
+    applied, outcomes = [], []
+    for kind in steps:
+        key = (user_id, project_id, kind)
+        if key in checkpoint.applied:
+            outcomes.append({"kind": kind, "status": "applied", "sec": 0.0, "error": None})
+            continue
+        started = time.perf_counter()
+        result, status = checkpoint.results.get(key), "resumed"
+        if result is None:
+            try:
+                result = STEP_RUNNERS[kind](user_id, project_id, proj, args)
+            except Exception as e:
+                outcomes.append({"kind": kind, "status": "error", "sec": time.perf_counter() - started, "error": str(e)})
+                break  # 後の STEP はこの結果を前提にするので進めない
+            if result is None:
+                outcomes.append({"kind": kind, "status": "skipped", "sec": 0.0, "error": None})
+                continue
+            status = "done"
+        reason = review_result(kind, result)
+        if reason:
+            # チェックポイントにも残さず、次の実行で生成し直す（同じ出力を避けるなら --force で応答キャッシュを使わない）
+            outcomes.append({"kind": kind, "status": "review", "sec": time.perf_counter() - started, "error": reason})
+            break
+        if status == "done": checkpoint.add_result(*key, result)
+        outcomes.append({"kind": kind, "status": status, "sec": time.perf_counter() - started, "error": None})
+        apply_result(proj, kind, result)
+        applied.append(kind)
+    return proj, applied, outcomes
+
+
+def write_back(user_id, updated, checkpoint):
+    """反映したプロジェクトを保存キューに積み、まとめて送り切ってから書き戻し済みを記録する"""
+    for project_id, (proj, _) in updated.items():
+        app.save_queue.submit_project(app.db, user_id, project_id, proj, set(proj["_dirty"]))
+    ok = app.save_queue.flush(user_id, timeout=300)
+    if isinstance(app.db, app.ReplicatedStore):
+        ok = app.db.flush(timeout=300) and ok
+    if ok:
+        for project_id, (_, kinds) in updated.items():
+            checkpoint.mark_applied(user_id, project_id, kinds)
+    return ok
+
+
+def select_projects(index, patterns):
+    if not patterns:
+        return list(index)
+    return [pid for pid in index if any(fnmatch.fnmatchcase(pid, p) for p in patterns)]
+
+
+def run_user(user_id, args, checkpoint, outcomes):
+    """1ユーザー分を args.concurrency 並列で実行して書き戻す。genai の API キーはプロセス共通なのでユーザーごとに設定する"""
+    (saved_key, _), index = app.db.get_login_data(user_id)
+    api_key = args.api_key or st.secrets.get("GEMINI_API_KEY", "") or saved_key
+    if not api_key:
+        print(f"[{user_id}] APIキー未設定のため飛ばします")
+        return
+    app.configure_genai(api_key)
+    project_ids = select_projects(index, args.projects)
+    print(f"[{user_id}] {len(project_ids)}件")
+
+    updated = {}
+    with ThreadPoolExecutor(max_workers=args.concurrency, thread_name_prefix="batch") as executor:
+        futures = {executor.submit(app.telemetry.wrap(run_project), user_id, pid, args.steps, args, checkpoint): pid
+                   for pid in project_ids}
+        for future in as_completed(futures):
+            project_id = futures[future]
+            proj, applied, project_outcomes = future.result()
+            for outcome in project_outcomes:
+                outcomes.append({"user": user_id, "project": project_id, **outcome})
+                if outcome["error"]:
+                    print(f"  ✗ {project_id} {outcome['kind']}: {outcome['error']}")
+            if applied:
+                updated[project_id] = (proj, applied)
+            done = [o["kind"] for o in project_outcomes if o["status"] == "done"]
+            if done:
+                print(f"  ✓ {project_id} ({', '.join(done)})")
+
+    if updated and not args.dry_run:
+        if not write_back(user_id, updated, checkpoint):
+            print(f"[{user_id}] 一部の書き戻しが完了していません（再実行すると続きから書き戻します）")
+
+
+def _percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def report(outcomes, elapsed):
+    """STEP ごとの件数・所要時間と、全体のスループット・バックエンド呼び出しの内訳を表示する"""
+    by_kind = defaultdict(list)
+    for o in outcomes:
+        by_kind[o["kind"]].append(o)
+    print(f"\n{'STEP':<8}{'done':>6}{'resumed':>9}{'skipped':>9}{'applied':>9}{'review':>8}{'errors':>8}{'p50 s':>8}{'p95 s':>8}")
+    for kind in STEPS:
+        rows = by_kind.get(kind)
+        if not rows:
+            continue
+        counts = Counter(o["status"] for o in rows)
+        secs = [o["sec"] for o in rows if o["status"] == "done"]
+        p50 = f"{statistics.median(secs):.1f}" if secs else "-"
+        p95 = f"{_percentile(secs, 0.95):.1f}" if secs else "-"
+        print(f"{kind:<8}{counts['done']:>6}{counts['resumed']:>9}{counts['skipped']:>9}{counts['applied']:>9}"
+              f"{counts['review']:>8}{counts['error']:>8}{p50:>8}{p95:>8}")
+
+    review = [o for o in outcomes if o["status"] == "review"]
+    if review:
+        print("\n反映しなかったプロジェクト（画面で確認してください）:")
+        for o in review:
+            print(f"  {o['user']}/{o['project']} {o['kind']}: {o['error']}")
+
+    projects = {(o["user"], o["project"]) for o in outcomes}
+    generated = sum(o["status"] == "done" for o in outcomes)
+    per_min = generated / elapsed * 60 if elapsed else 0.0
+    print(f"\n{len(projects)}プロジェクト / 生成 {generated}件 / {elapsed:.1f}秒（{per_min:.1f}件/分）")
+
+    rows = app.telemetry.summary(TELEMETRY_SESSION, 1)
+    if rows:
+        print("\nバックエンド呼び出しの内訳:")
+        for row in rows:
+            print(f"  {row['呼び出し']:<28}{row['累計']:>6}  p50 {row['p50 ms']:>8.0f} ms  "
+                  f"エラー {row['エラー']}  再試行 {row['再試行']}  トークン {row['トークン']}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", nargs="+", default=app.ALLOWED_USERS, help="対象のユーザー")
+    parser.add_argument("--projects", nargs="+", help="対象のプロジェクト名（ワイルドカード可）。省略時は全件")
+    parser.add_argument("--steps", nargs="+", choices=STEPS, default=list(STEPS), help="実行する STEP（この順に実行する）")
+    parser.add_argument("--concurrency", type=int, default=app.JOB_MAX_WORKERS, help="同時に処理するプロジェクト数")
+    parser.add_argument("--model", default=app.model_high_quality, help="生成に使うモデル")
+    parser.add_argument("--speed-model", default=app.model_high_speed, help="ログの要約・ヘッジに使うモデル")
+    parser.add_argument("--instruction", default="", help="STEP 3 の追加指示")
+    parser.add_argument("--api-key", default="", help="省略時は GEMINI_API_KEY、無ければ各ユーザーの保存済みのキー")
+    parser.add_argument("--force", action="store_true", help="応答キャッシュを使わずに生成し直す")
+    parser.add_argument("--checkpoint", default="batch_checkpoint.jsonl", help="途中経過を残すファイル（空文字で残さない）")
+    parser.add_argument("--dry-run", action="store_true", help="プロジェクトには書き戻さない（結果はチェックポイントにだけ残る）")
+    parser.add_argument("--json", help="処理ごとの結果を書き出す JSON ファイル")
+    args = parser.parse_args(argv)
+    args.steps = [kind for kind in STEPS if kind in args.steps]
+    args.concurrency = max(1, args.concurrency)
+
+    checkpoint = Checkpoint(args.checkpoint)
+    app.telemetry.bind(TELEMETRY_SESSION, 1)
+    outcomes = []
+    started = time.perf_counter()
+    for user_id in args.users:
+        run_user(user_id, args, checkpoint, outcomes)
+    elapsed = time.perf_counter() - started
+
+    report(outcomes, elapsed)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"args": {k: v for k, v in vars(args).items() if k != "api_key"}, "elapsed_sec": elapsed, "outcomes": outcomes}, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1 @@
+"""app.py のオフライン・ベンチマーク（偽 Sheets / Gemini + Streamlit AppTest）"""
@@ -0,0 +1,468 @@
+"""gspread / oauth2client / google.generativeai のプロセス内スタンドイン。
+
+install() を呼ぶと sys.modules に偽モジュールが登録され、その後に実行される app.py
+（AppTest 経由を含む）は本物の代わりにこれらを使う。全セッションで1つの偽スプレッドシートを共有し、
+遅延・クォータエラー・応答サイズを FakeConfig で調整できる。呼び出し回数は BACKEND.counts に数える。
+"""
+import json
+import re
+import sys
+import time
+import types
+import uuid
+import threading
+from collections import Counter
+
+
+class FakeConfig:
+    def __init__(self, sheets_latency=0.05, gemini_latency=None, quota_every=0, response_chars=800,
+                 cache_min_tokens=2048):
+        self.sheets_latency = sheets_latency
+        # モデル名に含まれる文字列 → 応答までの秒数
+        self.gemini_latency = gemini_latency or {"pro": 1.5, "flash": 0.3}
+        self.quota_every = quota_every  # N 回に1回 429 を返す（0 なら返さない）
+        self.response_chars = response_chars
+        self.cache_min_tokens = cache_min_tokens
+
+
+class QuotaError(Exception):
+    pass
+
+
+class FakeBackend:
+    """共有状態（シートの中身・キャッシュ済みコンテンツ）と呼び出しの計数"""
+
+    def __init__(self, config=None):
+        self.config = config or FakeConfig()
+        self.lock = threading.RLock()
+        self.counts = Counter()
+        self.last_call = 0.0
+        self.spreadsheets = {}  # name -> {title: FakeWorksheet}
+        self.cached_contents = {}
+
+    def call(self, name, latency):
+        with self.lock:
+            self.counts[name] += 1
+            family = name.split(".")[0]
+            self.counts[family] += 1
+            n = self.counts[family]
+            self.last_call = time.monotonic()
+        if latency:
+            time.sleep(latency)
+        if self.config.quota_every and n % self.config.quota_every == 0:
+            if family == "sheets":
+                raise APIError(f"APIError: [429]: Quota exceeded for quota metric 'Write requests' ({name})")
+            raise QuotaError(f"429 Resource has been exhausted (e.g. check quota). ({name})")
+
+    def snapshot(self):
+        with self.lock:
+            return Counter(self.counts)
+
+    def wait_idle(self, quiet=0.3, timeout=15):
+        """裏スレッド（保存キューなど）の呼び出しが quiet 秒止まるまで待つ"""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            with self.lock:
+                idle = time.monotonic() - self.last_call
+            if idle >= quiet:
+                return True
+            time.sleep(quiet - idle)
+        return False
+
+    def reset(self, config=None):
+        with self.lock:
+            if config is not None:
+                self.config = config
+            self.counts.clear()
+            self.spreadsheets.clear()
+            self.cached_contents.clear()
+
+
+BACKEND = FakeBackend()
+
+
+# ==========================================
+# gspread
+# ==========================================
+class APIError(Exception):
+    pass
+
+
+class WorksheetNotFound(Exception):
+    pass
+
+
+class CellNotFound(Exception):
+    pass
+
+
+def _col_index(letters):
+    n = 0
+    for ch in letters:
+        n = n * 26 + ord(ch) - 64
+    return n
+
+
+def _col_letters(n):
+    letters = ""
+    while n:
+        n, rem = divmod(n - 1, 26)
+        letters = chr(65 + rem) + letters
+    return letters
+
+
+def _parse_range(label):
+    """'A5:H5' / 'A2:A' / "'user'!B3" を ((行, 列), (行|None, 列)) にする"""
+    label = label.split("!")[-1]
+    start, _, end = label.partition(":")
+    m1 = re.fullmatch(r"([A-Z]+)(\d*)", start)
+    r1 = int(m1.group(2)) if m1.group(2) else 1
+    c1 = _col_index(m1.group(1))
+    if not end:
+        return (r1, c1), (r1 if m1.group(2) else None, c1)
+    m2 = re.fullmatch(r"([A-Z]+)(\d*)", end)
+    r2 = int(m2.group(2)) if m2.group(2) else None
+    return (r1, c1), (r2, _col_index(m2.group(1)))
+
+
+class FakeCell:
+    def __init__(self, row, col, value):
+        self.row, self.col, self.value = row, col, value
+
+
+class FakeWorksheet:
+    def __init__(self, title, rows=100, cols=26):
+        self.title = title
+        self._rows = []
+        self._col_count = cols
+        self._row_count = rows
+
+    @property
+    def col_count(self):
+        return self._col_count
+
+    def _call(self, name):
+        BACKEND.call(f"sheets.{name}", BACKEND.config.sheets_latency)
+
+    def _last_row(self):
+        for i in range(len(self._rows), 0, -1):
+            if any(v not in ("", None) for v in self._rows[i - 1]):
+                return i
+        return 0
+
+    def _get(self, row, col):
+        if row - 1 < len(self._rows) and col - 1 < len(self._rows[row - 1]):
+            return self._rows[row - 1][col - 1]
+        return ""
+
+    def _set(self, row, col, value):
+        while len(self._rows) < row:
+            self._rows.append([])
+        line = self._rows[row - 1]
+        while len(line) < col:
+            line.append("")
+        line[col - 1] = "" if value is None else value
+        self._col_count = max(self._col_count, col)
+
+    def _write(self, range_name, values):
+        (row, col), _ = _parse_range(range_name)
+        for i, line in enumerate(values):
+            for j, value in enumerate(line):
+                self._set(row + i, col + j, value)
+
+    @staticmethod
+    def _trim(values):
+        while values and values[-1] in ("", None):
+            values.pop()
+        return values
+
+    def _read(self, range_name):
+        (r1, c1), (r2, c2) = _parse_range(range_name)
+        r2 = r2 or self._last_row()
+        rows = [self._trim([self._get(r, c) for c in range(c1, c2 + 1)]) for r in range(r1, r2 + 1)]
+        while rows and not rows[-1]:
+            rows.pop()
+        return rows
+
+    # --- gspread.Worksheet 互換 ---
+    def row_values(self, row):
+        self._call("row_values")
+        return self._trim(list(self._rows[row - 1])) if row - 1 < len(self._rows) else []
+
+    def col_values(self, col):
+        self._call("col_values")
+        return self._trim([self._get(r, col) for r in range(1, self._last_row() + 1)])
+
+    def acell(self, label):
+        self._call("acell")
+        (row, col), _ = _parse_range(label)
+        return FakeCell(row, col, self._get(row, col))
+
+    def find(self, query, in_column=None):
+        self._call("find")
+        for r in range(1, self._last_row() + 1):
+            cols = [in_column] if in_column else range(1, len(self._rows[r - 1]) + 1)
+            for c in cols:
+                if str(self._get(r, c)) == query:
+                    return FakeCell(r, c, query)
+        return None
+
+    def get_all_values(self):
+        self._call("get_all_values")
+        width = max((len(r) for r in self._rows), default=0)
+        return [list(r) + [""] * (width - len(r)) for r in self._rows[:self._last_row()]]
+
+    def get_all_records(self):
+        self._call("get_all_records")
+        if not self._rows:
+            return []
+        headers = self._rows[0]
+        return [
+            {h: (row[i] if i < len(row) else "") for i, h in enumerate(headers)}
+            for row in self._rows[1:self._last_row()]
+        ]
+
+    def batch_get(self, ranges):
+        self._call("batch_get")
+        return [self._read(r) for r in ranges]
+
+    def update(self, *args, range_name=None, values=None, **kwargs):
+        self._call("update")
+        if args:
+            if isinstance(args[0], str):
+                range_name = args[0]
+                values = args[1] if len(args) > 1 else values
+            else:
+                values = args[0]
+                range_name = args[1] if len(args) > 1 else range_name
+        self._write(range_name or "A1", values)
+        return {"updatedRange": f"'{self.title}'!{range_name}"}
+
+    def update_cell(self, row, col, value):
+        self._call("update_cell")
+        self._set(row, col, value)
+
+    def batch_update(self, data, **kwargs):
+        self._call("batch_update")
+        for item in data:
+            self._write(item["range"], item["values"])
+
+    def append_row(self, values, **kwargs):
+        self._call("append_row")
+        row = self._last_row() + 1
+        for j, value in enumerate(values):
+            self._set(row, j + 1, value)
+        return {"updates": {"updatedRange": f"'{self.title}'!A{row}:{_col_letters(max(1, len(values)))}{row}"}}
+
+    def append_rows(self, values, **kwargs):
+        self._call("append_rows")
+        first = self._last_row() + 1
+        for i, row_values in enumerate(values):
+            for j, value in enumerate(row_values):
+                self._set(first + i, j + 1, value)
+        width = max([1] + [len(r) for r in values])
+        return {"updates": {"updatedRange": f"'{self.title}'!A{first}:{_col_letters(width)}{first + len(values) - 1}"}}
+
+    def resize(self, rows=None, cols=None):
+        self._call("resize")
+        if cols:
+            self._col_count = cols
+        if rows:
+            self._row_count = rows
+
+    def add_cols(self, cols):
+        self._call("add_cols")
+        self._col_count += cols
+
+
+class FakeSpreadsheet:
+    def __init__(self, name):
+        self.name = name
+        with BACKEND.lock:
+            self._sheets = BACKEND.spreadsheets.setdefault(name, {})
+
+    def worksheet(self, title):
+        BACKEND.call("sheets.worksheet", BACKEND.config.sheets_latency)
+        with BACKEND.lock:
+            if title not in self._sheets:
+                raise WorksheetNotFound(title)
+            return self._sheets[title]
+
+    def add_worksheet(self, title, rows=100, cols=26):
+        BACKEND.call("sheets.add_worksheet", BACKEND.config.sheets_latency)
+        with BACKEND.lock:
+            ws = self._sheets.setdefault(title, FakeWorksheet(title, rows, cols))
+        return ws
+
+    def values_batch_get(self, ranges, params=None):
+        BACKEND.call("sheets.values_batch_get", BACKEND.config.sheets_latency)
+        value_ranges = []
+        for r in ranges:
+            title = r.split("!")[0].strip("'") if "!" in r else next(iter(self._sheets), "")
+            ws = self._sheets.get(title)
+            values = ws._read(r) if ws else []
+            value_ranges.append({"range": r, "values": values})
+        return {"valueRanges": value_ranges}
+
+
+class FakeClient:
+    def open(self, name):
+        BACKEND.call("sheets.open", BACKEND.config.sheets_latency)
+        return FakeSpreadsheet(name)
+
+
+def authorize(credentials):
+    BACKEND.call("sheets.authorize", 0)
+    return FakeClient()
+
+
+class FakeCredentials:
+    @classmethod
+    def from_json_keyfile_dict(cls, keyfile_dict, scopes=None):
+        return cls()
+
+
+# ==========================================
+# google.generativeai
+# ==========================================
+class HarmCategory:
+    HARM_CATEGORY_HARASSMENT = "HARM_CATEGORY_HARASSMENT"
+    HARM_CATEGORY_HATE_SPEECH = "HARM_CATEGORY_HATE_SPEECH"
+    HARM_CATEGORY_SEXUALLY_EXPLICIT = "HARM_CATEGORY_SEXUALLY_EXPLICIT"
+    HARM_CATEGORY_DANGEROUS_CONTENT = "HARM_CATEGORY_DANGEROUS_CONTENT"
+
+
+class HarmBlockThreshold:
+    BLOCK_NONE = "BLOCK_NONE"
+
+
+def _model_latency(model_name):
+    for marker, latency in BACKEND.config.gemini_latency.items():
+        if marker in model_name:
+            return latency
+    return 0.5
+
+
+def _fake_answer(prompt):
+    filler = ("・確認事項のサンプル行です。\n" * (BACKEND.config.response_chars // 14 + 1))[:BACKEND.config.response_chars]
+    if "===SECTION1===" in prompt:
+        return f"===SECTION1===\n{filler}\n===SECTION2===\n- 未決のサンプル\n===SECTION3===\n- 戦略のサンプル"
+    if "===CONFIRMED===" in prompt:
+        return f"===CONFIRMED===\n{filler}\n===PENDING===\n- 未決のサンプル\n===STRATEGY===\n- 戦略のサンプル"
+    return filler
+
+
+class _Usage:
+    def __init__(self, prompt_tokens, response_tokens, cached_tokens=0):
+        self.prompt_token_count = prompt_tokens
+        self.candidates_token_count = response_tokens
+        self.cached_content_token_count = cached_tokens
+
+
+class FakeResponse:
+    def __init__(self, text, usage):
+        self.text = text
+        self.parts = [text] if text else []
+        self.usage_metadata = usage
+
+
+class FakeGenerativeModel:
+    def __init__(self, model_name="gemini-2.5-flash", **kwargs):
+        self.model_name = model_name
+        self.cached_content = None
+
+    @classmethod
+    def from_cached_content(cls, cached_content, **kwargs):
+        model = cls(cached_content.model)
+        model.cached_content = cached_content
+        return model
+
+    def generate_content(self, contents, safety_settings=None, stream=False, **kwargs):
+        prompt = contents if isinstance(contents, str) else "\n".join(map(str, contents))
+        cached = self.cached_content.text if self.cached_content else ""
+        latency = _model_latency(self.model_name)
+        text = _fake_answer(cached + prompt)
+        if (kwargs.get("generation_config") or {}).get("response_mime_type") == "application/json":
+            text = json.dumps({"conf": text, "pend": "- 未決のサンプル", "strat": "- 戦略のサンプル"}, ensure_ascii=False)
+        usage = _Usage(len(cached + prompt) // 2, len(text) // 2, len(cached) // 2)
+        if not stream:
+            BACKEND.call("gemini.generate", latency)
+            return FakeResponse(text, usage)
+        # 最初のチャンクまでに遅延の3割、残りを分割して流す
+        BACKEND.call("gemini.stream", latency * 0.3)
+        return self._stream(text, usage, latency * 0.7)
+
+    @staticmethod
+    def _stream(text, usage, rest_latency, pieces=10):
+        size = max(1, len(text) // pieces)
+        chunks = [text[i:i + size] for i in range(0, len(text), size)]
+        for i, chunk in enumerate(chunks):
+            if i:
+                time.sleep(rest_latency / len(chunks))
+            yield FakeResponse(chunk, usage if i == len(chunks) - 1 else None)
+
+
+class FakeCachedContent:
+    def __init__(self, model, text, ttl):
+        self.name = f"cachedContents/{uuid.uuid4().hex[:12]}"
+        self.model = model
+        self.text = text
+        self.ttl = ttl
+
+    @classmethod
+    def create(cls, model, contents=None, ttl=None, **kwargs):
+        BACKEND.call("gemini.cache_create", 0.2)
+        text = "\n".join(map(str, contents or []))
+        if len(text) // 2 < BACKEND.config.cache_min_tokens:
+            raise ValueError("400 Cached content is too small")
+        content = cls(model.replace("models/", ""), text, ttl)
+        with BACKEND.lock:
+            BACKEND.cached_contents[content.name] = content
+        return content
+
+    def delete(self):
+        BACKEND.call("gemini.cache_delete", 0)
+        with BACKEND.lock:
+            BACKEND.cached_contents.pop(self.name, None)
+
+
+def configure(api_key=None, **kwargs):
+    pass
+
+
+# ==========================================
+# sys.modules への登録
+# ==========================================
+def _module(name, **attrs):
+    module = types.ModuleType(name)
+    module.__dict__.update(attrs)
+    sys.modules[name] = module
+    return module
+
+
+def install(config=None):
+    """偽モジュールを登録する。以降の import gspread などはこのモジュールの実装を返す"""
+    if config is not None:
+        BACKEND.reset(config)
+
+    exceptions = _module("gspread.exceptions", APIError=APIError, WorksheetNotFound=WorksheetNotFound,
+                         CellNotFound=CellNotFound)
+    _module("gspread", authorize=authorize, exceptions=exceptions, APIError=APIError,
+            WorksheetNotFound=WorksheetNotFound, CellNotFound=CellNotFound)
+
+    service_account = _module("oauth2client.service_account", ServiceAccountCredentials=FakeCredentials)
+    _module("oauth2client", service_account=service_account)
+
+    gtypes = _module("google.generativeai.types", HarmCategory=HarmCategory, HarmBlockThreshold=HarmBlockThreshold)
+    caching = _module("google.generativeai.caching", CachedContent=FakeCachedContent)
+    generativeai = _module("google.generativeai", configure=configure, GenerativeModel=FakeGenerativeModel,
+                           types=gtypes, caching=caching)
+    try:
+        # streamlit が使う google.protobuf と同じ名前空間パッケージに相乗りする
+        import google
+    except ImportError:
+        google = _module("google")
+    if not hasattr(google, "__path__"):
+        google.__path__ = []
+    google.generativeai = generativeai
+    return BACKEND
@@ -0,0 +1,213 @@
+"""app.py のオフライン・ベンチマーク。
+
+偽の Sheets / Gemini（bench.fakes）の上で Streamlit の AppTest を使い、
+ログイン → テキスト編集（auto_save）→ プロジェクト切替 → STEP 1〜4 → AI相談 を操作して、
+操作ごとの所要時間・バックエンド呼び出し回数・ピークメモリを表示する。
+
+    python -m bench.run                       # 1セッション
+    python -m bench.run --sessions 5          # 5セッションが1つの偽スプレッドシートを交互に使う
+    python -m bench.run --quota-every 20 --json bench_output.json
+"""
+import argparse
+import json
+import os
+import statistics
+import tempfile
+import time
+import tracemalloc
+import unicodedata
+from collections import Counter, defaultdict
+
+from bench import fakes
+
+APP_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app.py")
+USERS = ["admin", "muramatsu", "wada"]
+
+
+def _find(widgets, key_prefix=None, label=None):
+    for w in widgets:
+        if key_prefix and (w.key or "").startswith(key_prefix):
+            return w
+        if label and w.label == label:
+            return w
+    raise LookupError(f"widget not found: {key_prefix or label}")
+
+
+class Session:
+    """1ユーザー分の AppTest と、操作ごとの計測結果"""
+
+    def __init__(self, index, user, secrets, timeout):
+        from streamlit import logger
+        from streamlit.testing.v1 import AppTest
+        # bare mode の警告などで表が流れないようにする
+        logger.set_log_level("error")
+        self.index = index
+        self.user = user
+        self.at = AppTest.from_file(APP_PATH, default_timeout=timeout)
+        for key, value in secrets.items():
+            self.at.secrets[key] = value
+        self.results = []
+
+    def step(self, name, action, quiet):
+        before = fakes.BACKEND.snapshot()
+        tracemalloc.reset_peak()
+        start = time.perf_counter()
+        action()
+        wall = time.perf_counter() - start
+        # 保存キューなど裏スレッドの書き込みが落ち着くまで待ってから呼び出し回数を数える
+        fakes.BACKEND.wait_idle(quiet=quiet)
+        calls = fakes.BACKEND.snapshot() - before
+        # 例外と、画面に出た st.error（API エラーなど）を数える
+        errors = [str(e.value) for e in self.at.exception] + [str(e.value) for e in self.at.error]
+        self.results.append({
+            "step": name,
+            "wall_ms": round(wall * 1000, 1),
+            "sheets_calls": calls.get("sheets", 0),
+            "gemini_calls": calls.get("gemini", 0),
+            "calls": {k: v for k, v in calls.items() if "." in k},
+            "peak_mb": round(tracemalloc.get_traced_memory()[1] / 1024 / 1024, 2),
+            "errors": errors,
+        })
+
+    def wait_jobs(self, timeout=120):
+        """STEP 1・3・4 は裏のジョブで動くので、「⏳」の表示が消えて結果が画面に出るまで再実行する"""
+        deadline = time.monotonic() + timeout
+        while any("⏳" in str(e.value) for e in self.at.info) and time.monotonic() < deadline:
+            time.sleep(0.2)
+            self.at.run()
+
+    def scenario(self, quiet):
+        """操作を1つ実行するごとに yield するジェネレーター"""
+        at = self.at
+        yield self.step("初期表示", lambda: at.run(), quiet)
+        yield self.step("ログイン", lambda: at.text_input(key="login_input").input(self.user).run(), quiet)
+        yield self.step("テキスト編集 (auto_save)",
+                  lambda: _find(at.text_area, key_prefix="conf_").set_value("■基本情報\nクライアント名：ベンチ株式会社").run(), quiet)
+
+        original = at.session_state["current_project_id"]
+        new_name = f"bench-{self.user}-{self.index}"
+        def create_project():
+            _find(at.sidebar.text_input, label="案件名").input(new_name)
+            _find(at.sidebar.button, label="作成").click().run()
+        yield self.step("プロジェクト作成", create_project, quiet)
+        def switch_project():
+            # 表示は format_func で「名前  (更新日時)」になっているので位置で選ぶ
+            box = _find(at.sidebar.selectbox, label="選択中")
+            index = next(i for i, o in enumerate(box.options) if o == original or o.startswith(f"{original}  ("))
+            box.select_index(index).run()
+        yield self.step("プロジェクト切替", switch_project, quiet)
+
+        def step1():
+            at.text_area(key="tool_a_input").set_value("問い合わせ: 美容室のサイトリニューアル。予約導線を強化したい。")
+            at.button(key="btn_a").click().run()
+            self.wait_jobs()
+        yield self.step("STEP 1 分析", step1, quiet)
+
+        def step2():
+            at.text_area(key="log_in").set_value("クライアント: トップに予約ボタンを大きく置きたい。\n" * 20)
+            _find(at.checkbox, label="まとめ").check()
+            _find(at.checkbox, label="問題抽出").check()
+            at.button(key="btn_b").click().run()
+        yield self.step("STEP 2 会議中サポート", step2, quiet)
+        yield self.step("STEP 3 更新案", lambda: (at.button(key="btn_post").click().run(), self.wait_jobs()), quiet)
+        yield self.step("STEP 4 指示書", lambda: (at.button(key="btn_final").click().run(), self.wait_jobs()), quiet)
+        yield self.step("AI相談", lambda: at.chat_input[0].set_value("予約導線の優先度は？").run(), quiet)
+
+
+def _pad(text, width):
+    """全角文字を2桁として左寄せする"""
+    used = sum(2 if unicodedata.east_asian_width(c) in "WF" else 1 for c in text)
+    return text + " " * max(0, width - used)
+
+
+def _percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def report(sessions):
+    by_step = defaultdict(list)
+    order = []
+    for session in sessions:
+        for r in session.results:
+            if r["step"] not in by_step:
+                order.append(r["step"])
+            by_step[r["step"]].append(r)
+
+    header = f"{_pad('操作', 26)}{'n':>3}{'p50 ms':>10}{'p95 ms':>10}{'Sheets':>8}{'Gemini':>8}{'peak MB':>9}  errors"
+    print(header)
+    print("-" * len(header))
+    for name in order:
+        rows = by_step[name]
+        walls = [r["wall_ms"] for r in rows]
+        errors = sum(len(r["errors"]) for r in rows)
+        print(f"{_pad(name, 26)}{len(rows):>3}{statistics.median(walls):>10.1f}{_percentile(walls, 0.95):>10.1f}"
+              f"{statistics.mean(r['sheets_calls'] for r in rows):>8.1f}"
+              f"{statistics.mean(r['gemini_calls'] for r in rows):>8.1f}"
+              f"{max(r['peak_mb'] for r in rows):>9.2f}  {errors}")
+
+    totals = Counter()
+    for session in sessions:
+        for r in session.results:
+            totals.update(r["calls"])
+    print("\nバックエンド呼び出しの内訳（全セッション合計）:")
+    for name, count in sorted(totals.items()):
+        print(f"  {name:<28}{count:>6}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sessions", type=int, default=1, help="交互に動かすセッション数")
+    parser.add_argument("--sheets-latency", type=float, default=0.05, help="Sheets 呼び出し1回の遅延（秒）")
+    parser.add_argument("--pro-latency", type=float, default=1.5)
+    parser.add_argument("--flash-latency", type=float, default=0.3)
+    parser.add_argument("--quota-every", type=int, default=0, help="N 回に1回 429 を返す")
+    parser.add_argument("--response-chars", type=int, default=800, help="偽 Gemini の応答文字数")
+    parser.add_argument("--save-debounce", type=float, default=0.2, help="SAVE_DEBOUNCE_SEC に渡す値")
+    parser.add_argument("--timeout", type=float, default=120, help="1回の script run のタイムアウト（秒）")
+    parser.add_argument("--storage", choices=["sqlite", "sheets"], default="sqlite", help="STORAGE_BACKEND に渡す値")
+    parser.add_argument("--json", help="生の計測結果を書き出す JSON ファイル")
+    args = parser.parse_args(argv)
+
+    fakes.install(fakes.FakeConfig(
+        sheets_latency=args.sheets_latency,
+        gemini_latency={"pro": args.pro_latency, "flash": args.flash_latency},
+        quota_every=args.quota_every,
+        response_chars=args.response_chars,
+    ))
+    cache_dir = tempfile.mkdtemp(prefix="bench_")
+    secrets = {
+        "gcp_service_account": {"type": "service_account", "client_email": "bench@example.com"},
+        "GEMINI_API_KEY": "fake-key",
+        "SPREADSHEET_NAME": "bench_db",
+        "SAVE_DEBOUNCE_SEC": args.save_debounce,
+        "LLM_CACHE_DIR": cache_dir,
+        "LOCAL_DB_PATH": os.path.join(cache_dir, "local_store.sqlite3"),
+        "STORAGE_BACKEND": args.storage,
+    }
+    quiet = max(0.3, args.save_debounce * 2)
+
+    tracemalloc.start()
+    sessions = [Session(i, USERS[i % len(USERS)], secrets, args.timeout) for i in range(args.sessions)]
+    started = time.perf_counter()
+    # AppTest はスレッドセーフではない（secrets や script の読み込みがプロセス共通）ので、
+    # 複数セッションは1操作ずつ交互に進める。保存キューや cache_resource は本番同様に共有される
+    scenarios = [s.scenario(quiet) for s in sessions]
+    while scenarios:
+        for scenario in list(scenarios):
+            if next(scenario, StopIteration) is StopIteration:
+                scenarios.remove(scenario)
+    elapsed = time.perf_counter() - started
+    tracemalloc.stop()
+
+    print(f"sessions={args.sessions}  total={elapsed:.1f}s\n")
+    report(sessions)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "elapsed_sec": elapsed,
+                       "sessions": [{"user": s.user, "results": s.results} for s in sessions]},
+                      f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+"""app.py を偽の Sheets / Gemini（bench.fakes）の上で読み込むための準備"""
+import os
+import sys
+import tempfile
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench import fakes  # noqa: E402
+
+fakes.install(fakes.FakeConfig(sheets_latency=0, gemini_latency={"pro": 0, "flash": 0}))
+
+_tmp = tempfile.mkdtemp(prefix="tests_")
+with open(os.path.join(_tmp, "secrets.toml"), "w", encoding="utf-8") as f:
+    f.write(f"""
+GEMINI_API_KEY = "fake-key"
+SPREADSHEET_NAME = "test_db"
+STORAGE_BACKEND = "sheets"
+LLM_CACHE_DIR = "{os.path.join(_tmp, 'llm_cache')}"
+LOCAL_DB_PATH = "{os.path.join(_tmp, 'local_store.sqlite3')}"
+
+[gcp_service_account]
+type = "service_account"
+client_email = "test@example.com"
+""")
+
+from streamlit import config  # noqa: E402
+
+config.set_option("secrets.files", [os.path.join(_tmp, "secrets.toml")])
+
+
+@pytest.fixture
+def app():
+    import app as module
+    return module
+
+
+@pytest.fixture
+def sheets(app):
+    """空の偽スプレッドシートにつないだ SpreadsheetDB"""
+    fakes.BACKEND.reset()
+    app.get_sheets_pool().reset()
+    return app.SpreadsheetDB()
@@ -0,0 +1,70 @@
+import random
+
+import pytest
+
+from bench import fakes
+
+
+def _noise(n, seed=0):
+    """圧縮が効かない文字列（続きのチャンクができる長さを作るため）"""
+    rng = random.Random(seed)
+    return "".join(rng.choice("0123456789abcdefghijklmnopqrstuvwxyz") for _ in range(n))
+
+
+@pytest.mark.parametrize("text", ["", "短い値", "あ" * 3000, "#zc1:平文のふり", _noise(120000)])
+def test_pack_cell_round_trip(app, text):
+    value, chunks = app.pack_cell(text, version="v1")
+    assert app.unpack_cell(value, chunks) == text
+    assert app._has_overflow(value) == bool(chunks)
+
+
+def test_pack_cell_keeps_short_text_plain(app):
+    assert app.pack_cell("abc") == ("abc", [])
+
+
+def test_version_is_only_added_with_overflow(app):
+    value, chunks = app.pack_cell("あ" * 3000, version="v1")
+    assert not chunks and app._overflow_key("u/p/E", value) == "u/p/E"
+    value, chunks = app.pack_cell(_noise(120000), version="v1")
+    assert chunks and app._overflow_key("u/p/E", value) == "u/p/E/v1"
+
+
+def test_unpack_cell_rejects_missing_chunks(app):
+    value, chunks = app.pack_cell(_noise(120000))
+    with pytest.raises(ValueError):
+        app.unpack_cell(value, chunks[:-1])
+
+
+def _big_project(app, n):
+    proj = app.new_project()
+    proj["meeting_history"] = [{"time": str(i), "text": _noise(5000, seed=i)} for i in range(n)]
+    return proj
+
+
+def test_unreadable_overflow_raises_instead_of_returning_empty_history(app, sheets):
+    assert sheets.save_project("u", "P", _big_project(app, 30)) is None
+    assert len(sheets.get_project("u", "P", strict=True)["meeting_history"]) == 30
+
+    overflow = fakes.BACKEND.spreadsheets["test_db"][app.OVERFLOW_SHEET]
+    saved, overflow._rows = overflow._rows, overflow._rows[:1]
+    sheets.pool.invalidate(app.OVERFLOW_SHEET)
+    with pytest.raises(ValueError):
+        sheets.get_project("u", "P", strict=True)
+    assert sheets.get_project("u", "P") is None
+
+    overflow._rows = saved
+    sheets.pool.invalidate(app.OVERFLOW_SHEET)
+    assert len(sheets.get_project("u", "P", strict=True)["meeting_history"]) == 30
+
+
+def test_failed_main_write_keeps_old_overflow(app, sheets, monkeypatch):
+    assert sheets.save_project("u", "P", _big_project(app, 30)) is None
+
+    def fail(*args, **kwargs):
+        raise fakes.APIError("APIError: [503]: unavailable")
+    monkeypatch.setattr(fakes.FakeWorksheet, "batch_update", fail)
+    assert sheets.save_project("u", "P", _big_project(app, 20), fields={"meeting_history"})
+    monkeypatch.undo()
+
+    proj = sheets.get_project("u", "P", strict=True)
+    assert len(proj["meeting_history"]) == 30
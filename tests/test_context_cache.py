@@ -0,0 +1,21 @@
+class _Backend:
+    def create(self, model_name, context, ttl_sec):
+        if context.startswith("fail"):
+            raise RuntimeError("create failed")
+        return f"handle:{context}"
+
+    def model(self, handle):
+        return handle
+
+    def delete(self, handle):
+        pass
+
+
+def test_creating_locks_are_released(app):
+    cache = app.ContextCache(_Backend(), ttl_sec=3600, min_tokens=0, max_entries=4)
+    for i in range(10):
+        assert cache.model_for("m", f"ctx {i}") == f"handle:ctx {i}"
+        assert cache.model_for("m", f"ctx {i}") == f"handle:ctx {i}"
+        assert cache.model_for("m", f"fail {i}") is None
+    assert cache._creating == {}
+    assert cache.stats["hits"] == 10 and cache.stats["created"] == 10 and cache.stats["fallbacks"] == 10
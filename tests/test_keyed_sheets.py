@@ -0,0 +1,23 @@
+from bench import fakes
+
+
+def test_load_archive_reads_only_matching_rows(sheets):
+    assert sheets.archive_entries("x", "other", "chat_history", [(i, {"n": i}) for i in range(50)]) is None
+    assert sheets.archive_entries("u", "P", "chat_history", [(0, {"n": "a"}), (1, {"n": "b"})]) is None
+    assert sheets.archive_entries("u", "P", "meeting_history", [(0, {"n": "c"})]) is None
+
+    before = fakes.BACKEND.snapshot()
+    assert sheets.load_archive("u", "P", "chat_history", strict=True) == [(0, {"n": "a"}), (1, {"n": "b"})]
+    calls = fakes.BACKEND.snapshot() - before
+    assert calls["sheets.get_all_values"] == 0 and calls["sheets.batch_get"] == 2
+    assert sheets.load_archive("u", "Q", "chat_history", strict=True) == []
+
+
+def test_load_transcript_filters_by_key_and_seq(sheets):
+    assert sheets.append_transcript("x", "other", [(i, "t", f"o{i}") for i in range(1, 50)]) is None
+    assert sheets.append_transcript("u", "P", [(10, "t", "a"), (20, "t", "b")]) is None
+
+    before = fakes.BACKEND.snapshot()
+    assert sheets.load_transcript("u", "P", after=10, strict=True) == [(20, "t", "b")]
+    assert (fakes.BACKEND.snapshot() - before)["sheets.get_all_values"] == 0
+    assert sheets.load_transcript("u", "P", strict=True) == [(10, "t", "a"), (20, "t", "b")]